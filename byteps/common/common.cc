@@ -116,6 +116,10 @@ ncclDataType_t getNcclDataType(DataType dtype) {
       return ncclInt8;
     case BYTEPS_INT64:
       return ncclUint64;
+#if NCCL_MAJOR > 2 || (NCCL_MAJOR == 2 && NCCL_MINOR >= 10)
+    case BYTEPS_BFLOAT16:
+      return ncclBfloat16;
+#endif
     default:
       BPS_CHECK(0) << "Unsupported data type: " << dtype;
   }
@@ -128,6 +132,7 @@ int getDataTypeLength(int dtype) {
     case BYTEPS_UINT8:
       return 1;
     case BYTEPS_FLOAT16:
+    case BYTEPS_BFLOAT16:
       return 2;
     case BYTEPS_INT32:
     case BYTEPS_FLOAT32:
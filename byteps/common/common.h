@@ -61,6 +61,8 @@ enum DataType {
   // BYTEPS_INT16 = 8,
   // BYTEPS_BOOL = 9,
   // BYTEPS_BYTE = 10,
+  // same as mshadow::kBfloat16
+  BYTEPS_BFLOAT16 = 12,
 };
 
 // List of supported frameworks.
@@ -156,9 +158,38 @@ typedef struct CommTime {
   int type = -1;
 } BPSCommTime;
 
+enum class RequestType {
+  kDefaultPushPull,
+  kRowSparsePushPull,
+  kCompressedPushPull,
+  kServerOptimizerPushPull
+};
+
+struct BytePSContext;
+struct TensorTableEntry;
+
+// Small tensors that are pushed and pulled as one key, see
+// BYTEPS_FUSION_BYTES. Each member has its own slice of cpubuff, and the
+// tasks of the members wait in push_tasks and pull_tasks until all members
+// are there.
+struct FusionGroup {
+  uint64_t key;
+  size_t len;
+  int dtype;
+  void* cpubuff;
+  std::vector<BytePSContext*> members;
+  std::mutex mutex;
+  std::vector<std::shared_ptr<TensorTableEntry>> push_tasks;
+  std::vector<std::shared_ptr<TensorTableEntry>> pull_tasks;
+};
+
 typedef struct BytePSContext {
   bool initialized;
   std::mutex init_mutex;
+  // set while InitTensorAsync is in flight, the callbacks run once it is
+  // done, both guarded by init_mutex
+  bool initializing = false;
+  std::vector<std::function<void()>> init_callbacks;
   // tensor name
   std::string tensor_name;
   // using ps::Key = uint64_t
@@ -172,6 +203,22 @@ typedef struct BytePSContext {
   // CPU buffer for cross-PCIe-switch merging
   std::vector<void*> pcie_cpubuff;
   size_t buff_len;
+  // size in bytes given at declaration, used by the balanced placement
+  size_t declared_size = 0;
+  // How the servers handle the pushed data of this tensor
+  RequestType request_type = RequestType::kDefaultPushPull;
+  // per-partition buffers for the compressed payload of kCompressedPushPull
+  std::vector<void*> compressed_buff;
+  // number of rows and bytes per row of kRowSparsePushPull tensors
+  size_t row_num = 0;
+  size_t row_len = 0;
+  // data type, set by InitTensor
+  int dtype = 0;
+  // may be fused with other small tensors, see BYTEPS_FUSION_BYTES
+  bool fusion = false;
+  // the group and the offset in its buffer, set by InitTensors
+  std::shared_ptr<FusionGroup> fusion_group;
+  size_t fusion_offset = 0;
   // Used for profiling communication events
   std::queue<BPSCommTime *> comm_time;
   bool profile_flag = false;
@@ -193,6 +240,22 @@ class Tensor {
 // A callback to call after the PS communication completes.
 using StatusCallback = std::function<void(const Status&)>;
 
+// Payload of kRowSparsePushPull: this header, num_rows uint32 row ids local to
+// the partition, then num_rows rows of row_len bytes. The init push only has
+// the header, with num_rows being all rows of the partition.
+struct RowSparseHeader {
+  uint32_t num_rows;
+  uint32_t row_len;
+};
+
+// Result of a row-sparse push_pull: the rows pushed by any worker, summed
+struct RowSparseData {
+  std::vector<int64_t> indices;
+  std::vector<char> values;
+};
+using RowSparseCallback =
+    std::function<void(const Status&, std::shared_ptr<RowSparseData>)>;
+
 // Table storing Tensors to be reduced, keyed by unique name.
 // This table contains everything necessary to do the reduction.
 struct TensorTableEntry {
@@ -234,15 +297,11 @@ struct TensorTableEntry {
   std::shared_ptr<std::atomic_int> counter_ptr;
   // How many partitions
   unsigned int total_partnum = 0;
+  // Set if this task is pushed and pulled as part of its fusion group
+  std::shared_ptr<FusionGroup> fusion_group;
 };
 using TensorTable = std::unordered_map<std::string, TensorTableEntry>;
 
-enum class RequestType {
-  kDefaultPushPull,
-  kRowSparsePushPull,
-  kCompressedPushPull
-};
-
 int GetCommandType(RequestType requestType, int d);
 
 #ifndef BYTEPS_BUILDING_SERVER
@@ -15,7 +15,9 @@
 
 #include "core_loops.h"
 #include <cuda_runtime.h>
+#include <algorithm>
 #include <chrono>
+#include <cstring>
 #include <memory>
 #include "common.h"
 #include "global.h"
@@ -168,7 +170,7 @@ bool RunCoordinateLoopOnce(QueueType this_op) {
                    << "Signal=" << sig << ", rank=" << rank << ", key=" << key;
 
   } else {
-    std::this_thread::sleep_for(std::chrono::nanoseconds(1000));
+    q->wait();
   }
   return true;
 }
@@ -289,7 +291,8 @@ bool RunRootNcclLoopOnce() {
     BytePSGlobal::GetNccl()->EnqueueGroup(nccl_entry);
   } else {
     NCCLCHECK(ncclGroupEnd());
-    std::this_thread::sleep_for(std::chrono::nanoseconds(1000));
+    // REDUCE and BROADCAST share the notifier
+    BytePSGlobal::GetScheduledQueue(REDUCE)->wait();
   }
 
   return true;
@@ -349,7 +352,7 @@ bool RunSyncNcclOnce() {
     BPS_LOG(TRACE) << "Finished NCCL Group size=" << nccl_entry->tasks.size()
                    << " rank=" << BytePSGlobal::GetLocalRank();
   } else {
-    std::this_thread::sleep_for(std::chrono::nanoseconds(1000));
+    BytePSGlobal::GetNccl()->WaitGroup();
   }
   return true;
 }
@@ -411,7 +414,7 @@ bool RunCopyDevice2HostLoopOnce() {
 
     FinishOrProceed(task);
   } else {
-    std::this_thread::sleep_for(std::chrono::nanoseconds(1000));
+    q->wait();
   }
   return true;
 }
@@ -464,11 +467,238 @@ bool RunPcieReduceLoopOnce() {
 
     FinishOrProceed(task);
   } else {
-    std::this_thread::sleep_for(std::chrono::nanoseconds(1000));
+    q->wait();
   }
   return true;
 }
 
+// Copies the slices of the group buffer back to the fused tasks
+void ScatterFused(std::shared_ptr<FusionGroup> group,
+                  const std::vector<std::shared_ptr<TensorTableEntry>> &tasks) {
+  for (auto &t : tasks) {
+    memcpy((char *)t->cpubuff + t->offset,
+           (char *)group->cpubuff + t->context->fusion_offset, t->len);
+  }
+}
+
+// Copies the data of a fused task to its slice of the group buffer. Once
+// all members are there, pushes the group buffer as one key.
+void PushFused(std::shared_ptr<TensorTableEntry> task) {
+  auto group = task->fusion_group;
+  memcpy((char *)group->cpubuff + task->context->fusion_offset,
+         (char *)task->cpubuff + task->offset, task->len);
+  std::vector<std::shared_ptr<TensorTableEntry>> tasks;
+  {
+    std::lock_guard<std::mutex> lock(group->mutex);
+    group->push_tasks.push_back(task);
+    if (group->push_tasks.size() < group->members.size()) return;
+    tasks.swap(group->push_tasks);
+  }
+  ps::SArray<char> vals((char *)group->cpubuff, group->len, false);
+  auto &pskv = BytePSGlobal::EncodeDefaultKey(group->key, group->len);
+  int cmd = GetCommandType(RequestType::kDefaultPushPull, group->dtype);
+  if (BytePSGlobal::IsPushPullRPC()) {
+    // the merged data overwrites the pushed data
+    auto outs = new ps::SArray<char>((char *)group->cpubuff, group->len, false);
+    BytePSGlobal::GetPS()->ZPushPull(pskv.keys, vals, outs, &pskv.lens, cmd,
+                                     [outs, group, tasks]() {
+                                       ScatterFused(group, tasks);
+                                       delete outs;
+                                       for (auto &t : tasks) FinishOrProceed(t);
+                                     });
+    return;
+  }
+  BytePSGlobal::GetPS()->ZPush(pskv.keys, vals, pskv.lens, cmd, [tasks]() {
+    for (auto &t : tasks) FinishOrProceed(t);
+  });
+}
+
+// Pulls the group buffer as one key once all members are there, and copies
+// the slices back to the members.
+void PullFused(std::shared_ptr<TensorTableEntry> task) {
+  auto group = task->fusion_group;
+  std::vector<std::shared_ptr<TensorTableEntry>> tasks;
+  {
+    std::lock_guard<std::mutex> lock(group->mutex);
+    group->pull_tasks.push_back(task);
+    if (group->pull_tasks.size() < group->members.size()) return;
+    tasks.swap(group->pull_tasks);
+  }
+  auto vals = new ps::SArray<char>((char *)group->cpubuff, group->len, false);
+  auto &pskv = BytePSGlobal::EncodeDefaultKey(group->key, group->len);
+  int cmd = GetCommandType(RequestType::kDefaultPushPull, group->dtype);
+  BytePSGlobal::GetPS()->ZPull(
+      pskv.keys, vals, &pskv.lens, cmd, [vals, group, tasks]() {
+        ScatterFused(group, tasks);
+        delete vals;
+        for (auto &t : tasks) FinishOrProceed(t);
+      });
+}
+
+// Tasks in a batch are handled key by key on the server, with the command
+// of the request
+bool IsBatchable(const TensorTableEntry &task) {
+  auto type = task.context->request_type;
+  return !task.fusion_group && (type == RequestType::kDefaultPushPull ||
+                                type == RequestType::kServerOptimizerPushPull);
+}
+
+// Pops the other ready tasks that go to the same server as task with the
+// same command, up to BYTEPS_PS_BATCH_SIZE tasks in total. The batch is
+// sorted by ps-lite key, as ps-lite expects.
+std::vector<std::shared_ptr<TensorTableEntry>> PopBatch(
+    BytePSScheduledQueue *q, std::shared_ptr<TensorTableEntry> task,
+    int cmd) {
+  std::vector<std::shared_ptr<TensorTableEntry>> batch{task};
+  auto server = BytePSGlobal::EncodeDefaultKey(task->key, task->len).server;
+  auto filter = [server, cmd](const TensorTableEntry &e) {
+    return IsBatchable(e) &&
+           GetCommandType(e.context->request_type, e.tensor->dtype()) == cmd &&
+           BytePSGlobal::EncodeDefaultKey(e.key, e.len).server == server;
+  };
+  while (batch.size() < BytePSGlobal::GetPSBatchSize()) {
+    auto next = q->getTask(filter);
+    if (!next) break;
+    batch.push_back(next);
+  }
+  std::sort(batch.begin(), batch.end(),
+            [](const std::shared_ptr<TensorTableEntry> &a,
+               const std::shared_ptr<TensorTableEntry> &b) {
+              return BytePSGlobal::EncodeDefaultKey(a->key, a->len).keys[0] <
+                     BytePSGlobal::EncodeDefaultKey(b->key, b->len).keys[0];
+            });
+  return batch;
+}
+
+// Keys and lens of a batch, the values are laid out in this order
+void EncodeBatch(const std::vector<std::shared_ptr<TensorTableEntry>> &batch,
+                 ps::SArray<ps::Key> *keys, ps::SArray<int> *lens,
+                 size_t *total) {
+  *total = 0;
+  for (auto &t : batch) {
+    auto &pskv = BytePSGlobal::EncodeDefaultKey(t->key, t->len);
+    keys->push_back(pskv.keys[0]);
+    lens->push_back(t->len);
+    *total += t->len;
+  }
+}
+
+// Copies the values of a batch, laid out in the order of the batch, back
+// into the partitions
+void ScatterBatch(const std::vector<std::shared_ptr<TensorTableEntry>> &batch,
+                  const char *data) {
+  size_t offset = 0;
+  for (auto &t : batch) {
+    memcpy((char *)t->cpubuff + t->offset, data + offset, t->len);
+    offset += t->len;
+  }
+}
+
+// Copies the data of the batch into one buffer and pushes it as one
+// multi-key request
+void PushBatch(const std::vector<std::shared_ptr<TensorTableEntry>> &batch,
+               int cmd) {
+  ps::SArray<ps::Key> keys;
+  ps::SArray<int> lens;
+  size_t total;
+  EncodeBatch(batch, &keys, &lens, &total);
+  ps::SArray<char> vals(total);
+  size_t offset = 0;
+  for (auto &t : batch) {
+    memcpy(vals.data() + offset, (char *)t->cpubuff + t->offset, t->len);
+    offset += t->len;
+  }
+  if (BytePSGlobal::IsPushPullRPC()) {
+    auto outs = new ps::SArray<char>(total);
+    auto out_lens = new ps::SArray<int>(lens);
+    BytePSGlobal::GetPS()->ZPushPull(keys, vals, outs, out_lens, cmd,
+                                     [outs, out_lens, batch]() {
+                                       ScatterBatch(batch, outs->data());
+                                       delete outs;
+                                       delete out_lens;
+                                       for (auto &t : batch) FinishOrProceed(t);
+                                     });
+    return;
+  }
+  BytePSGlobal::GetPS()->ZPush(keys, vals, lens, cmd, [batch]() {
+    for (auto &t : batch) FinishOrProceed(t);
+  });
+}
+
+// Pulls the batch as one multi-key request and copies the values back
+void PullBatch(const std::vector<std::shared_ptr<TensorTableEntry>> &batch,
+               int cmd) {
+  ps::SArray<ps::Key> keys;
+  auto lens = new ps::SArray<int>();
+  size_t total;
+  EncodeBatch(batch, &keys, lens, &total);
+  auto vals = new ps::SArray<char>(total);
+  BytePSGlobal::GetPS()->ZPull(keys, vals, lens, cmd, [vals, lens, batch]() {
+    ScatterBatch(batch, vals->data());
+    delete vals;
+    delete lens;
+    for (auto &t : batch) FinishOrProceed(t);
+  });
+}
+
+// Pulls a single task, fused tasks wait for the other members of their
+// group
+void PullTask(std::shared_ptr<TensorTableEntry> task) {
+  if (task->fusion_group) {
+    PullFused(task);
+    return;
+  }
+  auto offset = task->offset;
+  auto len = task->len;
+
+  char *data;
+  BPS_CHECK(task->cpubuff);
+  data = const_cast<char *>(static_cast<const char *>(task->cpubuff) + offset);
+
+  // get metadata
+  const int dtype = task->output->dtype();
+
+  if (task->context->request_type == RequestType::kCompressedPushPull &&
+      BytePSGlobal::IsPullCompressed()) {
+    // pull the recompressed data and decompress it into cpubuff
+    int cmd = GetCommandType(RequestType::kCompressedPushPull, dtype);
+    auto part = task->key - task->context->key_list[0];
+    auto buff = (char *)task->context->compressed_buff[part];
+    size_t count = len / sizeof(float);
+    auto compressed_len = CpuReducer::GetCompressedLen(
+        BytePSGlobal::GetCompressMethod(), count,
+        BytePSGlobal::GetCompressTopK(count));
+    auto vals = new ps::SArray<char>(buff, compressed_len, false);
+    auto &pskv =
+        BytePSGlobal::EncodeCompressedKey(task->key, len, compressed_len);
+    BytePSGlobal::GetPS()->ZPull(
+        pskv.keys, vals, &pskv.lens, cmd,
+        [vals, task, data, buff, compressed_len]() {
+          BytePSGlobal::GetCpuReducer()->decompress(data, buff, compressed_len,
+                                                    false);
+          delete vals;
+          FinishOrProceed(task);
+        });
+  } else {
+    // false means not to delete data when SArray is deleted
+    auto vals = new ps::SArray<char>(data, len, false);
+
+    // the servers send back the uncompressed data of compressed tensors
+    // unless BYTEPS_COMPRESS_PULL is set
+    int cmd = GetCommandType(RequestType::kDefaultPushPull, dtype);
+    if (task->context->request_type != RequestType::kCompressedPushPull) {
+      cmd = GetCommandType(task->context->request_type, dtype);
+    }
+    auto &pskv = BytePSGlobal::EncodeDefaultKey(task->key, len);
+    // issue pull
+    BytePSGlobal::GetPS()->ZPull(pskv.keys, vals, &pskv.lens, cmd,
+                                 [vals, task]() {
+                                   delete vals;
+                                   FinishOrProceed(task);
+                                 });
+  }
+}
+
 bool RunPushLoopOnce() {
   QueueType this_op = PUSH;
   auto q = BytePSGlobal::GetScheduledQueue(this_op);
@@ -477,7 +707,20 @@ bool RunPushLoopOnce() {
     BPS_CHECK(BytePSGlobal::IsRootDevice())
         << "only root device should enter PUSH loop";
 
-    if (BytePSGlobal::IsDistributed()) {
+    if (BytePSGlobal::IsDistributed() && BytePSGlobal::GetPSBatchSize() > 1 &&
+        IsBatchable(*task)) {
+      int cmd = GetCommandType(task->context->request_type,
+                               task->tensor->dtype());
+      auto batch = PopBatch(q, task, cmd);
+      if (batch.size() > 1) {
+        PushBatch(batch, cmd);
+        return true;
+      }
+    }
+
+    if (task->fusion_group) {
+      PushFused(task);
+    } else if (BytePSGlobal::IsDistributed()) {
       auto offset = task->offset;
       auto len = task->len;
 
@@ -489,20 +732,51 @@ bool RunPushLoopOnce() {
       // get metadata
       const int dtype = task->tensor->dtype();
 
-      // false means not to delete data when SArray is deleted
-      ps::SArray<char> vals(data, len, false);
-
-      int cmd = GetCommandType(RequestType::kDefaultPushPull, dtype);
-      auto &pskv = BytePSGlobal::EncodeDefaultKey(task->key, len);
-      BytePSGlobal::GetPS()->ZPush(pskv.keys, vals, pskv.lens, cmd,
-                                   [task, q]() { FinishOrProceed(task); });
+      int cmd = GetCommandType(task->context->request_type, dtype);
+      if (task->context->request_type == RequestType::kCompressedPushPull) {
+        auto part = task->key - task->context->key_list[0];
+        auto buff = (char *)task->context->compressed_buff[part];
+        size_t count = len / sizeof(float);
+        auto compressed_len = BytePSGlobal::GetCpuReducer()->compress(
+            buff, data, len, BytePSGlobal::GetCompressMethod(),
+            BytePSGlobal::GetCompressTopK(count));
+        ps::SArray<char> vals(buff, compressed_len, false);
+        auto &pskv =
+            BytePSGlobal::EncodeCompressedKey(task->key, len, compressed_len);
+        // the servers cannot answer a compressed push with the merged data,
+        // so the pull is chained within this stage
+        BytePSGlobal::GetPS()->ZPush(pskv.keys, vals, pskv.lens, cmd,
+                                     [task, q]() {
+                                       if (BytePSGlobal::IsPushPullRPC()) {
+                                         PullTask(task);
+                                       } else {
+                                         FinishOrProceed(task);
+                                       }
+                                     });
+      } else if (BytePSGlobal::IsPushPullRPC()) {
+        // the merged data overwrites the pushed data
+        ps::SArray<char> vals(data, len, false);
+        auto outs = new ps::SArray<char>(data, len, false);
+        auto &pskv = BytePSGlobal::EncodeDefaultKey(task->key, len);
+        BytePSGlobal::GetPS()->ZPushPull(pskv.keys, vals, outs, &pskv.lens,
+                                         cmd, [outs, task]() {
+                                           delete outs;
+                                           FinishOrProceed(task);
+                                         });
+      } else {
+        // false means not to delete data when SArray is deleted
+        ps::SArray<char> vals(data, len, false);
+        auto &pskv = BytePSGlobal::EncodeDefaultKey(task->key, len);
+        BytePSGlobal::GetPS()->ZPush(pskv.keys, vals, pskv.lens, cmd,
+                                     [task, q]() { FinishOrProceed(task); });
+      }
     } else {
       // This is a dummy barrier for IsCrossPcieSwitch()
       BPS_CHECK(BytePSGlobal::IsCrossPcieSwitch());
       FinishOrProceed(task);
     }
   } else {
-    std::this_thread::sleep_for(std::chrono::nanoseconds(1000));
+    q->wait();
   }
   return true;
 }
@@ -514,31 +788,18 @@ bool RunPullLoopOnce() {
   if (task) {
     BPS_CHECK(BytePSGlobal::IsRootDevice())
         << "only root device should enter PULL loop";
-    // TODO: allow merging
-    auto offset = task->offset;
-    auto len = task->len;
-
-    char *data;
-    BPS_CHECK(task->cpubuff);
-    data =
-        const_cast<char *>(static_cast<const char *>(task->cpubuff) + offset);
-
-    // get metadata
-    const int dtype = task->output->dtype();
-
-    // false means not to delete data when SArray is deleted
-    auto vals = new ps::SArray<char>(data, len, false);
-
-    int cmd = GetCommandType(RequestType::kDefaultPushPull, dtype);
-    auto &pskv = BytePSGlobal::EncodeDefaultKey(task->key, len);
-    // issue pull
-    BytePSGlobal::GetPS()->ZPull(pskv.keys, vals, &pskv.lens, cmd,
-                                 [vals, task, q]() {
-                                   delete vals;
-                                   FinishOrProceed(task);
-                                 });
+    if (BytePSGlobal::GetPSBatchSize() > 1 && IsBatchable(*task)) {
+      int cmd = GetCommandType(task->context->request_type,
+                               task->tensor->dtype());
+      auto batch = PopBatch(q, task, cmd);
+      if (batch.size() > 1) {
+        PullBatch(batch, cmd);
+        return true;
+      }
+    }
+    PullTask(task);
   } else {
-    std::this_thread::sleep_for(std::chrono::nanoseconds(1000));
+    q->wait();
   }
   return true;
 }
@@ -604,7 +865,7 @@ bool RunRootCopyHost2DeviceLoopOnce() {
 
     FinishOrProceed(task);
   } else {
-    std::this_thread::sleep_for(std::chrono::nanoseconds(1000));
+    q->wait();
   }
   return true;
 }
@@ -638,7 +899,7 @@ bool RunNonRootCopyHost2DeviceLoopOnce() {
     CopyHost2Device(task);
     FinishOrProceed(task);
   } else {
-    std::this_thread::sleep_for(std::chrono::nanoseconds(1000));
+    q->wait();
   }
   return true;
 }
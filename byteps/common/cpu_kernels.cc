@@ -0,0 +1,484 @@
+// Copyright 2019 Bytedance Inc. or its affiliates. All Rights Reserved.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//     http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+// =============================================================================
+
+#include <cstdlib>
+#include <cstring>
+
+#if defined(__x86_64__) || defined(__i386__)
+#define BYTEPS_X86_KERNELS 1
+#include <cpuid.h>
+#include <immintrin.h>
+// the _mm*_undefined_* helpers of some GCC versions trip this warning
+#if defined(__GNUC__) && !defined(__clang__)
+#pragma GCC diagnostic ignored "-Wmaybe-uninitialized"
+#endif
+#endif
+
+#include "cpu_kernels.h"
+#include "logging.h"
+
+namespace byteps {
+namespace common {
+
+namespace {
+
+// Kernels of one instruction set. uint8 and int8 share a kernel, because
+// wrap-around addition is the same for both.
+struct SumKernelTable {
+  SumKernel f32;
+  SumKernel f64;
+  SumKernel f16;
+  SumKernel bf16;
+  SumKernel i8;
+  SumKernel i32;
+  SumKernel i64;
+};
+
+template <typename T>
+void SumGeneric(void* out, const void* a, const void* b, size_t n) {
+  auto o = reinterpret_cast<T*>(out);
+  auto x = reinterpret_cast<const T*>(a);
+  auto y = reinterpret_cast<const T*>(b);
+  for (size_t i = 0; i < n; ++i) {
+    o[i] = x[i] + y[i];
+  }
+}
+
+void SumFloat16Generic(void* out, const void* a, const void* b, size_t n) {
+  auto o = reinterpret_cast<unsigned short*>(out);
+  auto x = reinterpret_cast<const unsigned short*>(a);
+  auto y = reinterpret_cast<const unsigned short*>(b);
+  for (size_t i = 0; i < n; ++i) {
+    float x_float;
+    float y_float;
+    HalfBits2Float(x + i, &x_float);
+    HalfBits2Float(y + i, &y_float);
+    x_float += y_float;
+    Float2HalfBits(&x_float, o + i);
+  }
+}
+
+void SumBFloat16Generic(void* out, const void* a, const void* b, size_t n) {
+  auto o = reinterpret_cast<unsigned short*>(out);
+  auto x = reinterpret_cast<const unsigned short*>(a);
+  auto y = reinterpret_cast<const unsigned short*>(b);
+  for (size_t i = 0; i < n; ++i) {
+    float x_float;
+    float y_float;
+    BFloat16Bits2Float(x + i, &x_float);
+    BFloat16Bits2Float(y + i, &y_float);
+    x_float += y_float;
+    Float2BFloat16Bits(&x_float, o + i);
+  }
+}
+
+void Float2HalfGeneric(unsigned short* dst, const float* src, size_t n) {
+  for (size_t i = 0; i < n; ++i) {
+    Float2HalfBits(src + i, dst + i);
+  }
+}
+
+void Half2FloatGeneric(float* dst, const unsigned short* src, size_t n,
+                       bool add) {
+  for (size_t i = 0; i < n; ++i) {
+    float f;
+    HalfBits2Float(src + i, &f);
+    dst[i] = add ? dst[i] + f : f;
+  }
+}
+
+#if BYTEPS_X86_KERNELS
+
+// Defines kernel NAME for TARGET, which adds WIDTH elements of T with one
+// instruction and the remainder one by one. The loads and stores are
+// unaligned, so any offset of the buffers works.
+#define BYTEPS_SUM_KERNEL(NAME, TARGET, T, WIDTH, PTR, LOAD, STORE, ADD) \
+  __attribute__((target(TARGET))) void NAME(void* out, const void* a,   \
+                                            const void* b, size_t n) {   \
+    auto o = reinterpret_cast<T*>(out);                                  \
+    auto x = reinterpret_cast<const T*>(a);                              \
+    auto y = reinterpret_cast<const T*>(b);                              \
+    size_t i = 0;                                                        \
+    for (; i + WIDTH <= n; i += WIDTH) {                                 \
+      STORE((PTR*)(o + i),                                               \
+            ADD(LOAD((const PTR*)(x + i)), LOAD((const PTR*)(y + i))));  \
+    }                                                                    \
+    for (; i < n; ++i) {                                                 \
+      o[i] = x[i] + y[i];                                                \
+    }                                                                    \
+  }
+
+BYTEPS_SUM_KERNEL(SumFloat32Sse, "sse2", float, 4, float, _mm_loadu_ps,
+                  _mm_storeu_ps, _mm_add_ps)
+BYTEPS_SUM_KERNEL(SumFloat64Sse, "sse2", double, 2, double, _mm_loadu_pd,
+                  _mm_storeu_pd, _mm_add_pd)
+BYTEPS_SUM_KERNEL(SumInt8Sse, "sse2", int8_t, 16, __m128i, _mm_loadu_si128,
+                  _mm_storeu_si128, _mm_add_epi8)
+BYTEPS_SUM_KERNEL(SumInt32Sse, "sse2", int32_t, 4, __m128i, _mm_loadu_si128,
+                  _mm_storeu_si128, _mm_add_epi32)
+BYTEPS_SUM_KERNEL(SumInt64Sse, "sse2", int64_t, 2, __m128i, _mm_loadu_si128,
+                  _mm_storeu_si128, _mm_add_epi64)
+
+BYTEPS_SUM_KERNEL(SumFloat32Avx2, "avx2", float, 8, float, _mm256_loadu_ps,
+                  _mm256_storeu_ps, _mm256_add_ps)
+BYTEPS_SUM_KERNEL(SumFloat64Avx2, "avx2", double, 4, double, _mm256_loadu_pd,
+                  _mm256_storeu_pd, _mm256_add_pd)
+BYTEPS_SUM_KERNEL(SumInt8Avx2, "avx2", int8_t, 32, __m256i,
+                  _mm256_loadu_si256, _mm256_storeu_si256, _mm256_add_epi8)
+BYTEPS_SUM_KERNEL(SumInt32Avx2, "avx2", int32_t, 8, __m256i,
+                  _mm256_loadu_si256, _mm256_storeu_si256, _mm256_add_epi32)
+BYTEPS_SUM_KERNEL(SumInt64Avx2, "avx2", int64_t, 4, __m256i,
+                  _mm256_loadu_si256, _mm256_storeu_si256, _mm256_add_epi64)
+
+BYTEPS_SUM_KERNEL(SumFloat32Avx512, "avx512f", float, 16, float,
+                  _mm512_loadu_ps, _mm512_storeu_ps, _mm512_add_ps)
+BYTEPS_SUM_KERNEL(SumFloat64Avx512, "avx512f", double, 8, double,
+                  _mm512_loadu_pd, _mm512_storeu_pd, _mm512_add_pd)
+BYTEPS_SUM_KERNEL(SumInt8Avx512, "avx512f,avx512bw", int8_t, 64, __m512i,
+                  _mm512_loadu_si512, _mm512_storeu_si512, _mm512_add_epi8)
+BYTEPS_SUM_KERNEL(SumInt32Avx512, "avx512f", int32_t, 16, __m512i,
+                  _mm512_loadu_si512, _mm512_storeu_si512, _mm512_add_epi32)
+BYTEPS_SUM_KERNEL(SumInt64Avx512, "avx512f", int64_t, 8, __m512i,
+                  _mm512_loadu_si512, _mm512_storeu_si512, _mm512_add_epi64)
+
+#undef BYTEPS_SUM_KERNEL
+
+// float16 is added in float32 and rounded to nearest even. It only needs
+// AVX and F16C, so it also serves the CPUs that have them without AVX2.
+__attribute__((target("avx,f16c"))) void SumFloat16F16c(void* out,
+                                                        const void* a,
+                                                        const void* b,
+                                                        size_t n) {
+  auto o = reinterpret_cast<unsigned short*>(out);
+  auto x = reinterpret_cast<const unsigned short*>(a);
+  auto y = reinterpret_cast<const unsigned short*>(b);
+  size_t i = 0;
+  for (; i + 8 <= n; i += 8) {
+    __m256 x_m256 = _mm256_cvtph_ps(_mm_loadu_si128((const __m128i*)(x + i)));
+    __m256 y_m256 = _mm256_cvtph_ps(_mm_loadu_si128((const __m128i*)(y + i)));
+    __m128i o_m128i = _mm256_cvtps_ph(_mm256_add_ps(x_m256, y_m256), 0);
+    _mm_storeu_si128((__m128i*)(o + i), o_m128i);
+  }
+  SumFloat16Generic(o + i, x + i, y + i, n - i);
+}
+
+__attribute__((target("avx,f16c"))) void Float2HalfF16c(unsigned short* dst,
+                                                        const float* src,
+                                                        size_t n) {
+  size_t i = 0;
+  for (; i + 8 <= n; i += 8) {
+    _mm_storeu_si128((__m128i*)(dst + i),
+                     _mm256_cvtps_ph(_mm256_loadu_ps(src + i), 0));
+  }
+  Float2HalfGeneric(dst + i, src + i, n - i);
+}
+
+__attribute__((target("avx,f16c"))) void Half2FloatF16c(
+    float* dst, const unsigned short* src, size_t n, bool add) {
+  size_t i = 0;
+  for (; i + 8 <= n; i += 8) {
+    __m256 f = _mm256_cvtph_ps(_mm_loadu_si128((const __m128i*)(src + i)));
+    if (add) f = _mm256_add_ps(f, _mm256_loadu_ps(dst + i));
+    _mm256_storeu_ps(dst + i, f);
+  }
+  Half2FloatGeneric(dst + i, src + i, n - i, add);
+}
+
+__attribute__((target("avx512f"))) void SumFloat16Avx512(void* out,
+                                                         const void* a,
+                                                         const void* b,
+                                                         size_t n) {
+  auto o = reinterpret_cast<unsigned short*>(out);
+  auto x = reinterpret_cast<const unsigned short*>(a);
+  auto y = reinterpret_cast<const unsigned short*>(b);
+  size_t i = 0;
+  for (; i + 16 <= n; i += 16) {
+    __m512 x_m512 =
+        _mm512_cvtph_ps(_mm256_loadu_si256((const __m256i*)(x + i)));
+    __m512 y_m512 =
+        _mm512_cvtph_ps(_mm256_loadu_si256((const __m256i*)(y + i)));
+    __m256i o_m256i = _mm512_cvtps_ph(_mm512_add_ps(x_m512, y_m512), 0);
+    _mm256_storeu_si256((__m256i*)(o + i), o_m256i);
+  }
+  SumFloat16F16c(o + i, x + i, y + i, n - i);
+}
+
+// bfloat16 is added in float32 and rounded to nearest even like
+// Float2BFloat16Bits, no instruction set below AVX512-BF16 converts it
+__attribute__((target("avx2"))) void SumBFloat16Avx2(void* out,
+                                                     const void* a,
+                                                     const void* b,
+                                                     size_t n) {
+  auto o = reinterpret_cast<unsigned short*>(out);
+  auto x = reinterpret_cast<const unsigned short*>(a);
+  auto y = reinterpret_cast<const unsigned short*>(b);
+  const __m256i one = _mm256_set1_epi32(1);
+  const __m256i bias = _mm256_set1_epi32(0x7fff);
+  const __m256i quiet = _mm256_set1_epi32(0x400000);
+  size_t i = 0;
+  for (; i + 8 <= n; i += 8) {
+    __m256 x_m256 = _mm256_castsi256_ps(_mm256_slli_epi32(
+        _mm256_cvtepu16_epi32(_mm_loadu_si128((const __m128i*)(x + i))), 16));
+    __m256 y_m256 = _mm256_castsi256_ps(_mm256_slli_epi32(
+        _mm256_cvtepu16_epi32(_mm_loadu_si128((const __m128i*)(y + i))), 16));
+    __m256 sum = _mm256_add_ps(x_m256, y_m256);
+    __m256i bits = _mm256_castps_si256(sum);
+    __m256i lsb = _mm256_and_si256(_mm256_srli_epi32(bits, 16), one);
+    __m256i rounded = _mm256_add_epi32(bits, _mm256_add_epi32(bias, lsb));
+    __m256i nan = _mm256_castps_si256(_mm256_cmp_ps(sum, sum, _CMP_UNORD_Q));
+    rounded = _mm256_blendv_epi8(rounded, _mm256_or_si256(bits, quiet), nan);
+    rounded = _mm256_srli_epi32(rounded, 16);
+    // packs within 128-bit lanes, then moves the halves together
+    __m256i packed = _mm256_permute4x64_epi64(
+        _mm256_packus_epi32(rounded, rounded), 0x08);
+    _mm_storeu_si128((__m128i*)(o + i), _mm256_castsi256_si128(packed));
+  }
+  SumBFloat16Generic(o + i, x + i, y + i, n - i);
+}
+
+__attribute__((target("avx512f"))) void SumBFloat16Avx512(void* out,
+                                                          const void* a,
+                                                          const void* b,
+                                                          size_t n) {
+  auto o = reinterpret_cast<unsigned short*>(out);
+  auto x = reinterpret_cast<const unsigned short*>(a);
+  auto y = reinterpret_cast<const unsigned short*>(b);
+  const __m512i one = _mm512_set1_epi32(1);
+  const __m512i bias = _mm512_set1_epi32(0x7fff);
+  const __m512i quiet = _mm512_set1_epi32(0x400000);
+  size_t i = 0;
+  for (; i + 16 <= n; i += 16) {
+    __m512 x_m512 = _mm512_castsi512_ps(_mm512_slli_epi32(
+        _mm512_cvtepu16_epi32(_mm256_loadu_si256((const __m256i*)(x + i))),
+        16));
+    __m512 y_m512 = _mm512_castsi512_ps(_mm512_slli_epi32(
+        _mm512_cvtepu16_epi32(_mm256_loadu_si256((const __m256i*)(y + i))),
+        16));
+    __m512 sum = _mm512_add_ps(x_m512, y_m512);
+    __m512i bits = _mm512_castps_si512(sum);
+    __m512i lsb = _mm512_and_si512(_mm512_srli_epi32(bits, 16), one);
+    __m512i rounded = _mm512_add_epi32(bits, _mm512_add_epi32(bias, lsb));
+    __mmask16 nan = _mm512_cmp_ps_mask(sum, sum, _CMP_UNORD_Q);
+    rounded = _mm512_mask_or_epi32(rounded, nan, bits, quiet);
+    _mm256_storeu_si256((__m256i*)(o + i),
+                        _mm512_cvtepi32_epi16(_mm512_srli_epi32(rounded, 16)));
+  }
+  SumBFloat16Avx2(o + i, x + i, y + i, n - i);
+}
+
+uint64_t GetXcr0() {
+  uint32_t eax, edx;
+  __asm__ volatile("xgetbv" : "=a"(eax), "=d"(edx) : "c"(0));
+  return ((uint64_t)edx << 32) | eax;
+}
+
+// AVX and F16C usable, which may come without AVX2
+bool DetectF16c() {
+  unsigned int eax, ebx, ecx, edx;
+  if (!__get_cpuid(1, &eax, &ebx, &ecx, &edx)) {
+    return false;
+  }
+  return (ecx & bit_F16C) && (ecx & bit_AVX) && (ecx & bit_OSXSAVE) &&
+         (GetXcr0() & 0x6) == 0x6;
+}
+
+CpuIsa DetectCpuIsa() {
+  unsigned int eax, ebx, ecx, edx;
+  if (!__get_cpuid(1, &eax, &ebx, &ecx, &edx)) {
+    return CPU_ISA_GENERIC;
+  }
+  if (!(edx & bit_SSE2)) {
+    return CPU_ISA_GENERIC;
+  }
+  bool f16c = ecx & bit_F16C;
+  // the OS must also save the AVX registers on context switches
+  if (!(ecx & bit_OSXSAVE) || !(ecx & bit_AVX) || (GetXcr0() & 0x6) != 0x6) {
+    return CPU_ISA_SSE;
+  }
+  if (__get_cpuid_max(0, nullptr) < 7) {
+    return CPU_ISA_SSE;
+  }
+  __cpuid_count(7, 0, eax, ebx, ecx, edx);
+  if (!f16c || !(ebx & bit_AVX2)) {
+    return CPU_ISA_SSE;
+  }
+  // opmask and the upper halves of the ZMM registers
+  if ((ebx & bit_AVX512F) && (ebx & bit_AVX512BW) &&
+      (GetXcr0() & 0xe6) == 0xe6) {
+    return CPU_ISA_AVX512;
+  }
+  return CPU_ISA_AVX2;
+}
+
+const SumKernelTable kSumKernels[CPU_ISA_NUM] = {
+    {SumGeneric<float>, SumGeneric<double>, SumFloat16Generic,
+     SumBFloat16Generic, SumGeneric<int8_t>, SumGeneric<int32_t>,
+     SumGeneric<int64_t>},
+    {SumFloat32Sse, SumFloat64Sse, SumFloat16Generic, SumBFloat16Generic,
+     SumInt8Sse, SumInt32Sse, SumInt64Sse},
+    {SumFloat32Avx2, SumFloat64Avx2, SumFloat16F16c, SumBFloat16Avx2,
+     SumInt8Avx2, SumInt32Avx2, SumInt64Avx2},
+    {SumFloat32Avx512, SumFloat64Avx512, SumFloat16Avx512, SumBFloat16Avx512,
+     SumInt8Avx512, SumInt32Avx512, SumInt64Avx512}};
+
+// the SSE kernels, with float16 converted by F16C
+const SumKernelTable kSseF16cKernels = {
+    SumFloat32Sse, SumFloat64Sse, SumFloat16F16c, SumBFloat16Generic,
+    SumInt8Sse,    SumInt32Sse,   SumInt64Sse};
+
+bool HasF16c() {
+  static bool f16c = DetectF16c();
+  return f16c;
+}
+
+const SumKernelTable& GetSumKernelTable(CpuIsa isa) {
+  if (isa == CPU_ISA_SSE && HasF16c()) {
+    return kSseF16cKernels;
+  }
+  return kSumKernels[isa];
+}
+
+Float2HalfKernel PickFloat2HalfKernel(CpuIsa isa) {
+  return (isa != CPU_ISA_GENERIC && HasF16c()) ? Float2HalfF16c
+                                               : Float2HalfGeneric;
+}
+
+Half2FloatKernel PickHalf2FloatKernel(CpuIsa isa) {
+  return (isa != CPU_ISA_GENERIC && HasF16c()) ? Half2FloatF16c
+                                               : Half2FloatGeneric;
+}
+
+#else
+
+CpuIsa DetectCpuIsa() { return CPU_ISA_GENERIC; }
+
+const SumKernelTable kGenericKernels = {
+    SumGeneric<float>,  SumGeneric<double>,  SumFloat16Generic,
+    SumBFloat16Generic, SumGeneric<int8_t>,  SumGeneric<int32_t>,
+    SumGeneric<int64_t>};
+
+const SumKernelTable kSumKernels[CPU_ISA_NUM] = {
+    kGenericKernels, kGenericKernels, kGenericKernels, kGenericKernels};
+
+const SumKernelTable& GetSumKernelTable(CpuIsa isa) {
+  return kSumKernels[isa];
+}
+
+Float2HalfKernel PickFloat2HalfKernel(CpuIsa) { return Float2HalfGeneric; }
+
+Half2FloatKernel PickHalf2FloatKernel(CpuIsa) { return Half2FloatGeneric; }
+
+#endif  // BYTEPS_X86_KERNELS
+
+const char* kIsaNames[CPU_ISA_NUM] = {"generic", "sse", "avx2", "avx512"};
+
+}  // namespace
+
+CpuIsa GetCpuIsa() {
+  static CpuIsa isa = DetectCpuIsa();
+  return isa;
+}
+
+CpuIsa GetReducerIsa() {
+  static CpuIsa isa = []() {
+    auto detected = GetCpuIsa();
+    auto isa = detected;
+    if (getenv("BYTEPS_REDUCER_ISA")) {
+      std::string name(getenv("BYTEPS_REDUCER_ISA"));
+      int i = 0;
+      while (i < CPU_ISA_NUM && name != kIsaNames[i]) ++i;
+      if (i == CPU_ISA_NUM) {
+        BPS_LOG(WARNING) << "Unknown BYTEPS_REDUCER_ISA " << name
+                         << ", should be generic, sse, avx2 or avx512";
+      } else if (i > detected) {
+        BPS_LOG(WARNING) << "BYTEPS_REDUCER_ISA " << name
+                         << " is not supported by this CPU";
+      } else {
+        isa = static_cast<CpuIsa>(i);
+      }
+    }
+    BPS_LOG(DEBUG) << "CpuReducer uses " << kIsaNames[isa]
+                   << " kernels, the CPU supports up to "
+                   << kIsaNames[detected];
+    return isa;
+  }();
+  return isa;
+}
+
+const char* GetCpuIsaName(CpuIsa isa) {
+  BPS_CHECK(isa >= 0 && isa < CPU_ISA_NUM) << "Invalid CpuIsa: " << isa;
+  return kIsaNames[isa];
+}
+
+SumKernel GetSumKernel(DataType dtype, CpuIsa isa) {
+  BPS_CHECK_LE(isa, GetCpuIsa()) << GetCpuIsaName(isa)
+                                 << " is not supported by this CPU";
+  auto& table = GetSumKernelTable(isa);
+  switch (dtype) {
+    case BYTEPS_FLOAT32:
+      return table.f32;
+    case BYTEPS_FLOAT64:
+      return table.f64;
+    case BYTEPS_FLOAT16:
+      return table.f16;
+    case BYTEPS_BFLOAT16:
+      return table.bf16;
+    case BYTEPS_UINT8:
+    case BYTEPS_INT8:
+      return table.i8;
+    case BYTEPS_INT32:
+      return table.i32;
+    case BYTEPS_INT64:
+      return table.i64;
+    default:
+      BPS_CHECK(0) << "Unsupported data type: " << dtype;
+  }
+  return nullptr;
+}
+
+Float2HalfKernel GetFloat2HalfKernel(CpuIsa isa) {
+  BPS_CHECK_LE(isa, GetCpuIsa()) << GetCpuIsaName(isa)
+                                 << " is not supported by this CPU";
+  return PickFloat2HalfKernel(isa);
+}
+
+Half2FloatKernel GetHalf2FloatKernel(CpuIsa isa) {
+  BPS_CHECK_LE(isa, GetCpuIsa()) << GetCpuIsaName(isa)
+                                 << " is not supported by this CPU";
+  return PickHalf2FloatKernel(isa);
+}
+
+size_t GetSumElementSize(DataType dtype) {
+  switch (dtype) {
+    case BYTEPS_FLOAT32:
+    case BYTEPS_INT32:
+      return 4;
+    case BYTEPS_FLOAT64:
+    case BYTEPS_INT64:
+      return 8;
+    case BYTEPS_FLOAT16:
+    case BYTEPS_BFLOAT16:
+      return 2;
+    case BYTEPS_UINT8:
+    case BYTEPS_INT8:
+      return 1;
+    default:
+      BPS_CHECK(0) << "Unsupported data type: " << dtype;
+  }
+  return 0;
+}
+
+}  // namespace common
+}  // namespace byteps
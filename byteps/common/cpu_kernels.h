@@ -0,0 +1,187 @@
+// Copyright 2019 Bytedance Inc. or its affiliates. All Rights Reserved.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//     http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+// =============================================================================
+
+#ifndef BYTEPS_CPU_KERNELS_H
+#define BYTEPS_CPU_KERNELS_H
+
+#include <stddef.h>
+#include <stdint.h>
+#include <cstring>
+#include "common.h"
+
+namespace byteps {
+namespace common {
+
+// Instruction sets of the summation kernels, in increasing order
+enum CpuIsa {
+  CPU_ISA_GENERIC = 0,
+  CPU_ISA_SSE = 1,     // SSE2, float16 is converted with F16C if the CPU
+                       // has it (and AVX), in software otherwise
+  CPU_ISA_AVX2 = 2,    // AVX2 and F16C
+  CPU_ISA_AVX512 = 3,  // AVX-512 F and BW
+  CPU_ISA_NUM
+};
+
+// out[i] = a[i] + b[i] for n elements, out may alias a or b
+typedef void (*SumKernel)(void* out, const void* a, const void* b, size_t n);
+
+// The best instruction set of this CPU, detected once with CPUID
+CpuIsa GetCpuIsa();
+
+// The instruction set to use: GetCpuIsa(), or BYTEPS_REDUCER_ISA if it is
+// set to a lower one
+CpuIsa GetReducerIsa();
+
+const char* GetCpuIsaName(CpuIsa isa);
+
+// Returns the kernel of dtype for isa, which must not exceed GetCpuIsa()
+SumKernel GetSumKernel(DataType dtype, CpuIsa isa);
+
+// Size in bytes of one element of dtype
+size_t GetSumElementSize(DataType dtype);
+
+// dst[i] = src[i] rounded to float16 (nearest even) for n elements
+typedef void (*Float2HalfKernel)(unsigned short* dst, const float* src,
+                                 size_t n);
+// dst[i] = src[i], or dst[i] += src[i] if add, for n float16 elements
+typedef void (*Half2FloatKernel)(float* dst, const unsigned short* src,
+                                 size_t n, bool add);
+
+// Returns the float16 conversions for isa, with F16C if the CPU has it
+Float2HalfKernel GetFloat2HalfKernel(CpuIsa isa);
+Half2FloatKernel GetHalf2FloatKernel(CpuIsa isa);
+
+inline void HalfBits2Float(const unsigned short* src, float* res) {
+  unsigned h = *src;
+  int sign = ((h >> 15) & 1);
+  int exp = ((h >> 10) & 0x1f);
+  int mantissa = (h & 0x3ff);
+  unsigned f = 0;
+
+  if (exp > 0 && exp < 31) {
+    // normal
+    exp += 112;
+    f = (sign << 31) | (exp << 23) | (mantissa << 13);
+  } else if (exp == 0) {
+    if (mantissa) {
+      // subnormal
+      exp += 113;
+      while ((mantissa & (1 << 10)) == 0) {
+        mantissa <<= 1;
+        exp--;
+      }
+      mantissa &= 0x3ff;
+      f = (sign << 31) | (exp << 23) | (mantissa << 13);
+    } else {
+      // sign-preserving zero
+      f = (sign << 31);
+    }
+  } else if (exp == 31) {
+    if (mantissa) {
+      f = 0x7fffffff;  // not a number
+    } else {
+      f = (0xff << 23) | (sign << 31);  //  inf
+    }
+  }
+
+  memcpy(res, &f, sizeof(f));
+}
+
+inline void Float2HalfBits(const float* src, unsigned short* dest) {
+  // software implementation rounds toward nearest even
+  unsigned s;
+  memcpy(&s, src, sizeof(s));
+  uint16_t sign = uint16_t((s >> 16) & 0x8000);
+  int16_t exp = uint16_t(((s >> 23) & 0xff) - 127);
+  int mantissa = s & 0x7fffff;
+  uint16_t u = 0;
+
+  if ((s & 0x7fffffff) == 0) {
+    // sign-preserving zero
+    *dest = sign;
+    return;
+  }
+
+  if (exp > 15) {
+    if (exp == 128 && mantissa) {
+      // not a number
+      u = 0x7fff;
+    } else {
+      // overflow to infinity
+      u = sign | 0x7c00;
+    }
+    *dest = u;
+    return;
+  }
+
+  int sticky_bit = 0;
+
+  if (exp >= -14) {
+    // normal fp32 to normal fp16
+    exp = uint16_t(exp + uint16_t(15));
+    u = uint16_t(((exp & 0x1f) << 10));
+    u = uint16_t(u | (mantissa >> 13));
+  } else {
+    // normal single-precision to subnormal half_t-precision representation
+    int rshift = (-14 - exp);
+    if (rshift < 32) {
+      mantissa |= (1 << 23);
+
+      sticky_bit = ((mantissa & ((1 << rshift) - 1)) != 0);
+
+      mantissa = (mantissa >> rshift);
+      u = (uint16_t(mantissa >> 13) & 0x3ff);
+    } else {
+      mantissa = 0;
+      u = 0;
+    }
+  }
+
+  // round to nearest even
+  int round_bit = ((mantissa >> 12) & 1);
+  sticky_bit |= ((mantissa & ((1 << 12) - 1)) != 0);
+
+  if ((round_bit && sticky_bit) || (round_bit && (u & 1))) {
+    u = uint16_t(u + 1);
+  }
+
+  u |= sign;
+
+  *dest = u;
+}
+
+// bfloat16 is the upper half of a float32
+inline void BFloat16Bits2Float(const unsigned short* src, float* res) {
+  unsigned f = (unsigned)*src << 16;
+  memcpy(res, &f, sizeof(f));
+}
+
+inline void Float2BFloat16Bits(const float* src, unsigned short* dest) {
+  unsigned f;
+  memcpy(&f, src, sizeof(f));
+  if ((f & 0x7fffffff) > 0x7f800000) {
+    // not a number, keep it quiet, rounding could turn it into infinity
+    *dest = (unsigned short)((f >> 16) | 0x40);
+    return;
+  }
+  // round to nearest even
+  f += 0x7fff + ((f >> 16) & 1);
+  *dest = (unsigned short)(f >> 16);
+}
+
+}  // namespace common
+}  // namespace byteps
+
+#endif  // BYTEPS_CPU_KERNELS_H
@@ -0,0 +1,148 @@
+// Copyright 2019 Bytedance Inc. or its affiliates. All Rights Reserved.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//     http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+// =============================================================================
+
+#include <cmath>
+#include <cstdlib>
+#include <cstring>
+
+#include "cpu_optimizer.h"
+
+namespace byteps {
+namespace common {
+
+namespace {
+
+float GetFloatEnv(const char* name, float default_val) {
+  return getenv(name) ? atof(getenv(name)) : default_val;
+}
+
+float* AllocState(size_t n) {
+  float* buf = nullptr;
+  BPS_CHECK_EQ(posix_memalign((void**)&buf, 64, n * sizeof(float)), 0);
+  memset(buf, 0, n * sizeof(float));
+  return buf;
+}
+
+}  // namespace
+
+CpuOptimizer::CpuOptimizer(const std::string& type) {
+  if (type == "sgd") {
+    _type = OPTIMIZER_SGD;
+  } else if (type == "adam") {
+    _type = OPTIMIZER_ADAM;
+  } else {
+    BPS_CHECK(0) << "Unsupported optimizer: " << type
+                 << ", should be sgd or adam";
+  }
+  _lr = GetFloatEnv("BYTEPS_SERVER_LEARNING_RATE", 0.01);
+  _momentum = GetFloatEnv("BYTEPS_SERVER_MOMENTUM", 0);
+  _weight_decay = GetFloatEnv("BYTEPS_SERVER_WEIGHT_DECAY", 0);
+  _beta1 = GetFloatEnv("BYTEPS_SERVER_ADAM_BETA1", 0.9);
+  _beta2 = GetFloatEnv("BYTEPS_SERVER_ADAM_BETA2", 0.999);
+  _eps = GetFloatEnv("BYTEPS_SERVER_ADAM_EPS", 1e-8);
+
+  if (getenv("BYTEPS_OMP_THREAD_PER_GPU")) {
+    _num_threads = atoi(getenv("BYTEPS_OMP_THREAD_PER_GPU"));
+  } else {
+    _num_threads = 4;
+  }
+  BPS_LOG(INFO) << "CpuOptimizer " << type << " lr=" << _lr
+                << " momentum=" << _momentum
+                << " weight_decay=" << _weight_decay;
+}
+
+int CpuOptimizer::update(void* weight, const void* grad, size_t len,
+                         OptimizerState* state) {
+  BPS_CHECK_EQ(len % sizeof(float), 0) << len;
+  size_t n = len / sizeof(float);
+  state->step++;
+  switch (_type) {
+    case OPTIMIZER_SGD:
+      return _sgd(reinterpret_cast<float*>(weight),
+                  reinterpret_cast<const float*>(grad), n, state);
+    case OPTIMIZER_ADAM:
+      return _adam(reinterpret_cast<float*>(weight),
+                   reinterpret_cast<const float*>(grad), n, state);
+    default:
+      BPS_CHECK(0) << "Unsupported optimizer: " << _type;
+  }
+  return 0;
+}
+
+void CpuOptimizer::freeState(OptimizerState* state) {
+  if (state->mom) free(state->mom);
+  if (state->var) free(state->var);
+  state->mom = nullptr;
+  state->var = nullptr;
+  state->step = 0;
+}
+
+// Same as torch.optim.SGD without dampening or nesterov
+int CpuOptimizer::_sgd(float* weight, const float* grad, size_t n,
+                       OptimizerState* state) {
+  float lr = _lr;
+  float wd = _weight_decay;
+  if (_momentum == 0) {
+#pragma omp parallel for simd num_threads(_num_threads)
+    for (size_t i = 0; i < n; ++i) {
+      weight[i] -= lr * (grad[i] + wd * weight[i]);
+    }
+    return 0;
+  }
+
+  float mu = _momentum;
+  float* mom = state->mom;
+  if (!mom) {
+    // the first step initializes the buffer with the gradient
+    mom = state->mom = AllocState(n);
+    mu = 0;
+  }
+#pragma omp parallel for simd num_threads(_num_threads)
+  for (size_t i = 0; i < n; ++i) {
+    mom[i] = mu * mom[i] + grad[i] + wd * weight[i];
+    weight[i] -= lr * mom[i];
+  }
+  return 0;
+}
+
+// Same as torch.optim.Adam with L2 weight decay
+int CpuOptimizer::_adam(float* weight, const float* grad, size_t n,
+                        OptimizerState* state) {
+  if (!state->mom) state->mom = AllocState(n);
+  if (!state->var) state->var = AllocState(n);
+  float* m = state->mom;
+  float* v = state->var;
+  float b1 = _beta1;
+  float b2 = _beta2;
+  float eps = _eps;
+  float wd = _weight_decay;
+  double t = (double)state->step;
+  float bias1 = 1.0 - std::pow((double)b1, t);
+  float bias2 = 1.0 - std::pow((double)b2, t);
+  float step_size = _lr / bias1;
+  float bias2_sqrt = std::sqrt(bias2);
+
+#pragma omp parallel for simd num_threads(_num_threads)
+  for (size_t i = 0; i < n; ++i) {
+    float g = grad[i] + wd * weight[i];
+    m[i] = b1 * m[i] + (1 - b1) * g;
+    v[i] = b2 * v[i] + (1 - b2) * g * g;
+    weight[i] -= step_size * m[i] / (std::sqrt(v[i]) / bias2_sqrt + eps);
+  }
+  return 0;
+}
+
+}  // namespace common
+}  // namespace byteps
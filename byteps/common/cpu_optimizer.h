@@ -0,0 +1,72 @@
+// Copyright 2019 Bytedance Inc. or its affiliates. All Rights Reserved.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//     http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+// =============================================================================
+
+#ifndef BYTEPS_CPU_OPTIMIZER_H
+#define BYTEPS_CPU_OPTIMIZER_H
+
+#include <stdint.h>
+#include <string>
+#include "common.h"
+#include "logging.h"
+
+namespace byteps {
+namespace common {
+
+enum OptimizerType { OPTIMIZER_SGD, OPTIMIZER_ADAM };
+
+// Per-tensor optimizer state, allocated at the first update
+struct OptimizerState {
+  int64_t step = 0;
+  // momentum buffer for SGD, first moment for Adam
+  float* mom = nullptr;
+  // second moment for Adam
+  float* var = nullptr;
+};
+
+// Applies optimizer updates to fp32 weights on CPU, e.g., on the servers
+// when BYTEPS_SERVER_OPTIMIZER is set. Hyper-parameters are read from env.
+class CpuOptimizer {
+ public:
+  CpuOptimizer(const std::string& type);
+  ~CpuOptimizer() {
+    BPS_LOG(DEBUG) << "Clear CpuOptimizer";
+  }
+
+  // weight -= f(grad, state), both buffers have len bytes of fp32
+  int update(void* weight, const void* grad, size_t len,
+             OptimizerState* state);
+
+  void freeState(OptimizerState* state);
+
+  OptimizerType getType() { return _type; }
+
+ private:
+  int _sgd(float* weight, const float* grad, size_t n, OptimizerState* state);
+  int _adam(float* weight, const float* grad, size_t n, OptimizerState* state);
+
+  OptimizerType _type;
+  float _lr;
+  float _momentum;
+  float _weight_decay;
+  float _beta1;
+  float _beta2;
+  float _eps;
+  int _num_threads;
+};
+
+}  // namespace common
+}  // namespace byteps
+
+#endif  // BYTEPS_CPU_OPTIMIZER_H
@@ -17,11 +17,101 @@
 #include "global.h"
 #endif
 
+#ifdef __linux__
+#include <pthread.h>
+#include <sched.h>
+#endif
+
+#include <algorithm>
+#include <cmath>
+#include <sstream>
+#include <vector>
+
 #include "cpu_reducer.h"
 
 namespace byteps {
 namespace common {
 
+ReducerThreadPool::ReducerThreadPool(int num_threads,
+                                     const std::vector<int>& cores) {
+  for (int i = 0; i + 1 < num_threads; ++i) {
+    _workers.emplace_back(&ReducerThreadPool::WorkerLoop, this);
+    if (cores.empty()) continue;
+#ifdef __linux__
+    int core = cores[i % cores.size()];
+    cpu_set_t cpuset;
+    CPU_ZERO(&cpuset);
+    CPU_SET(core, &cpuset);
+    if (pthread_setaffinity_np(_workers.back().native_handle(),
+                               sizeof(cpuset), &cpuset)) {
+      BPS_LOG(WARNING) << "Failed to pin reducer thread to core " << core;
+    }
+#else
+    BPS_LOG(WARNING) << "Pinning reducer threads is only supported on Linux";
+#endif
+  }
+}
+
+ReducerThreadPool::~ReducerThreadPool() {
+  {
+    std::lock_guard<std::mutex> lk(_mu);
+    _stop = true;
+  }
+  _start_cv.notify_all();
+  for (auto& t : _workers) {
+    t.join();
+  }
+}
+
+void ReducerThreadPool::ParallelFor(
+    size_t n, size_t chunk, const std::function<void(size_t, size_t)>& fn) {
+  std::unique_lock<std::mutex> run(_run_mu, std::try_to_lock);
+  if (_workers.empty() || !run.owns_lock() || n <= chunk) {
+    fn(0, n);
+    return;
+  }
+  {
+    std::lock_guard<std::mutex> lk(_mu);
+    _fn = &fn;
+    _n = n;
+    _chunk = chunk;
+    _next = 0;
+    _open = true;
+    ++_round;
+  }
+  _start_cv.notify_all();
+  RunChunks();
+  // workers that have not woken up by now are not waited for
+  std::unique_lock<std::mutex> lk(_mu);
+  _open = false;
+  _done_cv.wait(lk, [this] { return _active == 0; });
+  _fn = nullptr;
+}
+
+void ReducerThreadPool::RunChunks() {
+  while (true) {
+    size_t begin = _next.fetch_add(_chunk);
+    if (begin >= _n) return;
+    (*_fn)(begin, std::min(begin + _chunk, _n));
+  }
+}
+
+void ReducerThreadPool::WorkerLoop() {
+  uint64_t round = 0;
+  while (true) {
+    {
+      std::unique_lock<std::mutex> lk(_mu);
+      _start_cv.wait(lk, [&] { return _stop || (_open && _round != round); });
+      if (_stop) return;
+      round = _round;
+      ++_active;
+    }
+    RunChunks();
+    std::lock_guard<std::mutex> lk(_mu);
+    if (--_active == 0) _done_cv.notify_one();
+  }
+}
+
 CpuReducer::CpuReducer(std::shared_ptr<BytePSComm> comm) {
 
 #ifndef BYTEPS_BUILDING_SERVER
@@ -44,9 +134,43 @@ CpuReducer::CpuReducer(std::shared_ptr<BytePSComm> comm) {
   } else {
     _num_threads = 4;
   }
+  _isa = GetReducerIsa();
+
+  if (getenv("BYTEPS_REDUCER_PARALLEL_BYTES")) {
+    _min_chunk_bytes = strtoull(getenv("BYTEPS_REDUCER_PARALLEL_BYTES"),
+                                nullptr, 10);
+  } else {
+    _min_chunk_bytes = 65536;
+  }
+  _min_chunk_bytes = std::max(_min_chunk_bytes, (size_t)64);
+  if (_num_threads > 1) {
+    std::vector<int> cores;
+    if (getenv("BYTEPS_REDUCER_CORES")) {
+      std::stringstream ss(getenv("BYTEPS_REDUCER_CORES"));
+      std::string core;
+      while (std::getline(ss, core, ',')) {
+        if (!core.empty()) cores.push_back(atoi(core.c_str()));
+      }
+    }
+    _pool.reset(new ReducerThreadPool(_num_threads, cores));
+  }
   return;
 }
 
+void CpuReducer::_parallel_for(size_t n, size_t size,
+                               const std::function<void(size_t, size_t)>& fn) {
+  if (!_pool || n * size <= _min_chunk_bytes) {
+    fn(0, n);
+    return;
+  }
+  // a few chunks per thread to even out the load, but never smaller than
+  // _min_chunk_bytes, and starting at cache line boundaries of the buffers
+  size_t bytes = std::max(_min_chunk_bytes, n * size / (4 * _num_threads));
+  size_t align = std::max((size_t)1, 64 / size);
+  size_t chunk = (bytes / size + align - 1) / align * align;
+  _pool->ParallelFor(n, std::max((size_t)1, chunk), fn);
+}
+
 #ifndef BYTEPS_BUILDING_SERVER
 bool CpuReducer::isRoot() {
   if (!_comm) {
@@ -57,166 +181,237 @@ bool CpuReducer::isRoot() {
 #endif
 
 int CpuReducer::sum(void* dst, void* src, size_t len, DataType dtype) {
-  switch (dtype) {
-    case BYTEPS_FLOAT32:
-      return _sum(reinterpret_cast<float*>(dst), reinterpret_cast<float*>(src),
-                  len);
-    case BYTEPS_FLOAT64:
-      return _sum(reinterpret_cast<double*>(dst),
-                  reinterpret_cast<double*>(src), len);
-    case BYTEPS_FLOAT16:
-      return _sum_float16(dst, src, len);
-    case BYTEPS_UINT8:
-      return _sum(reinterpret_cast<uint8_t*>(dst),
-                  reinterpret_cast<uint8_t*>(src), len);
-    case BYTEPS_INT32:
-      return _sum(reinterpret_cast<int32_t*>(dst),
-                  reinterpret_cast<int32_t*>(src), len);
-    case BYTEPS_INT8:
-      return _sum(reinterpret_cast<int8_t*>(dst),
-                  reinterpret_cast<int8_t*>(src), len);
-    case BYTEPS_INT64:
-      return _sum(reinterpret_cast<int64_t*>(dst),
-                  reinterpret_cast<int64_t*>(src), len);
-    default:
-      BPS_CHECK(0) << "Unsupported data type: " << dtype;
-  }
-  return 0;
-}  
+  return _sum(dst, dst, src, len, dtype);
+}
+
+int CpuReducer::sum(void* dst, void* src1, void* src2, size_t len,
+                    DataType dtype) {
+  return _sum(dst, src1, src2, len, dtype);
+}
 
-template <typename T>
-int CpuReducer::_sum(T* dst, T* src, size_t len) {
-#pragma omp parallel for simd num_threads(_num_threads)
-  for (size_t i = 0; i < len / (size_t)sizeof(T); ++i) {
-    dst[i] = dst[i] + src[i];
+int CpuReducer::sum(void* dst, void** srcs, size_t num_srcs, size_t len,
+                    DataType dtype) {
+  BPS_CHECK_GE(num_srcs, 1);
+  if (num_srcs == 1) {
+    return (dst == srcs[0]) ? 0 : copy(dst, srcs[0], len);
   }
+  auto kernel = GetSumKernel(dtype, _isa);
+  size_t size = GetSumElementSize(dtype);
+  size_t n = len / size;
+  // small enough that a block of dst stays in L1 while the sources stream
+  size_t block = 8192 / size;
+  size_t num_blocks = (n + block - 1) / block;
+  auto out = reinterpret_cast<char*>(dst);
+  _parallel_for(num_blocks, block * size, [&](size_t begin, size_t end) {
+    for (size_t b = begin; b < end; ++b) {
+      size_t offset = b * block * size;
+      size_t count = std::min(block, n - b * block);
+      kernel(out + offset, reinterpret_cast<char*>(srcs[0]) + offset,
+             reinterpret_cast<char*>(srcs[1]) + offset, count);
+      for (size_t k = 2; k < num_srcs; ++k) {
+        kernel(out + offset, out + offset,
+               reinterpret_cast<char*>(srcs[k]) + offset, count);
+      }
+    }
+  });
   return 0;
 }
 
-int CpuReducer::_sum_float16(void* dst, void* src, size_t len) {
-  // cast src and dst to your float16 type
-  auto in = (unsigned short*)src;
-  auto inout = (unsigned short*)dst;
-  len = len / (size_t)2;
-
-#if __AVX__ && __F16C__
-  if (is_avx_and_f16c()) {
-#pragma omp parallel for simd num_threads(_num_threads)
-    for (size_t i = 0; i < (size_t)(len / 8) * 8; i += 8) {
-      // convert in & inout to m256
-      __m256 in_m256 = _mm256_cvtph_ps(_mm_loadu_si128((__m128i*)(in + i)));
-      __m256 inout_m256 =
-          _mm256_cvtph_ps(_mm_loadu_si128((__m128i*)(inout + i)));
+int CpuReducer::_sum(void* dst, const void* src1, const void* src2,
+                     size_t len, DataType dtype) {
+  auto kernel = GetSumKernel(dtype, _isa);
+  size_t size = GetSumElementSize(dtype);
+  size_t n = len / size;
+  if (!n) return 0;
+  auto out = reinterpret_cast<char*>(dst);
+  auto in1 = reinterpret_cast<const char*>(src1);
+  auto in2 = reinterpret_cast<const char*>(src2);
+  _parallel_for(n, size, [&](size_t begin, size_t end) {
+    kernel(out + begin * size, in1 + begin * size, in2 + begin * size,
+           end - begin);
+  });
+  return 0;
+}
 
-      // add them together to new_inout_m256
-      __m256 new_inout_m256 = _mm256_add_ps(in_m256, inout_m256);
+int CpuReducer::copy(void* dst, void* src, size_t len) {
+  auto in = reinterpret_cast<char*>(src);
+  auto out = reinterpret_cast<char*>(dst);
+  _parallel_for(len, 1, [&](size_t begin, size_t end) {
+    std::memcpy(out + begin, in + begin, end - begin);
+  });
+  return 0;
+}
 
-      // convert back and store in inout
-      __m128i new_inout_m128i = _mm256_cvtps_ph(new_inout_m256, 0);
-      _mm_storeu_si128((__m128i*)(inout + i), new_inout_m128i);
+int CpuReducer::sum_rows(void* dst, const uint32_t* rows, void* src,
+                         size_t num_rows, size_t row_len, DataType dtype) {
+  auto kernel = GetSumKernel(dtype, _isa);
+  size_t row_count = row_len / GetSumElementSize(dtype);
+  auto out = reinterpret_cast<char*>(dst);
+  auto in = reinterpret_cast<char*>(src);
+  // rows are unique, so they can be summed in parallel
+  _parallel_for(num_rows, row_len, [&](size_t begin, size_t end) {
+    for (size_t i = begin; i < end; ++i) {
+      auto row = out + (size_t)rows[i] * row_len;
+      kernel(row, row, in + i * row_len, row_count);
     }
-  }
-#endif
-  for (size_t i = (len / 8) * 8; i < (size_t)len; ++i) {
-    float in_float;
-    float inout_float;
-    HalfBits2Float(in + i, &in_float);
-    HalfBits2Float(inout + i, &inout_float);
-    inout_float += in_float;
-    Float2HalfBits(&inout_float, inout + i);
-  }
-
+  });
   return 0;
 }
 
-int CpuReducer::sum(void* dst, void* src1, void* src2, size_t len,
-                    DataType dtype) {
-  switch (dtype) {
-    case BYTEPS_FLOAT32:
-      return _sum(reinterpret_cast<float*>(dst), reinterpret_cast<float*>(src1),
-                  reinterpret_cast<float*>(src2), len);
-    case BYTEPS_FLOAT64:
-      return _sum(reinterpret_cast<double*>(dst),
-                  reinterpret_cast<double*>(src1),
-                  reinterpret_cast<double*>(src2), len);
-    case BYTEPS_FLOAT16:
-      return _sum_float16(dst, src1, src2, len);
-    case BYTEPS_UINT8:
-      return _sum(reinterpret_cast<uint8_t*>(dst),
-                  reinterpret_cast<uint8_t*>(src1),
-                  reinterpret_cast<uint8_t*>(src2), len);
-    case BYTEPS_INT32:
-      return _sum(reinterpret_cast<int32_t*>(dst),
-                  reinterpret_cast<int32_t*>(src1),
-                  reinterpret_cast<int32_t*>(src2), len);
-    case BYTEPS_INT8:
-      return _sum(reinterpret_cast<int8_t*>(dst),
-                  reinterpret_cast<int8_t*>(src1),
-                  reinterpret_cast<int8_t*>(src2), len);
-    case BYTEPS_INT64:
-      return _sum(reinterpret_cast<int64_t*>(dst),
-                  reinterpret_cast<int64_t*>(src1),
-                  reinterpret_cast<int64_t*>(src2), len);
+size_t CpuReducer::GetCompressedLen(int method, size_t count, size_t k) {
+  size_t len = sizeof(CompressHeader);
+  switch (method) {
+    case COMPRESS_FP16:
+      return len + count * sizeof(uint16_t);
+    case COMPRESS_TOPK:
+      return len + std::min(k, count) * (sizeof(uint32_t) + sizeof(float));
+    case COMPRESS_ONEBIT:
+      return len + (count + 7) / 8;
     default:
-      BPS_CHECK(0) << "Unsupported data type: " << dtype;
+      BPS_CHECK(0) << "Unsupported compress method: " << method;
   }
   return 0;
 }
 
-template <typename T>
-int CpuReducer::_sum(T* dst, T* src1, T* src2, size_t len) {
-#pragma omp parallel for simd num_threads(_num_threads)
-  for (size_t i = 0; i < len / (size_t)sizeof(T); ++i) {
-    dst[i] = src1[i] + src2[i];
+size_t CpuReducer::compress(void* dst, void* src, size_t len, int method,
+                            size_t k) {
+  BPS_CHECK_EQ(len % sizeof(float), 0) << len;
+  size_t count = len / sizeof(float);
+  BPS_CHECK_LE(count, (size_t)UINT32_MAX) << len;
+  auto header = reinterpret_cast<CompressHeader*>(dst);
+  auto data = reinterpret_cast<char*>(dst) + sizeof(CompressHeader);
+  auto in = reinterpret_cast<float*>(src);
+  header->method = method;
+  header->count = count;
+  header->k = 0;
+  header->scale = 0;
+
+  switch (method) {
+    case COMPRESS_FP16: {
+      auto out = reinterpret_cast<unsigned short*>(data);
+      auto kernel = GetFloat2HalfKernel(_isa);
+      _parallel_for(count, sizeof(float), [&](size_t begin, size_t end) {
+        kernel(out + begin, in + begin, end - begin);
+      });
+      break;
+    }
+    case COMPRESS_TOPK:
+      header->k = _compress_topk(in, count, k, data);
+      break;
+    case COMPRESS_ONEBIT:
+      _compress_onebit(in, count, data, header);
+      break;
+    default:
+      BPS_CHECK(0) << "Unsupported compress method: " << method;
   }
-  return 0;
+  return GetCompressedLen(method, count, header->k);
 }
 
-int CpuReducer::_sum_float16(void* dst, void* src1, void* src2, size_t len) {
-  // cast src and dst to your float16 type
-  auto in1 = (unsigned short*)src1;
-  auto in2 = (unsigned short*)src2;
-  auto out = (unsigned short*)dst;
-  len = len / (size_t)2;
-
-#if __AVX__ && __F16C__
-  if (is_avx_and_f16c()) {
-#pragma omp parallel for simd num_threads(_num_threads)
-    for (size_t i = 0; i < (size_t)(len / 8) * 8; i += 8) {
-      // convert in1 & in2 to m256
-      __m256 in_m256 = _mm256_cvtph_ps(_mm_loadu_si128((__m128i*)(in1 + i)));
-      __m256 inout_m256 = _mm256_cvtph_ps(_mm_loadu_si128((__m128i*)(in2 + i)));
+size_t CpuReducer::_compress_topk(float* src, size_t count, size_t k,
+                                  char* dst) {
+  k = std::min(k, count);
+  // reuse the index buffer, this runs once per partition per step
+  static thread_local std::vector<uint32_t> index;
+  index.resize(count);
+  for (size_t i = 0; i < count; ++i) {
+    index[i] = i;
+  }
+  std::nth_element(index.begin(), index.begin() + k, index.end(),
+                   [src](uint32_t a, uint32_t b) {
+                     return std::fabs(src[a]) > std::fabs(src[b]);
+                   });
+  auto out_idx = reinterpret_cast<uint32_t*>(dst);
+  auto out_val = reinterpret_cast<float*>(dst + k * sizeof(uint32_t));
+  for (size_t i = 0; i < k; ++i) {
+    out_idx[i] = index[i];
+    out_val[i] = src[index[i]];
+  }
+  return k;
+}
 
-      // add them together to new_inout_m256
-      __m256 new_inout_m256 = _mm256_add_ps(in_m256, inout_m256);
+size_t CpuReducer::_compress_onebit(float* src, size_t count, char* dst,
+                                    CompressHeader* header) {
+  // partial sums of fixed blocks, so that the scale does not depend on how
+  // the loop is split
+  size_t block = 4096;
+  size_t num_blocks = (count + block - 1) / block;
+  static thread_local std::vector<float> partial_buf;
+  // the pool threads must see the caller's buffer, not their own
+  auto& partial = partial_buf;
+  partial.assign(num_blocks, 0);
+  _parallel_for(num_blocks, block * sizeof(float),
+                [&](size_t begin, size_t end) {
+                  for (size_t b = begin; b < end; ++b) {
+                    float s = 0;
+                    size_t last = std::min(count, (b + 1) * block);
+                    for (size_t i = b * block; i < last; ++i) {
+                      s += std::fabs(src[i]);
+                    }
+                    partial[b] = s;
+                  }
+                });
+  float sum = 0;
+  for (auto s : partial) {
+    sum += s;
+  }
+  header->scale = count ? sum / count : 0;
 
-      // convert back and store in out
-      __m128i new_inout_m128i = _mm256_cvtps_ph(new_inout_m256, 0);
-      _mm_storeu_si128((__m128i*)(out + i), new_inout_m128i);
+  auto out = reinterpret_cast<uint8_t*>(dst);
+  size_t nbytes = (count + 7) / 8;
+  _parallel_for(nbytes, 8 * sizeof(float), [&](size_t begin, size_t end) {
+    for (size_t b = begin; b < end; ++b) {
+      uint8_t bits = 0;
+      for (size_t j = 0; j < 8 && b * 8 + j < count; ++j) {
+        if (src[b * 8 + j] >= 0) bits |= (1 << j);
+      }
+      out[b] = bits;
     }
-  }
-#endif
-  for (size_t i = (size_t)(len / 8) * 8; i < (size_t)len; ++i) {
-    float in1_float;
-    float in2_float;
-    float out_float;
-    HalfBits2Float(in1 + i, &in1_float);
-    HalfBits2Float(in2 + i, &in2_float);
-    out_float = in1_float + in2_float;
-    Float2HalfBits(&out_float, out + i);
-  }
-  return 0;
+  });
+  return nbytes;
 }
 
-int CpuReducer::copy(void* dst, void* src, size_t len) {
-  auto in = (float*)src;
-  auto out = (float*)dst;
-#pragma omp parallel for simd num_threads(_num_threads)
-  for (size_t i = 0; i < len / 4; ++i) {
-    out[i] = in[i];
-  }
-  if (len % 4) {
-    std::memcpy(out + len / 4, in + len / 4, len % 4);
+int CpuReducer::decompress(void* dst, void* src, size_t len, bool add) {
+  BPS_CHECK_GE(len, sizeof(CompressHeader)) << len;
+  auto header = reinterpret_cast<CompressHeader*>(src);
+  auto data = reinterpret_cast<char*>(src) + sizeof(CompressHeader);
+  auto out = reinterpret_cast<float*>(dst);
+  size_t count = header->count;
+  BPS_CHECK_EQ(len, GetCompressedLen(header->method, count, header->k))
+      << "corrupted payload of method " << header->method;
+
+  switch (header->method) {
+    case COMPRESS_FP16: {
+      auto in = reinterpret_cast<unsigned short*>(data);
+      auto kernel = GetHalf2FloatKernel(_isa);
+      _parallel_for(count, sizeof(float), [&](size_t begin, size_t end) {
+        kernel(out + begin, in + begin, end - begin, add);
+      });
+      break;
+    }
+    case COMPRESS_TOPK: {
+      size_t k = header->k;
+      auto in_idx = reinterpret_cast<uint32_t*>(data);
+      auto in_val = reinterpret_cast<float*>(data + k * sizeof(uint32_t));
+      if (!add) std::memset(out, 0, count * sizeof(float));
+      for (size_t i = 0; i < k; ++i) {
+        BPS_CHECK_LT(in_idx[i], count);
+        out[in_idx[i]] += in_val[i];
+      }
+      break;
+    }
+    case COMPRESS_ONEBIT: {
+      auto in = reinterpret_cast<uint8_t*>(data);
+      float scale = header->scale;
+      _parallel_for(count, sizeof(float), [&](size_t begin, size_t end) {
+        for (size_t i = begin; i < end; ++i) {
+          float v = ((in[i / 8] >> (i % 8)) & 1) ? scale : -scale;
+          out[i] = add ? out[i] + v : v;
+        }
+      });
+      break;
+    }
+    default:
+      BPS_CHECK(0) << "Unsupported compress method: " << header->method;
   }
   return 0;
 }
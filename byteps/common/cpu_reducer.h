@@ -16,14 +16,14 @@
 #ifndef BYTEPS_CPU_REDUCER_H
 #define BYTEPS_CPU_REDUCER_H
 
-#if __AVX__ && __F16C__
-#include <cpuid.h>
-#include <immintrin.h>
-#endif
-
-#include <memory>
+#include <condition_variable>
 #include <cstring>
+#include <functional>
+#include <memory>
+#include <thread>
+#include <vector>
 #include "common.h"
+#include "cpu_kernels.h"
 #include "logging.h"
 
 #ifndef BYTEPS_BUILDING_SERVER
@@ -37,6 +37,61 @@ typedef void BytePSComm;
 namespace byteps {
 namespace common {
 
+// Wire formats of kCompressedPushPull, only float32 tensors are compressed
+enum CompressMethod {
+  COMPRESS_NONE = 0,
+  COMPRESS_FP16 = 1,    // float16 values
+  COMPRESS_TOPK = 2,    // k uint32 indices followed by k float32 values
+  COMPRESS_ONEBIT = 3   // one sign bit per value, scaled by mean(|x|)
+};
+
+// Every compressed payload starts with this header
+struct CompressHeader {
+  uint32_t method;
+  // number of float32 values of the uncompressed tensor
+  uint32_t count;
+  // number of values kept by top-k
+  uint32_t k;
+  // scale of onebit
+  float scale;
+};
+
+// Persistent workers that run the loops of a CpuReducer, instead of an
+// OpenMP team per call. The calling thread works on the loop too, and runs
+// it alone if another thread, e.g., another server engine thread, is using
+// the pool, so that the cores are not oversubscribed.
+class ReducerThreadPool {
+ public:
+  // num_threads includes the caller, the workers are pinned to cores
+  // round-robin unless cores is empty
+  ReducerThreadPool(int num_threads, const std::vector<int>& cores);
+  ~ReducerThreadPool();
+
+  // Calls fn(begin, end) on chunks of [0, n), returns when all are done
+  void ParallelFor(size_t n, size_t chunk,
+                   const std::function<void(size_t, size_t)>& fn);
+
+ private:
+  void WorkerLoop();
+  void RunChunks();
+
+  std::vector<std::thread> _workers;
+  // held by the thread whose loop is running
+  std::mutex _run_mu;
+  std::mutex _mu;
+  std::condition_variable _start_cv;
+  std::condition_variable _done_cv;
+  // workers only join a loop while it is open
+  uint64_t _round = 0;
+  bool _open = false;
+  int _active = 0;
+  bool _stop = false;
+  const std::function<void(size_t, size_t)>* _fn = nullptr;
+  size_t _n = 0;
+  size_t _chunk = 0;
+  std::atomic<size_t> _next{0};
+};
+
 class CpuReducer {
  public:
   CpuReducer(std::shared_ptr<BytePSComm> comm);
@@ -47,8 +102,29 @@ class CpuReducer {
 
   int sum(void* dst, void* src, size_t len, DataType dtype);
   int sum(void* dst, void* src1, void* src2, size_t len, DataType dtype);
+  // dst = srcs[0] + ... + srcs[num_srcs - 1] in one cache-blocked pass, so
+  // dst is written once instead of once per source. dst may be srcs[0].
+  int sum(void* dst, void** srcs, size_t num_srcs, size_t len,
+          DataType dtype);
   int copy(void* dst, void* src, size_t len);
 
+  // Adds num_rows rows of row_len bytes in src to rows of dst, the row ids
+  // must be unique
+  int sum_rows(void* dst, const uint32_t* rows, void* src, size_t num_rows,
+               size_t row_len, DataType dtype);
+
+  // Compresses len bytes of float32 in src into dst, returns the payload size.
+  // dst must have GetCompressedLen(method, len / 4, k) bytes.
+  size_t compress(void* dst, void* src, size_t len, int method, size_t k);
+  // Decompresses a payload of len bytes into float32 dst, which is
+  // overwritten or, if add is true, accumulated into.
+  int decompress(void* dst, void* src, size_t len, bool add);
+
+  static size_t GetCompressedLen(int method, size_t count, size_t k);
+
+  // Instruction set of the summation kernels
+  CpuIsa getIsa() { return _isa; }
+
 #ifndef BYTEPS_BUILDING_SERVER
   bool isRoot();
   std::shared_ptr<BytePSComm> getComm() { return _comm; }
@@ -60,134 +136,28 @@ class CpuReducer {
   }
 
  private:
-#if __AVX__ && __F16C__
-  // Query CPUID to determine AVX and F16C runtime support.
-  bool is_avx_and_f16c() {
-    static bool initialized = false;
-    static bool result = false;
-    if (!initialized) {
-      unsigned int eax, ebx, ecx, edx;
-      if (__get_cpuid(1, &eax, &ebx, &ecx, &edx)) {
-        result = (ecx & bit_AVX) && (ecx & bit_F16C);
-      }
-      initialized = true;
-    }
-    return result;
-  }
-#endif
-
-  inline void HalfBits2Float(unsigned short* src, float* res) {
-    unsigned h = *src;
-    int sign = ((h >> 15) & 1);
-    int exp = ((h >> 10) & 0x1f);
-    int mantissa = (h & 0x3ff);
-    unsigned f = 0;
-
-    if (exp > 0 && exp < 31) {
-      // normal
-      exp += 112;
-      f = (sign << 31) | (exp << 23) | (mantissa << 13);
-    } else if (exp == 0) {
-      if (mantissa) {
-        // subnormal
-        exp += 113;
-        while ((mantissa & (1 << 10)) == 0) {
-          mantissa <<= 1;
-          exp--;
-        }
-        mantissa &= 0x3ff;
-        f = (sign << 31) | (exp << 23) | (mantissa << 13);
-      } else {
-        // sign-preserving zero
-        f = (sign << 31);
-      }
-    } else if (exp == 31) {
-      if (mantissa) {
-        f = 0x7fffffff;  // not a number
-      } else {
-        f = (0xff << 23) | (sign << 31);  //  inf
-      }
-    }
-
-    *res = *reinterpret_cast<float const*>(&f);
-  }
-
-  inline void Float2HalfBits(float* src, unsigned short* dest) {
-    // software implementation rounds toward nearest even
-    unsigned const& s = *reinterpret_cast<unsigned const*>(src);
-    uint16_t sign = uint16_t((s >> 16) & 0x8000);
-    int16_t exp = uint16_t(((s >> 23) & 0xff) - 127);
-    int mantissa = s & 0x7fffff;
-    uint16_t u = 0;
-
-    if ((s & 0x7fffffff) == 0) {
-      // sign-preserving zero
-      *dest = sign;
-      return;
-    }
-
-    if (exp > 15) {
-      if (exp == 128 && mantissa) {
-        // not a number
-        u = 0x7fff;
-      } else {
-        // overflow to infinity
-        u = sign | 0x7c00;
-      }
-      *dest = u;
-      return;
-    }
-
-    int sticky_bit = 0;
-
-    if (exp >= -14) {
-      // normal fp32 to normal fp16
-      exp = uint16_t(exp + uint16_t(15));
-      u = uint16_t(((exp & 0x1f) << 10));
-      u = uint16_t(u | (mantissa >> 13));
-    } else {
-      // normal single-precision to subnormal half_t-precision representation
-      int rshift = (-14 - exp);
-      if (rshift < 32) {
-        mantissa |= (1 << 23);
-
-        sticky_bit = ((mantissa & ((1 << rshift) - 1)) != 0);
-
-        mantissa = (mantissa >> rshift);
-        u = (uint16_t(mantissa >> 13) & 0x3ff);
-      } else {
-        mantissa = 0;
-        u = 0;
-      }
-    }
-
-    // round to nearest even
-    int round_bit = ((mantissa >> 12) & 1);
-    sticky_bit |= ((mantissa & ((1 << 12) - 1)) != 0);
-
-    if ((round_bit && sticky_bit) || (round_bit && (u & 1))) {
-      u = uint16_t(u + 1);
-    }
-
-    u |= sign;
-
-    *dest = u;
-  }
-
-  template <typename T>
-  int _sum(T* dst, T* src, size_t len);
+  // Runs fn(begin, end) over n elements of size bytes on the thread pool,
+  // small loops run on the calling thread
+  void _parallel_for(size_t n, size_t size,
+                     const std::function<void(size_t, size_t)>& fn);
 
-  template <typename T>
-  int _sum(T* dst, T* src1, T* src2, size_t len);
+  // dst = src1 + src2
+  int _sum(void* dst, const void* src1, const void* src2, size_t len,
+           DataType dtype);
 
-  int _sum_float16(void* dst, void* src, size_t len);
-  int _sum_float16(void* dst, void* src1, void* src2, size_t len);
+  size_t _compress_topk(float* src, size_t count, size_t k, char* dst);
+  size_t _compress_onebit(float* src, size_t count, char* dst,
+                          CompressHeader* header);
 
   float _convert_half_to_full_precision(uint16_t h);
   uint16_t _convert_full_to_half_precision(float f);
 
   std::shared_ptr<BytePSComm> _comm;
   int _num_threads;
+  CpuIsa _isa;
+  std::unique_ptr<ReducerThreadPool> _pool;
+  // loops of fewer bytes are not split
+  size_t _min_chunk_bytes;
 };
 
 }  // namespace common
@@ -15,6 +15,8 @@
 
 #include "global.h"
 #include <malloc.h>
+#include <algorithm>
+#include <fstream>
 #include <numa.h>
 #include <unistd.h>
 
@@ -37,6 +39,13 @@ bool BytePSGlobal::_is_root_device;
 bool BytePSGlobal::_is_distributed_job;
 bool BytePSGlobal::_is_cross_pcie_switch;
 uint32_t BytePSGlobal::_partition_bytes = 4096000;
+uint32_t BytePSGlobal::_fusion_bytes = 0;
+uint32_t BytePSGlobal::_ps_batch_size = 1;
+bool BytePSGlobal::_push_pull_rpc = false;
+std::unordered_map<uint64_t, PSKV> BytePSGlobal::_compressed_ps_kv;
+int BytePSGlobal::_compress_method = COMPRESS_NONE;
+double BytePSGlobal::_compress_topk_ratio = 0.01;
+bool BytePSGlobal::_compress_pull = false;
 
 int BytePSGlobal::_is_trace = 0;
 int BytePSGlobal::_start_step = 10;
@@ -50,6 +59,8 @@ std::shared_ptr<BytePSSharedMemory> BytePSGlobal::_shm_obj;
 std::unordered_map<uint64_t, PSKV> BytePSGlobal::ps_kv_;
 std::vector<unsigned long> BytePSGlobal::_server_accumulated_len;
 std::string BytePSGlobal::_hash_knob;
+bool BytePSGlobal::_placement_planned = false;
+std::unordered_map<uint64_t, int> BytePSGlobal::_key_to_server;
 
 volatile BytePSScheduledQueue* BytePSGlobal::_queues[QueueNum] = {NULL};
 std::mutex BytePSGlobal::_queues_mutex[QueueNum];
@@ -70,6 +81,7 @@ cudaStream_t* BytePSGlobal::_copy_device2host_stream;
 cudaStream_t* BytePSGlobal::_copy_host2device_stream;
 std::shared_ptr<NcclManager> BytePSGlobal::_nccl_manager;
 std::shared_ptr<CpuReducer> BytePSGlobal::_cpu_reducer;
+std::shared_ptr<InitThreadPool> BytePSGlobal::_init_pool;
 
 std::hash<std::string> BytePSGlobal::_built_in_hash_fn;
 unsigned int BytePSGlobal::_built_in_hash_coefficient;
@@ -84,7 +96,12 @@ BytePSScheduledQueue* BytePSGlobal::GetScheduledQueue(QueueType queueType) {
 void BytePSGlobal::CreateScheduledQueue(QueueType queueType) {
   std::lock_guard<std::mutex> lock(_queues_mutex[queueType]);
   if (!_queues[queueType]) {
-    _queues[queueType] = new BytePSScheduledQueue(queueType);
+    // the root NCCL loop takes tasks from both REDUCE and BROADCAST
+    std::shared_ptr<TaskNotifier> notifier;
+    if (queueType == BROADCAST && _queues[REDUCE]) {
+      notifier = GetScheduledQueue(REDUCE)->getNotifier();
+    }
+    _queues[queueType] = new BytePSScheduledQueue(queueType, notifier);
   }
   return;
 }
@@ -118,6 +135,59 @@ void BytePSGlobal::Init() {
   // alignment for Reduce-Scatter/All-Gather
   _partition_bytes = AlignTo(_partition_bytes, (8 * _local_size));
 
+  // a fusion group is sent as one key, so it is not larger than a partition
+  if (getenv("BYTEPS_FUSION_BYTES")) {
+    _fusion_bytes = atoi(getenv("BYTEPS_FUSION_BYTES"));
+  }
+  _fusion_bytes = std::min(_fusion_bytes, _partition_bytes);
+  if (_fusion_bytes) {
+    BPS_LOG(DEBUG) << "Fusion bound set to " << _fusion_bytes << " bytes";
+  }
+
+  // max number of ready partitions sent to a server in one request
+  if (getenv("BYTEPS_PS_BATCH_SIZE")) {
+    _ps_batch_size = atoi(getenv("BYTEPS_PS_BATCH_SIZE"));
+  }
+  _ps_batch_size = std::max(_ps_batch_size, (uint32_t)1);
+
+  // the servers answer a push with the merged data, so PUSH and PULL are
+  // one stage, only for synchronous training
+  _push_pull_rpc = getenv("BYTEPS_PUSH_PULL_RPC")
+                       ? atoi(getenv("BYTEPS_PUSH_PULL_RPC"))
+                       : false;
+  if (_push_pull_rpc && getenv("BYTEPS_ENABLE_ASYNC") &&
+      atoi(getenv("BYTEPS_ENABLE_ASYNC"))) {
+    BPS_LOG(WARNING) << "BYTEPS_PUSH_PULL_RPC is ignored in async mode";
+    _push_pull_rpc = false;
+  }
+
+  // wire compression for tensors declared as kCompressedPushPull
+  if (getenv("BYTEPS_COMPRESSOR")) {
+    std::string compressor(getenv("BYTEPS_COMPRESSOR"));
+    if (compressor == "fp16") {
+      _compress_method = COMPRESS_FP16;
+    } else if (compressor == "topk") {
+      _compress_method = COMPRESS_TOPK;
+    } else if (compressor == "onebit") {
+      _compress_method = COMPRESS_ONEBIT;
+    } else if (!compressor.empty()) {
+      BPS_CHECK(0) << "Unsupported BYTEPS_COMPRESSOR " << compressor
+                   << ", must be one of [fp16, topk, onebit]";
+    }
+  }
+  if (getenv("BYTEPS_COMPRESSOR_TOPK_RATIO")) {
+    _compress_topk_ratio = atof(getenv("BYTEPS_COMPRESSOR_TOPK_RATIO"));
+  }
+  BPS_CHECK(_compress_topk_ratio > 0 && _compress_topk_ratio <= 1)
+      << "BYTEPS_COMPRESSOR_TOPK_RATIO must be in (0, 1]";
+  _compress_pull = getenv("BYTEPS_COMPRESS_PULL")
+                       ? atoi(getenv("BYTEPS_COMPRESS_PULL"))
+                       : false;
+  if (_compress_method != COMPRESS_NONE) {
+    BPS_LOG(DEBUG) << "Compression method " << _compress_method
+                   << (_compress_pull ? ", also for pull" : "");
+  }
+
   BPS_CHECK(getenv("DMLC_NUM_WORKER")) << "error: env DMLC_NUM_WORKER not set";
 
   _num_worker = atoi(getenv("DMLC_NUM_WORKER"));
@@ -167,8 +237,17 @@ void BytePSGlobal::Init() {
   // Init CPU Reducer
   if (_is_cross_pcie_switch) {
     _cpu_reducer = std::make_shared<CpuReducer>(_basic_comm);
+  } else if (_compress_method != COMPRESS_NONE) {
+    // only used to (de)compress the pushed and pulled data
+    _cpu_reducer = std::make_shared<CpuReducer>(nullptr);
   }
 
+  // Threads that initialize tensors on their first push_pull
+  int init_threads = getenv("BYTEPS_INIT_THREADS")
+                         ? atoi(getenv("BYTEPS_INIT_THREADS"))
+                         : 4;
+  _init_pool = std::make_shared<InitThreadPool>(std::max(init_threads, 1));
+
   // ReadyTable for Push & Pull
   if (_is_root_device) {
     _push_table = new ReadyTable(_local_size - 1, "PUSH");
@@ -264,6 +343,16 @@ void BytePSGlobal::Shutdown() {
   _should_shutdown = true;
   int total_thread_num = _threads.size();
 
+  // wake up the loops that wait for tasks
+  for (size_t i = 0; i < QueueNum; i++) {
+    if (_queues[i]) {
+      GetScheduledQueue(static_cast<QueueType>(i))->getNotifier()->Notify();
+    }
+  }
+  if (_nccl_manager) {
+    _nccl_manager->GetGroupNotifier()->Notify();
+  }
+
   for (size_t i = 0; i < _threads.size(); i++) {
     if (_threads[i]->joinable()) {
       _threads[i]->join();
@@ -282,6 +371,9 @@ void BytePSGlobal::Shutdown() {
     }
   }
 
+  // before the PS, since queued init jobs may still push
+  _init_pool.reset();
+
   if (_ps) {
     ps::Finalize(0, false);
     delete _ps;
@@ -474,6 +566,68 @@ uint64_t BytePSGlobal::Hash_SDBM(uint64_t key) {
   return hash;
 }
 
+// Assigns the partitions of all tensors declared with a size to the
+// servers, largest first, each to the server with the fewest bytes so far.
+// Ties are broken by key and server index, so all workers get the same
+// placement. The caller holds _encode_mutex.
+void BytePSGlobal::PlanPlacement(int num_servers) {
+  std::vector<std::pair<uint64_t, size_t>> parts;  // (key, len)
+  {
+    std::lock_guard<std::mutex> lock(_context_mutex);
+    for (auto& it : _name_to_cxt) {
+      auto& context = it.second;
+      ps::Key key = context.declared_key << 16;
+      for (size_t accumulated = 0; accumulated < context.declared_size;) {
+        size_t len = std::min(context.declared_size - accumulated,
+                              (size_t)_partition_bytes);
+        parts.emplace_back(key++, len);
+        accumulated += len;
+      }
+    }
+  }
+  std::sort(parts.begin(), parts.end(),
+            [](const std::pair<uint64_t, size_t>& a,
+               const std::pair<uint64_t, size_t>& b) {
+              return a.second != b.second ? a.second > b.second
+                                          : a.first < b.first;
+            });
+  std::vector<size_t> load(num_servers, 0);
+  for (auto& part : parts) {
+    auto server = std::min_element(load.begin(), load.end()) - load.begin();
+    load[server] += part.second;
+    _key_to_server[part.first] = server;
+  }
+  _placement_planned = true;
+
+  // export the planned bytes per server
+  const char* load_path = std::getenv("BYTEPS_SERVER_LOAD_PATH");
+  std::ofstream load_file;
+  if (_rank == 0 && load_path != NULL) {
+    load_file.open(load_path);
+  }
+  for (int i = 0; i < num_servers; ++i) {
+    BPS_LOG(DEBUG) << "Server " << i << " is assigned " << load[i]
+                   << " bytes by the balanced placement";
+    if (load_file.is_open()) {
+      load_file << i << ": " << load[i] << std::endl;
+    }
+  }
+  BPS_LOG(DEBUG) << "Balanced placement of " << parts.size()
+                 << " partitions to " << num_servers << " servers";
+}
+
+int BytePSGlobal::GetPlacedServer(uint64_t key, int num_servers) {
+  if (!_placement_planned) {
+    PlanPlacement(num_servers);
+  }
+  auto it = _key_to_server.find(key);
+  if (it != _key_to_server.end()) {
+    return it->second;
+  }
+  // not declared with a size, e.g., fusion groups
+  return Hash_DJB2(key) % num_servers;
+}
+
 PSKV& BytePSGlobal::EncodeDefaultKey(uint64_t key, size_t len) {
   std::lock_guard<std::mutex> lock(_encode_mutex);
   PSKV& pskv = ps_kv_[key];
@@ -494,9 +648,11 @@ PSKV& BytePSGlobal::EncodeDefaultKey(uint64_t key, size_t len) {
       server = Hash_DJB2(key) % num_servers;
     } else if (!_hash_knob.compare(std::string("sdbm"))) {
       server = Hash_SDBM(key) % num_servers;
+    } else if (!_hash_knob.compare(std::string("balanced"))) {
+      server = GetPlacedServer(key, num_servers);
     } else {
       BPS_CHECK(0) << "Unsupported BYTEPS_KEY_HASH_FN, "
-                   << "must be one of [naive, built_in, djb2, sdbm]";
+                   << "must be one of [naive, built_in, djb2, sdbm, balanced]";
     }
     
     _server_accumulated_len[server] += len;
@@ -508,11 +664,34 @@ PSKV& BytePSGlobal::EncodeDefaultKey(uint64_t key, size_t len) {
     pskv.keys.push_back(ps_key);
     pskv.lens.push_back(len);
     pskv.size = len;
+    pskv.server = server;
   }
   BPS_LOG(TRACE) << "key " << key << " is encoded to " << pskv.keys[0];
   return pskv;
 }
 
+PSKV& BytePSGlobal::EncodeCompressedKey(uint64_t key, size_t len,
+                                        size_t compressed_len) {
+  auto& default_pskv = EncodeDefaultKey(key, len);
+  std::lock_guard<std::mutex> lock(_encode_mutex);
+  PSKV& pskv = _compressed_ps_kv[key];
+  if (!pskv.keys.empty()) {
+    BPS_CHECK_EQ(static_cast<size_t>(pskv.size), compressed_len)
+        << "The value size cannot be changed " << compressed_len
+        << ". Key is " << key;
+  } else {
+    pskv.keys.push_back(default_pskv.keys[0]);
+    pskv.lens.push_back(compressed_len);
+    pskv.size = compressed_len;
+  }
+  return pskv;
+}
+
+size_t BytePSGlobal::GetCompressTopK(size_t count) {
+  size_t k = count * _compress_topk_ratio;
+  return k ? k : 1;
+}
+
 uint32_t BytePSGlobal::GetTensorCount() {
   std::lock_guard<std::mutex> lock(_context_mutex);
   return BytePSGlobal::_name_to_cxt.size();
@@ -26,6 +26,7 @@
 #include "common.h"
 #include "communicator.h"
 #include "cpu_reducer.h"
+#include "init_pool.h"
 #include "logging.h"
 #include "nccl_manager.h"
 #include "ps/ps.h"
@@ -40,6 +41,7 @@ struct PSKV {
   ps::SArray<ps::Key> keys;  // n keys
   ps::SArray<int> lens;      // the length of the i-th value
   int size;
+  int server = -1;  // the server of a single-key PSKV
 };
 
 typedef void (*LoopFunction)();
@@ -87,8 +89,19 @@ class BytePSGlobal {
   static std::vector<unsigned long> _server_accumulated_len;
   static std::unordered_map<uint64_t, PSKV> ps_kv_;
   static PSKV& EncodeDefaultKey(uint64_t key, size_t len);
+  // same server as EncodeDefaultKey(key, len), with the compressed length
+  static PSKV& EncodeCompressedKey(uint64_t key, size_t len,
+                                   size_t compressed_len);
+
+  // wire compression of kCompressedPushPull tensors (BYTEPS_COMPRESSOR)
+  static int GetCompressMethod() { return _compress_method; }
+  static size_t GetCompressTopK(size_t count);
+  static bool IsPullCompressed() { return _compress_pull; }
 
   static uint32_t GetPartitionBound() { return _partition_bytes; }
+  static uint32_t GetFusionBound() { return _fusion_bytes; }
+  static uint32_t GetPSBatchSize() { return _ps_batch_size; }
+  static bool IsPushPullRPC() { return _push_pull_rpc; }
 
   static cudaStream_t* GetCopyDevice2HostStream();
   static cudaStream_t* GetCopyHost2DeviceStream();
@@ -104,6 +117,7 @@ class BytePSGlobal {
 
   static std::shared_ptr<NcclManager> GetNccl() { return _nccl_manager; }
   static std::shared_ptr<CpuReducer> GetCpuReducer() { return _cpu_reducer; }
+  static std::shared_ptr<InitThreadPool> GetInitPool() { return _init_pool; }
 
   static bool IsTensorSampled(uint64_t key) { return (key == _sample_key); }
 
@@ -156,6 +170,14 @@ class BytePSGlobal {
   static cudaStream_t* _copy_host2device_stream;
 
   static uint32_t _partition_bytes;
+  static uint32_t _fusion_bytes;
+  static uint32_t _ps_batch_size;
+  static bool _push_pull_rpc;
+
+  static std::unordered_map<uint64_t, PSKV> _compressed_ps_kv;
+  static int _compress_method;
+  static double _compress_topk_ratio;
+  static bool _compress_pull;
 
   // (key, ready_signal_count) pair, only valid for root device
   static ReadyTable* _reduce_table;
@@ -168,6 +190,7 @@ class BytePSGlobal {
 
   static std::shared_ptr<NcclManager> _nccl_manager;
   static std::shared_ptr<CpuReducer> _cpu_reducer;
+  static std::shared_ptr<InitThreadPool> _init_pool;
 
   // for debug sampling
   static uint64_t _sample_key;
@@ -184,6 +207,13 @@ class BytePSGlobal {
   static uint64_t Hash_BuiltIn(uint64_t key);
   static uint64_t Hash_DJB2(uint64_t key);
   static uint64_t Hash_SDBM(uint64_t key);
+
+  // balanced placement (BYTEPS_KEY_HASH_FN=balanced), built from the
+  // declared sizes on the first EncodeDefaultKey()
+  static bool _placement_planned;
+  static std::unordered_map<uint64_t, int> _key_to_server;
+  static void PlanPlacement(int num_servers);
+  static int GetPlacedServer(uint64_t key, int num_servers);
 };
 
 }  // namespace common
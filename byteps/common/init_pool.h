@@ -0,0 +1,87 @@
+// Copyright 2019 Bytedance Inc. or its affiliates. All Rights Reserved.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//     http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+// =============================================================================
+
+#ifndef BYTEPS_INIT_POOL_H
+#define BYTEPS_INIT_POOL_H
+
+#include <condition_variable>
+#include <functional>
+#include <mutex>
+#include <queue>
+#include <thread>
+#include <vector>
+
+namespace byteps {
+namespace common {
+
+// A fixed number of threads that run the steps of first-use tensor
+// initialization in FIFO order. The jobs must not wait for the network:
+// init pushes are a barrier across workers, which may initialize their
+// tensors in different orders, so a job that blocks on one could hold a
+// thread needed by the tensor the other workers wait for.
+class InitThreadPool {
+ public:
+  explicit InitThreadPool(int num_threads) {
+    for (int i = 0; i < num_threads; ++i) {
+      _workers.emplace_back(&InitThreadPool::WorkerLoop, this);
+    }
+  }
+
+  // Runs the queued jobs before joining the threads
+  ~InitThreadPool() {
+    {
+      std::lock_guard<std::mutex> lock(_mutex);
+      _stop = true;
+    }
+    _cv.notify_all();
+    for (auto& t : _workers) {
+      t.join();
+    }
+  }
+
+  void Submit(std::function<void()> job) {
+    {
+      std::lock_guard<std::mutex> lock(_mutex);
+      _jobs.push(std::move(job));
+    }
+    _cv.notify_one();
+  }
+
+ private:
+  void WorkerLoop() {
+    while (true) {
+      std::function<void()> job;
+      {
+        std::unique_lock<std::mutex> lock(_mutex);
+        _cv.wait(lock, [this] { return _stop || !_jobs.empty(); });
+        if (_jobs.empty()) return;
+        job = std::move(_jobs.front());
+        _jobs.pop();
+      }
+      job();
+    }
+  }
+
+  std::vector<std::thread> _workers;
+  std::mutex _mutex;
+  std::condition_variable _cv;
+  std::queue<std::function<void()>> _jobs;
+  bool _stop = false;
+};
+
+}  // namespace common
+}  // namespace byteps
+
+#endif  // BYTEPS_INIT_POOL_H
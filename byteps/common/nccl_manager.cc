@@ -165,13 +165,17 @@ void NcclManager::InitGlobalEnv() {  // init all global env/param here
 }
 
 void NcclManager::EnqueueGroup(std::shared_ptr<NcclGroupEntry> e) {
-  std::lock_guard<std::mutex> lock(_nccl_mutex);
-  _nccl_pipeline.push(e);
+  {
+    std::lock_guard<std::mutex> lock(_nccl_mutex);
+    _nccl_pipeline.push(e);
+  }
+  _group_notifier->Notify();
   return;
 }
 
 std::shared_ptr<NcclGroupEntry> NcclManager::DequeueGroup() {
   std::lock_guard<std::mutex> lock(_nccl_mutex);
+  _group_wait_version = _group_notifier->Version();
   if (!_nccl_pipeline.size()) {
     return nullptr;
   }
@@ -180,6 +184,8 @@ std::shared_ptr<NcclGroupEntry> NcclManager::DequeueGroup() {
   return r;
 }
 
+void NcclManager::WaitGroup() { _group_notifier->Wait(_group_wait_version); }
+
 // Example:
 // 4 reduce rings:
 // 0 1 2 3 | 4 5 6 7
@@ -66,6 +66,10 @@ class NcclManager {
   int GetGroupSize() { return _nccl_group_size; }
   void EnqueueGroup(std::shared_ptr<NcclGroupEntry> e);
   std::shared_ptr<NcclGroupEntry> DequeueGroup();
+  // Called after DequeueGroup() returned nothing, returns when a group may
+  // have been enqueued
+  void WaitGroup();
+  std::shared_ptr<TaskNotifier> GetGroupNotifier() { return _group_notifier; }
 
   virtual cudaStream_t GetStream(uint64_t key, QueueType op);
   virtual ncclComm_t GetComm(uint64_t key, QueueType op);
@@ -95,6 +99,9 @@ class NcclManager {
   // for pipelining nccl
   std::mutex _nccl_mutex;
   std::queue<std::shared_ptr<NcclGroupEntry>> _nccl_pipeline;
+  std::shared_ptr<TaskNotifier> _group_notifier =
+      std::make_shared<TaskNotifier>();
+  uint64_t _group_wait_version = 0;
 
   std::shared_ptr<BytePSComm> _signal_comm;
   std::shared_ptr<BytePSComm> _global_comm;
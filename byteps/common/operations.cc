@@ -15,6 +15,9 @@
 
 #include "operations.h"
 #include <cuda_runtime.h>
+#include <algorithm>
+#include <chrono>
+#include <condition_variable>
 #include <cstring>
 #include <memory>
 #include <thread>
@@ -172,6 +175,12 @@ Status EnqueueTensor(BPSContext &context, std::shared_ptr<Tensor> input,
   BPS_CHECK_EQ(context.key_list.size(), partitions.size())
       << name << ": " << context.key_list.size() << ", " << partitions.size();
 
+  // The fusion group is set when the tensor is initialized, so every worker
+  // fuses it from its first push_pull on
+  if (context.fusion_group) {
+    partitions[0]->fusion_group = context.fusion_group;
+  }
+
   if (e->queue_list.size() == 0) {
     BPS_CHECK(e->tensor_name != "");
     BPS_LOG(TRACE) << e->tensor_name << ", device=" << e->device
@@ -232,18 +241,105 @@ void LogKeyMapping(std::string name, const std::vector<uint64_t>& keys) {
   }
 }
 
-void InitTensor(BPSContext &context, size_t size, int dtype, void *cpubuff) {
-  std::lock_guard<std::mutex> lock(context.init_mutex);
-  if (context.initialized) {
-    return;
+namespace {
+
+std::shared_ptr<FusionGroup> MakeFusionGroup(
+    const std::vector<BPSContext *> &members) {
+  auto group = std::make_shared<FusionGroup>();
+  group->key = (members[0]->declared_key << 16) | 0xFFFF;  // not a partition
+  group->dtype = members[0]->dtype;
+  group->len = 0;
+  for (auto c : members) {
+    c->fusion_offset = group->len;
+    group->len += c->buff_len;
   }
-  CUDA_CALL(cudaSetDevice(BytePSGlobal::GetLocalRank()));
+  group->members = members;
+  group->cpubuff = BytePSGlobal::GetSharedMemoryObj()->openSharedMemory(
+      std::string("BytePS_ShM_"), group->key, group->len);
+  return group;
+}
 
+// Issues the init push of a fusion group and returns its timestamp
+int PushInitFusionGroup(const FusionGroup &group) {
+  auto ps = BytePSGlobal::GetOrInitPS();
+  auto &pskv = BytePSGlobal::EncodeDefaultKey(group.key, group.len);
+  ps::SArray<char> vals((char *)group.cpubuff, group.len, false);
+  int cmd = GetCommandType(RequestType::kDefaultPushPull, group.dtype);
+  return ps->ZPush(pskv.keys, vals, pskv.lens, cmd);
+}
+
+// Lets the members push and pull through the group. The caller holds their
+// init_mutex.
+void ActivateFusionGroup(const std::shared_ptr<FusionGroup> &group) {
+  auto &members = group->members;
+  for (auto c : members) {
+    c->fusion_group = group;
+  }
+  BPS_LOG(DEBUG) << "Fused " << members.size() << " tensors from "
+                 << members.front()->tensor_name << " to "
+                 << members.back()->tensor_name << " into key " << group->key
+                 << ", len=" << group->len;
+  LogKeyMapping("Fusion." + members.front()->tensor_name, {group->key});
+}
+
+// Packs the given tensors declared with fusion into groups of adjacent
+// declared keys, i.e. of adjacent priority, up to BYTEPS_FUSION_BYTES each.
+// Only tensors of one partition that the servers simply sum are fused. The
+// plan only depends on the declared tensors, so it is the same on all
+// workers. The caller holds their init_mutex.
+std::vector<std::shared_ptr<FusionGroup>> PlanFusion(
+    std::vector<BPSContext *> contexts) {
+  std::vector<std::shared_ptr<FusionGroup>> groups;
+  if (!BytePSGlobal::GetFusionBound() || !BytePSGlobal::IsDistributed() ||
+      !BytePSGlobal::IsRootDevice()) {
+    return groups;
+  }
+  std::sort(contexts.begin(), contexts.end(),
+            [](BPSContext *a, BPSContext *b) {
+              return a->declared_key < b->declared_key;
+            });
+  auto bound = BytePSGlobal::GetFusionBound();
+  std::vector<BPSContext *> members;
+  size_t len = 0;
+  auto close = [&members, &len, &groups]() {
+    if (members.size() > 1) {
+      groups.push_back(MakeFusionGroup(members));
+    }
+    members.clear();
+    len = 0;
+  };
+  for (auto c : contexts) {
+    if (!c->fusion) continue;
+    bool eligible = c->request_type == RequestType::kDefaultPushPull &&
+                    c->key_list.size() == 1 && c->buff_len <= bound;
+    if (!eligible ||
+        (members.size() &&
+         (c->dtype != members[0]->dtype || len + c->buff_len > bound))) {
+      close();
+    }
+    if (eligible) {
+      members.push_back(c);
+      len += c->buff_len;
+    }
+  }
+  close();
+  return groups;
+}
+
+}  // namespace
+
+namespace {
+
+// Partitions a tensor and allocates its buffers. The caller holds
+// context.init_mutex.
+void PrepareTensor(BPSContext &context, size_t size, int dtype,
+                   void *cpubuff) {
   BPS_CHECK_GT(size, 0) << "init tensor size not larger than 0";
   // Get metadata
   auto bound = BytePSGlobal::GetPartitionBound();
   auto &name = context.tensor_name;
   context.buff_len = size;
+  context.dtype = dtype;
   size_t accumulated = 0;
 
   // Add for timeline
@@ -298,41 +394,423 @@ void InitTensor(BPSContext &context, size_t size, int dtype, void *cpubuff) {
   }
   BPS_LOG(TRACE) << name << ": open shared memory size " << size;
 
-  // Init tensors with BytePS server
+  // The compressed payload of each partition is staged in its own buffer,
+  // the init push below always sends the uncompressed data
+  if (context.request_type == RequestType::kCompressedPushPull) {
+    auto method = BytePSGlobal::GetCompressMethod();
+    if (dtype != BYTEPS_FLOAT32 || method == COMPRESS_NONE) {
+      BPS_LOG(DEBUG) << name << " is not compressed, dtype=" << dtype
+                     << ", method=" << method;
+      context.request_type = RequestType::kDefaultPushPull;
+    } else {
+      accumulated = 0;
+      while (accumulated < size) {
+        size_t len = ((size - accumulated) > bound) ? bound : (size - accumulated);
+        size_t count = len / sizeof(float);
+        auto compressed_len = CpuReducer::GetCompressedLen(
+            method, count, BytePSGlobal::GetCompressTopK(count));
+        context.compressed_buff.push_back(malloc(compressed_len));
+        accumulated += len;
+      }
+    }
+  }
+
+}
+
+// Issues the init pushes of the partitions of a prepared tensor and
+// returns their timestamps. The callback, if any, runs once per partition.
+std::vector<int> PushInitTensor(BPSContext &context,
+                                const std::function<void()> &cb = nullptr) {
+  std::vector<int> timestamps;
+  if (!BytePSGlobal::IsDistributed() || !BytePSGlobal::IsRootDevice()) {
+    return timestamps;
+  }
+  auto bound = BytePSGlobal::GetPartitionBound();
+  auto size = context.buff_len;
+  auto &key_list = context.key_list;
+  auto ps = BytePSGlobal::GetOrInitPS();
   char *data = const_cast<char *>(static_cast<const char *>(context.cpubuff));
-  accumulated = 0;
+  size_t accumulated = 0;
   size_t i = 0;
   while (accumulated < size) {
     auto key = key_list[i];
     int len = ((size - accumulated) > bound) ? bound : (size - accumulated);
-
-    if (BytePSGlobal::IsDistributed() && BytePSGlobal::IsRootDevice()) {
-      auto ps = BytePSGlobal::GetOrInitPS();
-      // encode the key for pskv scattering
-      auto &pskv = BytePSGlobal::EncodeDefaultKey(key, len);
-      // false means not to delete data when SArray is deleted
-      ps::SArray<char> vals(data + accumulated, len, false);
-      // cmd type
-      int cmd = GetCommandType(RequestType::kDefaultPushPull, dtype);
-      // blocking push, also as a global barrirer
-      ps->Wait(ps->ZPush(pskv.keys, vals, pskv.lens, cmd));
-    }
-
+    // encode the key for pskv scattering
+    auto &pskv = BytePSGlobal::EncodeDefaultKey(key, len);
+    // false means not to delete data when SArray is deleted
+    ps::SArray<char> vals(data + accumulated, len, false);
+    // cmd type
+    int cmd = GetCommandType(context.request_type, context.dtype);
+    // the servers answer once all workers pushed, so waiting for them is
+    // also a global barrier
+    timestamps.push_back(ps->ZPush(pskv.keys, vals, pskv.lens, cmd, cb));
     accumulated += len;
     ++i;
   }
-
   BPS_CHECK_EQ(accumulated, size);
   BPS_CHECK_EQ(i, key_list.size());
+  return timestamps;
+}
 
+void FinishInitTensor(BPSContext &context) {
+  auto &name = context.tensor_name;
+  auto &key_list = context.key_list;
   context.initialized = true;
 
   LogKeyMapping(name, key_list);
 
-  BPS_LOG(TRACE) << "Finish Init " << name << ", size=" << size
+  BPS_LOG(TRACE) << "Finish Init " << name << ", size=" << context.buff_len
                  << ", parts=" << key_list.size();
 }
 
+// First-use initialization on the pool, reported each time it drains with
+// the time since the first request, i.e. mostly the first step
+std::mutex init_stats_mutex;
+std::chrono::steady_clock::time_point init_first_request;
+size_t init_requested = 0;
+size_t init_finished = 0;
+
+void FinishInitTensorAsync(BPSContext *context) {
+  std::vector<std::function<void()>> callbacks;
+  {
+    std::lock_guard<std::mutex> lock(context->init_mutex);
+    FinishInitTensor(*context);
+    context->initializing = false;
+    callbacks.swap(context->init_callbacks);
+  }
+  for (auto &cb : callbacks) {
+    cb();
+  }
+
+  std::lock_guard<std::mutex> lock(init_stats_mutex);
+  if (++init_finished == init_requested) {
+    BPS_LOG(INFO) << "Initialized " << init_finished
+                  << " tensors on first use, "
+                  << std::chrono::duration<double, std::milli>(
+                         std::chrono::steady_clock::now() -
+                         init_first_request)
+                         .count()
+                  << " ms after the first one was requested"
+                  << ", rank=" << BytePSGlobal::GetLocalRank();
+  }
+}
+
+// Runs on the init pool. Only the pushes wait for the servers, the last one
+// to be answered hands the rest back to the pool.
+void StartInitTensorAsync(BPSContext *context, size_t size, int dtype,
+                          void *cpubuff) {
+  CUDA_CALL(cudaSetDevice(BytePSGlobal::GetLocalRank()));
+  {
+    std::lock_guard<std::mutex> lock(context->init_mutex);
+    PrepareTensor(*context, size, dtype, cpubuff);
+  }
+  if (!BytePSGlobal::IsDistributed() || !BytePSGlobal::IsRootDevice()) {
+    FinishInitTensorAsync(context);
+    return;
+  }
+  auto remaining =
+      std::make_shared<std::atomic<size_t>>(context->key_list.size());
+  PushInitTensor(*context, [context, remaining]() {
+    if (remaining->fetch_sub(1) != 1) return;
+    auto pool = BytePSGlobal::GetInitPool();
+    if (pool) {
+      pool->Submit([context]() { FinishInitTensorAsync(context); });
+    } else {
+      FinishInitTensorAsync(context);
+    }
+  });
+}
+
+}  // namespace
+
+void InitTensorAsync(BPSContext &context, size_t size, int dtype,
+                     void *cpubuff, std::function<void()> callback) {
+  {
+    std::lock_guard<std::mutex> lock(context.init_mutex);
+    if (!context.initialized) {
+      context.init_callbacks.push_back(std::move(callback));
+      if (context.initializing) {
+        return;
+      }
+      context.initializing = true;
+      {
+        std::lock_guard<std::mutex> stats_lock(init_stats_mutex);
+        if (init_requested++ == 0) {
+          init_first_request = std::chrono::steady_clock::now();
+        }
+      }
+      auto ctx = &context;
+      BytePSGlobal::GetInitPool()->Submit([ctx, size, dtype, cpubuff]() {
+        StartInitTensorAsync(ctx, size, dtype, cpubuff);
+      });
+      return;
+    }
+  }
+  callback();
+}
+
+void InitTensor(BPSContext &context, size_t size, int dtype, void *cpubuff) {
+  if (context.initialized) {
+    return;
+  }
+  std::mutex mu;
+  std::condition_variable cv;
+  bool done = false;
+  InitTensorAsync(context, size, dtype, cpubuff, [&mu, &cv, &done]() {
+    std::lock_guard<std::mutex> lock(mu);
+    done = true;
+    cv.notify_one();
+  });
+  std::unique_lock<std::mutex> lock(mu);
+  cv.wait(lock, [&done] { return done; });
+}
+
+void InitTensors(const std::vector<BPSContext *> &contexts,
+                 const std::vector<size_t> &sizes,
+                 const std::vector<int> &dtypes) {
+  BPS_CHECK_EQ(contexts.size(), sizes.size());
+  BPS_CHECK_EQ(contexts.size(), dtypes.size());
+  CUDA_CALL(cudaSetDevice(BytePSGlobal::GetLocalRank()));
+  auto start = std::chrono::steady_clock::now();
+
+  // the contexts stay locked until they are initialized, except those
+  // already being initialized on the init pool, which are waited for last
+  std::vector<std::unique_lock<std::mutex>> locks;
+  std::vector<BPSContext *> pending;
+  std::vector<size_t> in_flight;
+  for (size_t i = 0; i < contexts.size(); ++i) {
+    std::unique_lock<std::mutex> lock(contexts[i]->init_mutex);
+    if (contexts[i]->initialized) continue;
+    if (contexts[i]->initializing) {
+      in_flight.push_back(i);
+      continue;
+    }
+    PrepareTensor(*contexts[i], sizes[i], dtypes[i], nullptr);
+    pending.push_back(contexts[i]);
+    locks.push_back(std::move(lock));
+  }
+  // the fusion groups of these tensors are initialized in the same round
+  // trip, and used from their first push_pull on
+  auto groups = PlanFusion(pending);
+  auto prepared = std::chrono::steady_clock::now();
+
+  std::vector<int> timestamps;
+  for (auto context : pending) {
+    auto ts = PushInitTensor(*context);
+    timestamps.insert(timestamps.end(), ts.begin(), ts.end());
+  }
+  for (auto &group : groups) {
+    timestamps.push_back(PushInitFusionGroup(*group));
+  }
+  auto pushed = std::chrono::steady_clock::now();
+  for (auto ts : timestamps) {
+    BytePSGlobal::GetPS()->Wait(ts);
+  }
+  auto synced = std::chrono::steady_clock::now();
+
+  for (auto &group : groups) {
+    ActivateFusionGroup(group);
+  }
+  for (auto context : pending) {
+    FinishInitTensor(*context);
+  }
+  auto finished = std::chrono::steady_clock::now();
+
+  auto ms = [](std::chrono::steady_clock::time_point a,
+               std::chrono::steady_clock::time_point b) {
+    return std::chrono::duration<double, std::milli>(b - a).count();
+  };
+  BPS_LOG(INFO) << "Initialized " << pending.size() << " tensors and "
+                << groups.size() << " fusion groups with "
+                << timestamps.size() << " init pushes in "
+                << ms(start, finished) << " ms: prepare "
+                << ms(start, prepared) << " ms, issue pushes "
+                << ms(prepared, pushed) << " ms, wait for servers "
+                << ms(pushed, synced) << " ms, finish "
+                << ms(synced, finished) << " ms"
+                << ", rank=" << BytePSGlobal::GetLocalRank();
+
+  locks.clear();
+  for (auto i : in_flight) {
+    InitTensor(*contexts[i], sizes[i], dtypes[i], nullptr);
+  }
+}
+
+namespace {
+
+size_t GetRowsPerPartition(const BPSContext &context) {
+  size_t rows = BytePSGlobal::GetPartitionBound() / context.row_len;
+  return rows ? rows : 1;
+}
+
+size_t GetRowsOfPartition(const BPSContext &context, size_t part) {
+  auto rows_per_part = GetRowsPerPartition(context);
+  return std::min(rows_per_part, context.row_num - part * rows_per_part);
+}
+
+}  // namespace
+
+void InitRowSparseTensor(BPSContext &context, size_t row_num, size_t row_len,
+                         int dtype) {
+  std::lock_guard<std::mutex> lock(context.init_mutex);
+  if (context.initialized) {
+    BPS_CHECK(context.request_type == RequestType::kRowSparsePushPull)
+        << context.tensor_name << " is already used as a dense tensor";
+    BPS_CHECK_EQ(context.row_num, row_num) << context.tensor_name;
+    BPS_CHECK_EQ(context.row_len, row_len) << context.tensor_name;
+    return;
+  }
+  BPS_CHECK_GT(row_num, 0) << context.tensor_name;
+  BPS_CHECK_GT(row_len, 0) << context.tensor_name;
+  auto &name = context.tensor_name;
+  context.request_type = RequestType::kRowSparsePushPull;
+  context.row_num = row_num;
+  context.row_len = row_len;
+  context.buff_len = row_num * row_len;
+
+  // partitions are made of whole rows
+  auto rows_per_part = GetRowsPerPartition(context);
+  ps::Key start_key = context.declared_key << 16;
+  for (size_t rows = 0; rows < row_num; rows += rows_per_part) {
+    context.key_list.push_back(start_key++);
+  }
+  BPS_CHECK_LE(context.key_list.size(), (size_t)1 << 16) << name;
+  BPS_LOG(DEBUG) << name << " (row-sparse) partitioned to "
+                 << context.key_list.size() << " part(s) of " << rows_per_part
+                 << " rows, row_len=" << row_len;
+
+  if (BytePSGlobal::IsDistributed()) {
+    BPS_CHECK_EQ(BytePSGlobal::GetLocalSize(), 1)
+        << "row-sparse push_pull needs one BytePS process per worker";
+    auto ps = BytePSGlobal::GetOrInitPS();
+    int cmd = GetCommandType(RequestType::kRowSparsePushPull, dtype);
+    for (size_t i = 0; i < context.key_list.size(); ++i) {
+      auto rows = GetRowsOfPartition(context, i);
+      // the dense length of the partition only selects the server
+      auto &pskv =
+          BytePSGlobal::EncodeDefaultKey(context.key_list[i], rows * row_len);
+      // the server allocates the partition from the header
+      ps::SArray<char> vals(sizeof(RowSparseHeader));
+      auto header = reinterpret_cast<RowSparseHeader *>(vals.data());
+      header->num_rows = rows;
+      header->row_len = row_len;
+      ps::SArray<int> lens(1, vals.size());
+      // blocking push, also as a global barrirer
+      ps->Wait(ps->ZPush(pskv.keys, vals, lens, cmd));
+    }
+  }
+
+  context.initialized = true;
+
+  LogKeyMapping(name, context.key_list);
+
+  BPS_LOG(TRACE) << "Finish Init " << name << " (row-sparse), rows=" << row_num
+                 << ", parts=" << context.key_list.size();
+}
+
+Status EnqueueRowSparseTensor(BPSContext &context, const int64_t *indices,
+                              const void *values, size_t num_rows, int dtype,
+                              RowSparseCallback callback) {
+  BPS_CHECK(context.initialized) << context.tensor_name;
+  BPS_CHECK(context.request_type == RequestType::kRowSparsePushPull)
+      << context.tensor_name;
+  auto row_len = context.row_len;
+  auto data = reinterpret_cast<const char *>(values);
+
+  // rows are sent in order, and each row only once
+  std::vector<size_t> order(num_rows);
+  for (size_t i = 0; i < num_rows; ++i) order[i] = i;
+  std::sort(order.begin(), order.end(), [indices](size_t a, size_t b) {
+    return indices[a] < indices[b];
+  });
+  for (size_t i = 0; i < num_rows; ++i) {
+    auto idx = indices[order[i]];
+    if (idx < 0 || (size_t)idx >= context.row_num) {
+      return Status::InvalidArgument(context.tensor_name + ": row index " +
+                                     std::to_string(idx) + " out of range");
+    }
+    if (i && idx == indices[order[i - 1]]) {
+      return Status::InvalidArgument(context.tensor_name +
+                                     ": duplicated row index " +
+                                     std::to_string(idx) + ", coalesce first");
+    }
+  }
+
+  if (!BytePSGlobal::IsDistributed()) {
+    auto result = std::make_shared<RowSparseData>();
+    result->indices.assign(indices, indices + num_rows);
+    result->values.assign(data, data + num_rows * row_len);
+    callback(Status::OK(), result);
+    return Status::OK();
+  }
+
+  auto ps = BytePSGlobal::GetPS();
+  auto num_parts = context.key_list.size();
+  auto rows_per_part = GetRowsPerPartition(context);
+  auto pulled = std::make_shared<std::vector<ps::SArray<char>>>(num_parts);
+  auto counter = std::make_shared<std::atomic_int>(num_parts);
+  int cmd = GetCommandType(RequestType::kRowSparsePushPull, dtype);
+
+  // every partition is pushed, even without rows, so that the servers can
+  // tell when a round is complete
+  size_t begin = 0;
+  for (size_t part = 0; part < num_parts; ++part) {
+    size_t end = begin;
+    while (end < num_rows &&
+           (size_t)indices[order[end]] < (part + 1) * rows_per_part) {
+      ++end;
+    }
+    size_t n = end - begin;
+    ps::SArray<char> vals(sizeof(RowSparseHeader) +
+                          n * (sizeof(uint32_t) + row_len));
+    auto header = reinterpret_cast<RowSparseHeader *>(vals.data());
+    header->num_rows = n;
+    header->row_len = row_len;
+    auto ids = reinterpret_cast<uint32_t *>(vals.data() +
+                                            sizeof(RowSparseHeader));
+    auto rows = vals.data() + sizeof(RowSparseHeader) + n * sizeof(uint32_t);
+    for (size_t j = 0; j < n; ++j) {
+      auto i = order[begin + j];
+      ids[j] = indices[i] - part * rows_per_part;
+      memcpy(rows + j * row_len, data + i * row_len, row_len);
+    }
+    begin = end;
+
+    auto rows_of_part = GetRowsOfPartition(context, part);
+    auto &pskv = BytePSGlobal::EncodeDefaultKey(context.key_list[part],
+                                                rows_of_part * row_len);
+    auto keys = pskv.keys;
+    ps::SArray<int> lens(1, vals.size());
+    ps->ZPush(keys, vals, lens, cmd, [ps, keys, cmd, part, rows_per_part,
+                                      pulled, counter, callback]() {
+      // the size of the pulled rows is only known from the response
+      ps->ZPull(keys, &(*pulled)[part], nullptr, cmd, [pulled, counter,
+                                                      rows_per_part,
+                                                      callback]() {
+        if (counter->fetch_sub(1) != 1) return;
+        auto result = std::make_shared<RowSparseData>();
+        for (size_t p = 0; p < pulled->size(); ++p) {
+          auto &buf = (*pulled)[p];
+          BPS_CHECK_GE(buf.size(), sizeof(RowSparseHeader));
+          auto header = reinterpret_cast<RowSparseHeader *>(buf.data());
+          auto n = header->num_rows;
+          auto ids = reinterpret_cast<uint32_t *>(buf.data() +
+                                                  sizeof(RowSparseHeader));
+          auto rows = buf.data() + sizeof(RowSparseHeader) +
+                      n * sizeof(uint32_t);
+          for (size_t j = 0; j < n; ++j) {
+            result->indices.push_back(p * rows_per_part + ids[j]);
+          }
+          result->values.insert(result->values.end(), rows,
+                                rows + (size_t)n * header->row_len);
+        }
+        callback(Status::OK(), result);
+      });
+    });
+  }
+  return Status::OK();
+}
+
 BPSContext &GetContextFromName(const std::string &name) {
   return BytePSGlobal::GetContextFromName(name);
 }
@@ -377,8 +855,8 @@ std::shared_ptr<std::vector<QueueType>> GetPushQueueList(int device) {
 std::shared_ptr<std::vector<QueueType>> GetPullQueueList(int device) {
   auto queue_list = std::make_shared<std::vector<QueueType>>();
 
-  // Pull in distributed mode
-  if (BytePSGlobal::IsDistributed()) {
+  // Pull in distributed mode, unless the PUSH stage gets the merged data
+  if (BytePSGlobal::IsDistributed() && !BytePSGlobal::IsPushPullRPC()) {
     if (BytePSGlobal::IsRootDevice()) {
       queue_list->push_back(PULL);
     }
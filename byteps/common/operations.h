@@ -60,6 +60,27 @@ Status EnqueueTensor(BPSContext &context, std::shared_ptr<Tensor> input,
 
 void InitTensor(BPSContext &context, size_t size, int dtype, void *cpubuff);
 
+// Initializes a tensor on the init pool (BYTEPS_INIT_THREADS) and calls
+// callback there once it is done, or right away if it already is
+void InitTensorAsync(BPSContext &context, size_t size, int dtype,
+                     void *cpubuff, std::function<void()> callback);
+
+// Initializes tensors on GPU at once: the init pushes of all partitions are
+// issued before waiting for the servers, so it costs one round trip
+void InitTensors(const std::vector<BPSContext *> &contexts,
+                 const std::vector<size_t> &sizes,
+                 const std::vector<int> &dtypes);
+
+// Row-sparse push_pull of a tensor with row_num rows of row_len bytes. Only
+// the given rows are sent, and the callback receives the union of the rows
+// pushed by all workers, summed. Needs one BytePS process per worker.
+void InitRowSparseTensor(BPSContext &context, size_t row_num, size_t row_len,
+                         int dtype);
+
+Status EnqueueRowSparseTensor(BPSContext &context, const int64_t *indices,
+                              const void *values, size_t num_rows, int dtype,
+                              RowSparseCallback callback);
+
 // Only call these in Framework plugins for the best performance
 bool IsTensorDeclared(const std::string &name);
 
@@ -26,10 +26,19 @@ bool ReadyTable::IsKeyReady(uint64_t key) {
 }
 
 int ReadyTable::AddReadyCount(uint64_t key) {
-  std::lock_guard<std::mutex> lock(_table_mutex);
-  BPS_CHECK_LT(_ready_table[key], _ready_count)
-      << _table_name << ": " << _ready_table[key] << ", " << (_ready_count);
-  return ++_ready_table[key];
+  int count;
+  std::function<void(uint64_t)> cb;
+  {
+    std::lock_guard<std::mutex> lock(_table_mutex);
+    BPS_CHECK_LT(_ready_table[key], _ready_count)
+        << _table_name << ": " << _ready_table[key] << ", " << (_ready_count);
+    count = ++_ready_table[key];
+    if (count == _ready_count) cb = _ready_callback;
+  }
+  // the callback may take the lock of a queue, which calls into this table
+  // while holding it
+  if (cb) cb(key);
+  return count;
 }
 
 void ReadyTable::ClearReadyCount(uint64_t key) {
@@ -37,5 +46,10 @@ void ReadyTable::ClearReadyCount(uint64_t key) {
   _ready_table[key] = 0;
 }
 
+void ReadyTable::SetReadyCallback(std::function<void(uint64_t)> cb) {
+  std::lock_guard<std::mutex> lock(_table_mutex);
+  _ready_callback = std::move(cb);
+}
+
 }  // namespace common
 }  // namespace byteps
@@ -16,6 +16,7 @@
 #ifndef BYTEPS_READY_TABLE_H
 #define BYTEPS_READY_TABLE_H
 
+#include <functional>
 #include <mutex>
 #include <thread>
 #include <unordered_map>
@@ -33,6 +34,9 @@ class ReadyTable {
   bool IsKeyReady(uint64_t key);
   int AddReadyCount(uint64_t key);
   void ClearReadyCount(uint64_t key);
+  // cb(key) is called, outside of the table lock, whenever the count of key
+  // reaches ready_count in AddReadyCount()
+  void SetReadyCallback(std::function<void(uint64_t)> cb);
 
  private:
   // (key, ready_signal_count) pair, only valid for root device
@@ -41,6 +45,7 @@ class ReadyTable {
   std::mutex _table_mutex;
   int _ready_count;
   std::string _table_name;
+  std::function<void(uint64_t)> _ready_callback;
 };
 
 }  // namespace common
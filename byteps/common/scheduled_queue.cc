@@ -21,7 +21,10 @@
 namespace byteps {
 namespace common {
 
-BytePSScheduledQueue::BytePSScheduledQueue(QueueType type) {
+BytePSScheduledQueue::BytePSScheduledQueue(
+    QueueType type, std::shared_ptr<TaskNotifier> notifier) {
+  _notifier = notifier ? notifier : std::make_shared<TaskNotifier>();
+
   if (type == REDUCE && BytePSGlobal::GetNccl()->IsSignalRoot()) {
     _is_scheduled = true;
   } else {
@@ -73,23 +76,21 @@ BytePSScheduledQueue::BytePSScheduledQueue(QueueType type) {
     default:
       break;
   }
+
+  _sq.reset(new TaskIndex<TensorTableEntry>(_is_scheduled));
+  if (_rt) {
+    _rt->SetReadyCallback([this](uint64_t key) { onKeyReady(key); });
+  }
 }
 
 void BytePSScheduledQueue::addTask(std::shared_ptr<TensorTableEntry> entry) {
-  std::lock_guard<std::mutex> lock(_mutex);
-  _sq.push_back(entry);
-  if (_is_scheduled) {
-    // TODO: below can be optimized to O(n) using insertion sort
-    std::sort(
-        _sq.begin(), _sq.end(),
-        [](std::shared_ptr<TensorTableEntry> a,
-           std::shared_ptr<TensorTableEntry> b) {
-          if (a->priority == b->priority) {
-            return (a->key < b->key);  // from the first partition to the last
-          }
-          return (a->priority > b->priority);  // from higher priority to lower
-        });
+  {
+    std::lock_guard<std::mutex> lock(_mutex);
+    // the signals of the key may have arrived before the task, otherwise
+    // onKeyReady() makes it ready later
+    _sq->Add(entry, !_rt || _rt->IsKeyReady(entry->key));
   }
+  _notifier->Notify();
   BPS_CHECK(entry->tensor_name != "");
   BPS_LOG(TRACE) << "Queue " << LogStrings[_qt]
                  << " addTask: " << entry->tensor_name << " key: " << entry->key
@@ -119,82 +120,99 @@ void BytePSScheduledQueue::recorderTs(std::shared_ptr<TensorTableEntry> task) {
 }
 
 std::shared_ptr<TensorTableEntry> BytePSScheduledQueue::getTask() {
-  std::lock_guard<std::mutex> lock(_mutex);
-  std::shared_ptr<TensorTableEntry> task;
-  // TODO: below can be optimized -- if we take task from the tail, erase() can
-  // be faster
-  for (auto it = _sq.begin(); it != _sq.end(); ++it) {
-    if ((*it)->ready_event) {
-      if (!(*it)->ready_event->Ready()) {
-        continue;
-      }
-    }
-    if (_is_scheduled) {
-      if ((*it)->len > _credits) {
-        continue;
-      }
-    }
-    if (_rt) {
-      if (!_rt->IsKeyReady((*it)->key)) {
-        continue;
-      }
-      _rt->ClearReadyCount((*it)->key);
-    }
-    task = *it;
-    _sq.erase(it);
-    if (_is_scheduled) {
-      _credits -= task->len;
-    }
+  return getTask(nullptr);
+}
 
-    BPS_CHECK(task->tensor_name != "");
-    BPS_LOG(TRACE) << "Queue " << LogStrings[_qt]
-                   << " getTask: " << task->tensor_name << " key: " << task->key
-                   << " rank: " << BytePSGlobal::GetLocalRank();
-    task->ready_event = nullptr;
-    // Add for profiling communication traces
-    recorderTs(task);
-    return task;
+std::shared_ptr<TensorTableEntry> BytePSScheduledQueue::getTask(
+    const std::function<bool(const TensorTableEntry &)> &filter) {
+  std::lock_guard<std::mutex> lock(_mutex);
+  _wait_version = _notifier->Version();
+  _poll_events = false;
+  // only tasks whose key is ready in _rt are visited
+  auto task = _sq->PopReady(
+      [this](const TensorTableEntry &entry) {
+        if (entry.ready_event && !entry.ready_event->Ready()) {
+          _poll_events = true;
+          return false;
+        }
+        if (filter && !filter(entry)) {
+          return false;
+        }
+        return !_is_scheduled || entry.len <= _credits;
+      },
+      _rt != nullptr);
+  if (!task) {
+    return nullptr;
+  }
+  if (_rt) {
+    _rt->ClearReadyCount(task->key);
+  }
+  if (_is_scheduled) {
+    _credits -= task->len;
   }
-  return nullptr;
-}
 
+  BPS_CHECK(task->tensor_name != "");
+  BPS_LOG(TRACE) << "Queue " << LogStrings[_qt]
+                 << " getTask: " << task->tensor_name << " key: " << task->key
+                 << " rank: " << BytePSGlobal::GetLocalRank();
+  task->ready_event = nullptr;
+  // Add for profiling communication traces
+  recorderTs(task);
+  return task;
+}
 
 std::shared_ptr<TensorTableEntry> BytePSScheduledQueue::getTask(uint64_t key) {
   BPS_CHECK(!_is_scheduled);
   std::lock_guard<std::mutex> lock(_mutex);
-  std::shared_ptr<TensorTableEntry> task;
-  for (auto it = _sq.begin(); it != _sq.end(); ++it) {
-    if ((*it)->ready_event) {
-      BPS_CHECK((*it)->ready_event->Ready());
-    }
-    if ((*it)->key != (uint64_t)key) {
-      continue;
-    }
-    task = *it;
-    _sq.erase(it);
-
-    BPS_CHECK(task->tensor_name != "");
-    BPS_LOG(TRACE) << "Queue " << LogStrings[_qt]
-                   << " getTask(key): " << task->tensor_name
-                   << " key: " << task->key
-                   << " rank: " << BytePSGlobal::GetLocalRank();
-    task->ready_event = nullptr;
-    // Add for profiling communication traces
-    recorderTs(task);
-    return task;
+  auto task = _sq->PopKey(key);
+  if (!task) {
+    return nullptr;
+  }
+  if (task->ready_event) {
+    BPS_CHECK(task->ready_event->Ready());
+  }
+
+  BPS_CHECK(task->tensor_name != "");
+  BPS_LOG(TRACE) << "Queue " << LogStrings[_qt]
+                 << " getTask(key): " << task->tensor_name
+                 << " key: " << task->key
+                 << " rank: " << BytePSGlobal::GetLocalRank();
+  task->ready_event = nullptr;
+  // Add for profiling communication traces
+  recorderTs(task);
+  return task;
+}
+
+void BytePSScheduledQueue::onKeyReady(uint64_t key) {
+  std::lock_guard<std::mutex> lock(_mutex);
+  // a late callback must not release the task of the next round, the count
+  // may have been cleared since
+  if (_rt->IsKeyReady(key)) {
+    _sq->SetKeyReady(key);
+    _notifier->Notify();
+  }
+}
+
+void BytePSScheduledQueue::wait() {
+  if (_poll_events) {
+    std::this_thread::sleep_for(std::chrono::nanoseconds(1000));
+  } else {
+    _notifier->Wait(_wait_version);
   }
-  return nullptr;
 }
 
 uint32_t BytePSScheduledQueue::pendingSize() {
   std::lock_guard<std::mutex> lock(_mutex);
-  return _sq.size();
+  return _sq->size();
 }
 
 void BytePSScheduledQueue::reportFinish(int size) {
   if (_is_scheduled) {
-    std::lock_guard<std::mutex> lock(_mutex);
-    _credits += size;
+    {
+      std::lock_guard<std::mutex> lock(_mutex);
+      _credits += size;
+    }
+    _notifier->Notify();
   }
   return;
 }
@@ -17,30 +17,50 @@
 #define BYTEPS_SCHEDULED_QUEUE_H
 
 #include <atomic>
+#include <functional>
 #include <memory>
 #include <unordered_map>
 #include <vector>
 #include "common.h"
 #include "ready_table.h"
+#include "task_index.h"
+#include "task_notifier.h"
 
 namespace byteps {
 namespace common {
 
 class BytePSScheduledQueue {
  public:
-  BytePSScheduledQueue(QueueType type);
+  // Queues that are consumed by the same loop thread share a notifier
+  BytePSScheduledQueue(QueueType type,
+                       std::shared_ptr<TaskNotifier> notifier = nullptr);
   QueueType getQueueType() { return _qt; }
   void addTask(std::shared_ptr<TensorTableEntry>);
   void recorderTs(std::shared_ptr<TensorTableEntry>);
   std::shared_ptr<TensorTableEntry> getTask();
+  // Only returns a task for which filter is true
+  std::shared_ptr<TensorTableEntry> getTask(
+      const std::function<bool(const TensorTableEntry &)> &filter);
   std::shared_ptr<TensorTableEntry> getTask(uint64_t key);
   uint32_t pendingSize();
   void reportFinish(int size);
+  // Called by the consumer after getTask() returned nothing, returns when
+  // a task may be available
+  void wait();
+  std::shared_ptr<TaskNotifier> getNotifier() { return _notifier; }
 
  private:
-  // TODO: use priority queue or heap
-  std::vector<std::shared_ptr<TensorTableEntry>> _sq;
+  // called by _rt when all signals of key have arrived
+  void onKeyReady(uint64_t key);
+
+  std::unique_ptr<TaskIndex<TensorTableEntry>> _sq;
   std::mutex _mutex;
+  std::shared_ptr<TaskNotifier> _notifier;
+  // notifier version before the last getTask()
+  uint64_t _wait_version = 0;
+  // the last getTask() skipped a task for its ready_event, which has to be
+  // polled
+  bool _poll_events = false;
   uint64_t _credits;
   bool _is_scheduled;
   QueueType _qt;
@@ -0,0 +1,151 @@
+// Copyright 2019 Bytedance Inc. or its affiliates. All Rights Reserved.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//     http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+// =============================================================================
+
+#ifndef BYTEPS_TASK_INDEX_H
+#define BYTEPS_TASK_INDEX_H
+
+#include <stdint.h>
+#include <map>
+#include <memory>
+#include <unordered_map>
+#include <utility>
+
+namespace byteps {
+namespace common {
+
+// Pending tasks of a BytePSScheduledQueue. Tasks whose key is ready are kept
+// in a tree ordered by (priority, key), or in FIFO order if by_priority is
+// false, the others wait in a hash table until SetKeyReady() of their key.
+// T needs a priority and a key. Not thread-safe.
+template <typename T>
+class TaskIndex {
+ public:
+  explicit TaskIndex(bool by_priority) : _by_priority(by_priority) {}
+
+  void Add(std::shared_ptr<T> task, bool key_ready) {
+    Order order = {_by_priority ? task->priority : 0,
+                   _by_priority ? task->key : 0, _seq++};
+    if (key_ready) {
+      AddReady(order, std::move(task));
+    } else {
+      uint64_t key = task->key;
+      _waiting.emplace(key, Item{order, std::move(task)});
+    }
+  }
+
+  // Moves the waiting tasks of key to the ready ones
+  void SetKeyReady(uint64_t key) {
+    auto range = _waiting.equal_range(key);
+    for (auto it = range.first; it != range.second; ++it) {
+      AddReady(it->second.order, std::move(it->second.task));
+    }
+    _waiting.erase(range.first, range.second);
+  }
+
+  // Removes and returns the first ready task for which accept(task) is
+  // true, or nullptr. If unready is true, the other ready tasks of its key
+  // wait for SetKeyReady() again.
+  template <typename F>
+  std::shared_ptr<T> PopReady(F accept, bool unready) {
+    for (auto it = _ready.begin(); it != _ready.end(); ++it) {
+      if (!accept(*it->second)) continue;
+      auto task = std::move(it->second);
+      EraseReady(it, task->key);
+      if (unready) {
+        auto range = _ready_keys.equal_range(task->key);
+        for (auto k = range.first; k != range.second; ++k) {
+          auto found = _ready.find(k->second);
+          _waiting.emplace(task->key,
+                           Item{k->second, std::move(found->second)});
+          _ready.erase(found);
+        }
+        _ready_keys.erase(range.first, range.second);
+      }
+      return task;
+    }
+    return nullptr;
+  }
+
+  // Removes and returns the first ready task of key, or nullptr
+  std::shared_ptr<T> PopKey(uint64_t key) {
+    auto range = _ready_keys.equal_range(key);
+    if (range.first == range.second) return nullptr;
+    auto first = range.first;
+    for (auto k = range.first; k != range.second; ++k) {
+      if (OrderLess()(k->second, first->second)) first = k;
+    }
+    auto found = _ready.find(first->second);
+    auto task = std::move(found->second);
+    _ready.erase(found);
+    _ready_keys.erase(first);
+    return task;
+  }
+
+  size_t size() const { return _ready.size() + _waiting.size(); }
+
+ private:
+  struct Order {
+    int priority;
+    uint64_t key;
+    uint64_t seq;
+  };
+
+  struct OrderLess {
+    bool operator()(const Order& a, const Order& b) const {
+      if (a.priority != b.priority) {
+        return a.priority > b.priority;  // from higher priority to lower
+      }
+      if (a.key != b.key) {
+        return a.key < b.key;  // from the first partition to the last
+      }
+      return a.seq < b.seq;
+    }
+  };
+
+  struct Item {
+    Order order;
+    std::shared_ptr<T> task;
+  };
+
+  typedef std::map<Order, std::shared_ptr<T>, OrderLess> ReadyMap;
+
+  void AddReady(const Order& order, std::shared_ptr<T> task) {
+    _ready_keys.emplace(task->key, order);
+    _ready.emplace(order, std::move(task));
+  }
+
+  void EraseReady(typename ReadyMap::iterator it, uint64_t key) {
+    auto range = _ready_keys.equal_range(key);
+    for (auto k = range.first; k != range.second; ++k) {
+      if (k->second.seq == it->first.seq) {
+        _ready_keys.erase(k);
+        break;
+      }
+    }
+    _ready.erase(it);
+  }
+
+  bool _by_priority;
+  uint64_t _seq = 0;
+  ReadyMap _ready;
+  // key -> order of its ready tasks
+  std::unordered_multimap<uint64_t, Order> _ready_keys;
+  std::unordered_multimap<uint64_t, Item> _waiting;
+};
+
+}  // namespace common
+}  // namespace byteps
+
+#endif  // BYTEPS_TASK_INDEX_H
@@ -0,0 +1,87 @@
+// Copyright 2019 Bytedance Inc. or its affiliates. All Rights Reserved.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//     http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+// =============================================================================
+
+#ifndef BYTEPS_TASK_NOTIFIER_H
+#define BYTEPS_TASK_NOTIFIER_H
+
+#include <stdint.h>
+#include <stdlib.h>
+#include <atomic>
+#include <chrono>
+#include <condition_variable>
+#include <mutex>
+#include <thread>
+
+namespace byteps {
+namespace common {
+
+// Wakes up the loop thread that consumes one or more queues. Producers call
+// Notify() whenever a task may have become available. The consumer takes
+// Version() before it looks for tasks, and if there are none, Wait() spins
+// for BYTEPS_LOOP_SPIN_COUNT iterations and then blocks until the next
+// Notify().
+class TaskNotifier {
+ public:
+  TaskNotifier() {
+    auto spin = getenv("BYTEPS_LOOP_SPIN_COUNT");
+    _spin_count = spin ? atoi(spin) : 1000;
+  }
+
+  uint64_t Version() const { return _version.load(); }
+
+  void Notify() {
+    _version.fetch_add(1);
+    if (_waiters.load() > 0) {
+      // a waiter checks the version under the lock before it blocks
+      std::lock_guard<std::mutex> lock(_mutex);
+      _cv.notify_all();
+    }
+  }
+
+  // Returns once Notify() has been called after version was taken. It also
+  // returns after a while without one, so that a lost wakeup only delays
+  // the loop.
+  void Wait(uint64_t version) {
+    for (int i = 0; i < _spin_count; ++i) {
+      if (_version.load(std::memory_order_acquire) != version) return;
+      CpuRelax();
+    }
+    std::unique_lock<std::mutex> lock(_mutex);
+    ++_waiters;
+    _cv.wait_for(lock, std::chrono::milliseconds(10),
+                 [this, version] { return _version.load() != version; });
+    --_waiters;
+  }
+
+ private:
+  static inline void CpuRelax() {
+#if defined(__x86_64__) || defined(__i386__)
+    __builtin_ia32_pause();
+#else
+    std::this_thread::yield();
+#endif
+  }
+
+  std::atomic<uint64_t> _version{0};
+  std::atomic<int> _waiters{0};
+  std::mutex _mutex;
+  std::condition_variable _cv;
+  int _spin_count;
+};
+
+}  // namespace common
+}  // namespace byteps
+
+#endif  // BYTEPS_TASK_NOTIFIER_H
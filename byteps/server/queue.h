@@ -16,8 +16,12 @@
 #ifndef BYTEPS_SERVER_QUEUE_H
 #define BYTEPS_SERVER_QUEUE_H
 
+#include <atomic>
+#include <cstdint>
+#include <deque>
 #include <vector>
 #include <mutex>
+#include <thread>
 #include <condition_variable>
 #include <memory>
 #include <algorithm>
@@ -26,19 +30,14 @@ namespace byteps {
 namespace server {
 
 /**
- * \brief thread-safe queue allowing push and waited pop
+ * \brief thread-safe queue allowing push and waited pop. Each engine thread
+ * owns one queue, so there are many producers but a single consumer.
  */
 class PriorityQueue {
  public:
-  PriorityQueue(bool is_schedule) { 
+  PriorityQueue(bool is_schedule, int spin_count = 0) {
     enable_schedule_ = is_schedule;
-    if (enable_schedule_) {
-      std::make_heap(queue_.begin(), queue_.end(),
-        [this](const BytePSEngineMessage& a, const BytePSEngineMessage& b) {
-          return ComparePriority(a, b);
-        }
-      );
-    }
+    spin_count_ = spin_count;
   }
   ~PriorityQueue() { }
 
@@ -47,18 +46,25 @@ class PriorityQueue {
    * \param new_value the value
    */
   void Push(BytePSEngineMessage new_value) {
-    mu_.lock();
-    queue_.push_back(std::move(new_value));
-    if (enable_schedule_) {
-      ++push_cnt_[new_value.key]; 
-      std::push_heap(queue_.begin(), queue_.end(), 
-        [this](const BytePSEngineMessage& a, const BytePSEngineMessage& b) {
-          return ComparePriority(a, b);
-        }
-      );
+    bool notify = false;
+    {
+      std::lock_guard<std::mutex> lk(mu_);
+      if (enable_schedule_) {
+        ++push_cnt_[new_value.key];
+        heap_.push_back(std::move(new_value));
+        std::push_heap(heap_.begin(), heap_.end(),
+          [this](const BytePSEngineMessage& a, const BytePSEngineMessage& b) {
+            return ComparePriority(a, b);
+          }
+        );
+      } else {
+        fifo_.push_back(std::move(new_value));
+      }
+      size_.fetch_add(1, std::memory_order_release);
+      notify = (waiters_ > 0);
     }
-    mu_.unlock();
-    cond_.notify_all();
+    // only the consumer can be waiting, and only wake it up if it sleeps
+    if (notify) cond_.notify_one();
   }
 
   /**
@@ -66,20 +72,66 @@ class PriorityQueue {
    * \param value the poped value
    */
   void WaitAndPop(BytePSEngineMessage* value) {
+    // spin for a while before parking the thread, trading cpu for latency
+    for (int i = 0; i < spin_count_; ++i) {
+      if (size_.load(std::memory_order_acquire) > 0) break;
+      CpuRelax();
+    }
     std::unique_lock<std::mutex> lk(mu_);
-    cond_.wait(lk, [this]{return !queue_.empty();});
+    if (size_.load(std::memory_order_relaxed) == 0) {
+      ++waiters_;
+      cond_.wait(lk, [this]{ return size_.load(std::memory_order_relaxed) > 0; });
+      --waiters_;
+    }
     if (enable_schedule_) {
-      std::pop_heap(queue_.begin(), queue_.end(), 
+      std::pop_heap(heap_.begin(), heap_.end(),
         [this](const BytePSEngineMessage& a, const BytePSEngineMessage& b) {
           return ComparePriority(a, b);
         }
       );
-      *value = queue_.back();
-      queue_.pop_back();
+      *value = std::move(heap_.back());
+      heap_.pop_back();
+    } else {
+      *value = std::move(fifo_.front());
+      fifo_.pop_front();
+    }
+    size_.fetch_sub(1, std::memory_order_relaxed);
+  }
+
+  /**
+   * \brief pop up to max SUM_RECV messages that add into the same buffer as
+   * msg, as long as they are the next ones to pop, so that they can be
+   * reduced in one pass. It stops at the first other message, which may end
+   * the round of the key. threadsafe
+   * \param msg the SUM_RECV message being processed
+   * \param max the maximum number of messages to pop
+   * \param batch the poped messages are appended to it
+   */
+  void PopMergeable(const BytePSEngineMessage& msg, size_t max,
+                    std::vector<BytePSEngineMessage>* batch) {
+    std::lock_guard<std::mutex> lk(mu_);
+    size_t n = 0;
+    if (enable_schedule_) {
+      // messages of a key have the same priority, so they leave the heap
+      // in the order of their ids
+      while (n < max && !heap_.empty() && IsMergeable(msg, heap_.front())) {
+        std::pop_heap(heap_.begin(), heap_.end(),
+          [this](const BytePSEngineMessage& a, const BytePSEngineMessage& b) {
+            return ComparePriority(a, b);
+          }
+        );
+        batch->push_back(std::move(heap_.back()));
+        heap_.pop_back();
+        ++n;
+      }
     } else {
-      *value = std::move(queue_.front());	
-      queue_.erase(queue_.begin());
+      while (n < max && !fifo_.empty() && IsMergeable(msg, fifo_.front())) {
+        batch->push_back(std::move(fifo_.front()));
+        fifo_.pop_front();
+        ++n;
+      }
     }
+    size_.fetch_sub(n, std::memory_order_relaxed);
   }
 
   void ClearCounter(uint64_t key) {
@@ -97,8 +149,29 @@ class PriorityQueue {
   }
 
  private:
+  static bool IsMergeable(const BytePSEngineMessage& msg,
+                          const BytePSEngineMessage& other) {
+    return other.ops == SUM_RECV && other.key == msg.key &&
+           other.dst == msg.dst &&
+           other.len == msg.len && other.type.dtype == msg.type.dtype &&
+           other.type.requestType == msg.type.requestType;
+  }
+
+  static inline void CpuRelax() {
+#if defined(__x86_64__) || defined(__i386__)
+    __builtin_ia32_pause();
+#else
+    std::this_thread::yield();
+#endif
+  }
+
   mutable std::mutex mu_;
-  std::vector<BytePSEngineMessage> queue_;
+  // FIFO when scheduling is off, a heap ordered by ComparePriority otherwise
+  std::deque<BytePSEngineMessage> fifo_;
+  std::vector<BytePSEngineMessage> heap_;
+  std::atomic<size_t> size_{0};
+  int waiters_ = 0;
+  int spin_count_ = 0;
   std::condition_variable cond_;
   std::unordered_map<uint64_t, uint64_t> push_cnt_;
   volatile bool enable_schedule_ = false;
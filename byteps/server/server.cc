@@ -13,6 +13,8 @@
 // limitations under the License.
 // =============================================================================
 
+#include <algorithm>
+#include <cstring>
 #include <fstream>
 #include "server.h"
 #include "queue.h"
@@ -41,50 +43,184 @@ void LogServerTrace(const std::string& startend , uint64_t key, const std::strin
 std::vector<PriorityQueue*> engine_queues_;
 std::vector<std::thread *> engine_threads_;
 
+uint64_t GetBatchID(const ps::KVMeta& req) {
+  return ((uint64_t) req.sender << 32) | (uint32_t) req.timestamp;
+}
+
+// Concatenates the responses of the keys of a multi-key request
+ps::KVPairs<char> MergeBatchResponse(const BatchResponse& batch) {
+  ps::KVPairs<char> merged;
+  size_t total = 0;
+  for (auto& r : batch.responses) total += r.vals.size();
+  merged.vals.resize(total);
+  size_t offset = 0;
+  for (auto& r : batch.responses) {
+    merged.keys.push_back(r.keys[0]);
+    if (r.lens.size()) merged.lens.push_back(r.lens[0]);
+    if (r.vals.size()) {
+      memcpy(merged.vals.data() + offset, r.vals.data(), r.vals.size());
+      offset += r.vals.size();
+    }
+  }
+  return merged;
+}
+
+// Sends the response of a single key. If the request has several keys, the
+// response is kept until all keys are answered, and then sent as one.
+void SendResponse(const ps::KVMeta& req, const ps::KVPairs<char>& res,
+                  ps::KVServer<char>* server) {
+  if (batch_pending_ == 0) {
+    server->Response(req, res);
+    return;
+  }
+  ps::KVPairs<char> merged;
+  {
+    std::lock_guard<std::mutex> lock(batch_mu_);
+    auto it = batch_responses_.find(GetBatchID(req));
+    if (it == batch_responses_.end()) {
+      merged = res;
+    } else {
+      auto& batch = it->second;
+      CHECK_EQ(res.keys.size(), (size_t)1);
+      batch.responses[batch.index[res.keys[0]]] = res;
+      if (--batch.remaining) return;
+      merged = MergeBatchResponse(batch);
+      batch_responses_.erase(it);
+      --batch_pending_;
+    }
+  }
+  server->Response(req, merged);
+}
+
 void SendPushResponse(uint64_t key, const ps::KVMeta& req, ps::KVServer<char>* server){
-  auto iterator = push_response_map_.find(key);
-  if (iterator == push_response_map_.end()) { // new key
+  // the caller holds handle_mu_ of this key's stripe
+  auto& response_map = push_response_map_[GetStripeID(key)];
+  auto iterator = response_map.find(key);
+  if (iterator == response_map.end()) { // new key
     ps::KVPairs<char> response;
     response.keys = {EncodeKey(key)};
-    push_response_map_[key] = response; // add to the map
-    server->Response(req, response);
+    response_map[key] = response; // add to the map
+    SendResponse(req, response, server);
   } else { // not new key, then reuse the memory address to avoid ibv_reg_mr on RDMA data path
     ps::KVPairs<char> *response = &iterator->second;
     // response->keys[0] = key;
-    server->Response(req, *response);
+    SendResponse(req, *response, server);
   }
 }
 
+// Compresses the stored float32 data of a kCompressedPushPull key with the
+// method of its pushes, for the pulls (BYTEPS_COMPRESS_PULL)
+void CompressForPull(uint64_t key, char* stored, size_t len) {
+  auto& compressed = GetCompressedBuf(key);
+  CHECK_NE(compressed.method, byteps::common::COMPRESS_NONE)
+      << "compressed pull of key " << key << " before any compressed push";
+  if (!compressed.tensor) {
+    compressed.tensor = (char*) malloc(byteps::common::CpuReducer::
+        GetCompressedLen(compressed.method, len / sizeof(float),
+                         compressed.k));
+    CHECK(compressed.tensor);
+  }
+  compressed.len = bps_reducer_->compress(compressed.tensor, stored, len,
+                                          compressed.method, compressed.k);
+}
+
 void SendPullResponse(const DataHandleType type,
                       const uint64_t key,
+                      char* tensor,
+                      size_t len,
                       const ps::KVMeta& req_meta,
                       ps::KVServer<char>* server) {
-  std::lock_guard<std::mutex> lock(pullresp_mu_);
-  auto& stored = store_[key];
-  CHECK(stored.tensor) << "init " << key << " first";
+  if (type.requestType == RequestType::kCompressedPushPull) {
+    CHECK(compress_pull_) << "compressed pull of key " << key
+                          << " requires BYTEPS_COMPRESS_PULL on the servers";
+    // asynchronous training has no merge step to compress the data, so it
+    // is compressed for each pull. The caller holds handle_mu_ of this key's
+    // stripe.
+    if (!sync_mode_) CompressForPull(key, tensor, len);
+    auto& compressed = GetCompressedBuf(key);
+    tensor = compressed.tensor;
+    len = compressed.len;
+  }
+  auto stripe = GetStripeID(key);
+  std::lock_guard<std::mutex> lock(pullresp_mu_[stripe]);
+  CHECK(tensor) << "init " << key << " first";
   // as server returns when store_realt is ready in this case
-  auto len = stored.len;
+  auto& response_map = pull_response_map_[stripe];
   // send pull response
-  auto iterator = pull_response_map_.find(key);
-  if (iterator == pull_response_map_.end()) { // new key
+  auto iterator = response_map.find(key);
+  if (iterator == response_map.end()) { // new key
     ps::KVPairs<char> response;
     response.keys = {EncodeKey(key)};
     response.lens = {len};
-    response.vals = ps::SArray<char>(stored.tensor, len, false); // zero copy
-    pull_response_map_[key] = response; // add to the map
-    server->Response(req_meta, response);
+    response.vals = ps::SArray<char>(tensor, len, false); // zero copy
+    response_map[key] = response; // add to the map
+    SendResponse(req_meta, response, server);
   } else { // not new key, then reuse the memory address to avoid ibv_reg_mr on RDMA data path
     ps::KVPairs<char> *response = &iterator->second;
     // keys and lens remain unchanged, just update vals
-    auto p = static_cast<char*>(stored.tensor);
+    auto p = static_cast<char*>(tensor);
     CHECK(p);
     response->vals = ps::SArray<char>(p, len, false); 
-    server->Response(req_meta, *response);
+    SendResponse(req_meta, *response, server);
+  }
+}
+
+// Copies the data of the first push of a round into the merged buffer,
+// compressed pushes are decompressed into float32
+void CopyFirstRecv(const DataHandleType& type, void* dst, void* src,
+                   size_t len) {
+  if (type.requestType == RequestType::kCompressedPushPull) {
+    CHECK_GE(bps_reducer_->decompress(dst, src, len, false), 0);
+  } else {
+    CHECK_GE(bps_reducer_->copy(dst, src, len), 0);
+  }
+}
+
+// Accumulates a pushed payload into dst
+void SumRecv(const DataHandleType& type, void* dst, void* src, size_t len) {
+  if (type.requestType == RequestType::kCompressedPushPull) {
+    CHECK_GE(bps_reducer_->decompress(dst, src, len, true), 0);
+  } else {
+    CHECK_GE(bps_reducer_->sum(dst, src, len,
+                               bps_reducer_->GetDataType(type.dtype)), 0);
+  }
+}
+
+// Moves the merged data of a finished round into the store. Keys pushed with
+// kServerOptimizerPushPull carry the initial weights in their first round and
+// gradients afterwards, which are applied to the stored weights.
+void CopyMergedToStore(const DataHandleType& type, uint64_t key,
+                       char* stored, char* merged, size_t len) {
+  if (type.requestType == RequestType::kCompressedPushPull) {
+    bps_reducer_->copy(stored, merged, len);
+    if (compress_pull_) CompressForPull(key, stored, len);
+    return;
+  }
+  if (type.requestType != RequestType::kServerOptimizerPushPull) {
+    bps_reducer_->copy(stored, merged, len);
+    return;
+  }
+  CHECK(bps_optimizer_) << "key " << key << " asks for the server optimizer, "
+                        << "set BYTEPS_SERVER_OPTIMIZER on the servers";
+  CHECK_EQ(type.dtype, byteps::common::BYTEPS_FLOAT32)
+      << "the server optimizer only supports float32";
+  ServerOptimizerState* state;
+  {
+    std::lock_guard<std::mutex> lock(opt_state_mu_);
+    state = &opt_state_[key];
   }
+  if (!state->seeded) {
+    bps_reducer_->copy(stored, merged, len);
+    state->seeded = true;
+    return;
+  }
+  CHECK_GE(bps_optimizer_->update(stored, merged, len, &state->state), 0);
 }
 
 void BytePSServerEngineThread(int i) {
   auto& q = engine_queues_[i];
+  std::vector<BytePSEngineMessage> batch;
+  std::vector<void*> srcs;
   while (true) {
     BytePSEngineMessage msg;
     q->WaitAndPop(&msg);
@@ -105,7 +241,8 @@ void BytePSServerEngineThread(int i) {
                     << "src_addr: " << DEBUG_PRINT_TENSOR_ADDRESS(msg.src) << "\t";
         }
         LogServerTrace("start", msg.key, "copy_merged, " + std::to_string(i));
-        bps_reducer_->copy(msg.dst, msg.src, msg.len);
+        CopyMergedToStore(msg.type, msg.key, (char*) msg.dst, (char*) msg.src,
+                          msg.len);
         LogServerTrace("end", msg.key, "copy_merged, " + std::to_string(i));
         if (is_debug) {
           std::lock_guard<std::mutex> lock(debug_mu_);
@@ -122,7 +259,8 @@ void BytePSServerEngineThread(int i) {
         }
         is_push_finished_[i][msg.key] = true;
         for (auto& req_meta : q_pull_reqmeta_[i][msg.key]) {
-          SendPullResponse(msg.type, msg.key, req_meta, byteps_server_); 
+          SendPullResponse(DepairDataHandleType(req_meta.cmd), msg.key,
+                           (char*) msg.dst, msg.len, req_meta, byteps_server_);
           pull_cnt_[i][msg.key] += 1;
           if (pull_cnt_[i][msg.key] == (size_t) ps::NumWorkers()) {
             is_push_finished_[i][msg.key] = false;
@@ -132,8 +270,13 @@ void BytePSServerEngineThread(int i) {
         q_pull_reqmeta_[i][msg.key].clear();
         break;
       }
+      case COPY_FIRST: {
+        LogServerTrace("start", msg.key, "copy_first, " + std::to_string(i));
+        CopyFirstRecv(msg.type, msg.dst, msg.src, msg.len);
+        LogServerTrace("end", msg.key, "copy_first, " + std::to_string(i));
+        break;
+      }
       case SUM_RECV: {
-        auto bps_type = bps_reducer_->GetDataType(msg.type.dtype);
         if (is_debug) {
           std::lock_guard<std::mutex> lock(debug_mu_);
           LOG(INFO) << "stage: ENGINE_SUM_RECV_BEFORE \t" 
@@ -142,12 +285,26 @@ void BytePSServerEngineThread(int i) {
                     << "dst_addr: " << DEBUG_PRINT_TENSOR_ADDRESS(msg.dst) << "\t"
                     << "src_addr: " << DEBUG_PRINT_TENSOR_ADDRESS(msg.src) << "\t";
         }
-        LogServerTrace("start", msg.key, "sum, " + std::to_string(i));
-        CHECK_GE(bps_reducer_->sum(msg.dst, 
-                                  msg.src, 
-                                  msg.len, 
-                                  bps_type), 0);
-        LogServerTrace("end", msg.key, "sum, " + std::to_string(i));
+        // compressed payloads are decompressed one by one
+        if (engine_batch_size_ > 1 &&
+            msg.type.requestType != RequestType::kCompressedPushPull) {
+          q->PopMergeable(msg, engine_batch_size_ - 1, &batch);
+        }
+        if (batch.empty()) {
+          LogServerTrace("start", msg.key, "sum, " + std::to_string(i));
+          SumRecv(msg.type, msg.dst, msg.src, msg.len);
+          LogServerTrace("end", msg.key, "sum, " + std::to_string(i));
+        } else {
+          // other pushes to the same buffer are reduced in one pass
+          srcs.assign({msg.dst, msg.src});
+          for (auto& m : batch) srcs.push_back(m.src);
+          LogServerTrace("start", msg.key, "sum_batch, " + std::to_string(i));
+          CHECK_GE(bps_reducer_->sum(msg.dst, srcs.data(), srcs.size(),
+                                     msg.len, bps_reducer_->GetDataType(
+                                         msg.type.dtype)), 0);
+          LogServerTrace("end", msg.key, "sum_batch, " + std::to_string(i));
+          batch.clear();
+        }
         if (is_debug) {
           std::lock_guard<std::mutex> lock(debug_mu_);
           LOG(INFO) << "stage: ENGINE_SUM_RECV_AFTER \t" 
@@ -164,11 +321,278 @@ void BytePSServerEngineThread(int i) {
   }
 }
 
+void SendRowSparsePullResponse(uint64_t key, RowSparseBuf& buf,
+                               const ps::KVMeta& req_meta,
+                               ps::KVServer<char>* server) {
+  ps::KVPairs<char> response;
+  response.keys = {EncodeKey(key)};
+  response.lens = {(int) buf.response.size()};
+  response.vals = buf.response;
+  SendResponse(req_meta, response, server);
+  buf.pull_cnt += 1;
+  if (buf.pull_cnt == (size_t) ps::NumWorkers()) {
+    buf.ready = false;
+    buf.pull_cnt = 0;
+  }
+}
+
+// Row-sparse keys are handled by the request handler itself: pushed rows are
+// added into the store, which is cleared row by row once the summed rows of
+// a round are copied out for the pulls. The caller holds the stripe lock.
+void BytePSRowSparseHandler(const DataHandleType& type, uint64_t key,
+                            const ps::KVMeta& req_meta,
+                            const ps::KVPairs<char>& req_data,
+                            ps::KVServer<char>* server, BytePSArray& stored,
+                            UpdateBuf& updates, RowSparseBuf& buf) {
+  using byteps::common::RowSparseHeader;
+  CHECK(sync_mode_) << "row-sparse push_pull only supports synchronous training";
+  if (!req_meta.push) {
+    CHECK(stored.tensor) << "Processing pull request when the row-sparse key "
+                         << key << " has not been inited yet";
+    if (buf.ready) {
+      SendRowSparsePullResponse(key, buf, req_meta, server);
+    } else {
+      buf.pending_pulls.push_back(req_meta);
+    }
+    return;
+  }
+
+  CHECK_EQ(req_data.lens.size(), (size_t)1);
+  auto len = (size_t) req_data.lens[0];
+  auto recved = reinterpret_cast<char*>(req_data.vals.data());
+  CHECK_GE(len, sizeof(RowSparseHeader));
+  auto header = reinterpret_cast<RowSparseHeader*>(recved);
+  updates.request.push_back(req_meta);
+
+  if (!stored.tensor) {
+    // should send response after collecting all init push
+    if (updates.request.size() < (size_t) ps::NumWorkers()) return;
+    LogServerTrace("start", key, "init");
+    stored.len = (size_t) header->num_rows * header->row_len;
+    stored.dtype = type.dtype;
+    stored.tensor = (char*) calloc(stored.len, 1);
+    CHECK(stored.tensor);
+    buf.row_len = header->row_len;
+    buf.touched.assign(header->num_rows, false);
+    LogServerTrace("end", key, "init");
+    for (const auto& req : updates.request) {
+      SendPushResponse(key, req, server);
+    }
+    updates.request.clear();
+    return;
+  }
+
+  size_t num_rows = header->num_rows;
+  CHECK_EQ(header->row_len, buf.row_len);
+  CHECK_EQ(len, sizeof(RowSparseHeader) + num_rows * (sizeof(uint32_t) + buf.row_len));
+  auto ids = reinterpret_cast<uint32_t*>(recved + sizeof(RowSparseHeader));
+  auto rows = recved + sizeof(RowSparseHeader) + num_rows * sizeof(uint32_t);
+  for (size_t i = 0; i < num_rows; ++i) {
+    CHECK_LT(ids[i], buf.touched.size());
+    if (!buf.touched[ids[i]]) {
+      buf.touched[ids[i]] = true;
+      buf.rows.push_back(ids[i]);
+    }
+  }
+  LogServerTrace("start", key, "sum_rows");
+  CHECK_GE(bps_reducer_->sum_rows(stored.tensor, ids, rows, num_rows, buf.row_len,
+                                  bps_reducer_->GetDataType(stored.dtype)), 0);
+  LogServerTrace("end", key, "sum_rows");
+  SendPushResponse(key, req_meta, server);
+  if (updates.request.size() < (size_t) ps::NumWorkers()) return;
+
+  // all pushed: copy the summed rows out and clear them for the next round
+  auto row_len = buf.row_len;
+  auto n = buf.rows.size();
+  ps::SArray<char> response(sizeof(RowSparseHeader) + n * (sizeof(uint32_t) + row_len));
+  auto res_header = reinterpret_cast<RowSparseHeader*>(response.data());
+  res_header->num_rows = n;
+  res_header->row_len = row_len;
+  auto res_ids = reinterpret_cast<uint32_t*>(response.data() + sizeof(RowSparseHeader));
+  auto res_rows = response.data() + sizeof(RowSparseHeader) + n * sizeof(uint32_t);
+  for (size_t i = 0; i < n; ++i) {
+    auto row = stored.tensor + (size_t) buf.rows[i] * row_len;
+    res_ids[i] = buf.rows[i];
+    memcpy(res_rows + i * row_len, row, row_len);
+    memset(row, 0, row_len);
+    buf.touched[buf.rows[i]] = false;
+  }
+  buf.rows.clear();
+  buf.response = response;
+  buf.ready = true;
+  updates.request.clear();
+  for (auto& pull : buf.pending_pulls) {
+    SendRowSparsePullResponse(key, buf, pull, server);
+  }
+  buf.pending_pulls.clear();
+}
+
+// Answers a pull with the stored data once the pushes of this round are
+// merged, otherwise parks it for the engine
+void HandlePullRequest(const DataHandleType& type, uint64_t key,
+                       const BytePSArray& stored, const ps::KVMeta& req_meta,
+                       ps::KVServer<char>* server) {
+  // asynchronous training has no rounds, the pull gets the current data
+  if (is_engine_blocking_ || !sync_mode_) {
+    SendPullResponse(type, key, stored.tensor, stored.len, req_meta, server);
+    return;
+  }
+  auto tid = GetThreadID(key, 0);
+  std::lock_guard<std::mutex> lock(flag_mu_[tid]);
+  if (is_push_finished_[tid].find(key) == is_push_finished_[tid].end()) {
+    is_push_finished_[tid][key] = false;
+    pull_cnt_[tid][key] = 0;
+  }
+  if (is_push_finished_[tid][key]) { // push already finished
+    SendPullResponse(type, key, stored.tensor, stored.len, req_meta, server);
+    pull_cnt_[tid][key] += 1;
+    if (pull_cnt_[tid][key] == (size_t) ps::NumWorkers()) {
+      is_push_finished_[tid][key] = false;
+      pull_cnt_[tid][key] = 0;
+      // check: remain should be 0
+      auto remain = q_pull_reqmeta_[tid][key].size();
+      CHECK_EQ(remain, 0) << remain;
+    }
+  } else { // push not finished, put into the queue, and wait for the engine 
+    q_pull_reqmeta_[tid][key].push_back(req_meta);
+  }
+}
+
+// Logs the staleness counters of the workers, the caller holds
+// ssp_stats_mu_
+void LogSSPStats() {
+  for (const auto& it : ssp_stats_) {
+    const auto& stats = it.second;
+    LOG(INFO) << "SSP worker " << it.first << ": " << stats.pulls
+              << " pulls, " << stats.blocked_pulls << " blocked for "
+              << stats.blocked_ms << " ms in total, max lead "
+              << stats.max_lead << " pushes";
+  }
+}
+
+// Counts a pull of a worker that is lead pushes ahead of the slowest worker
+void RecordSSPPull(int sender, uint64_t lead, bool blocked) {
+  std::lock_guard<std::mutex> lock(ssp_stats_mu_);
+  auto& stats = ssp_stats_[ps::Postoffice::IDtoRank(sender)];
+  ++stats.pulls;
+  if (blocked) ++stats.blocked_pulls;
+  stats.max_lead = std::max(stats.max_lead, lead);
+  auto now = std::chrono::steady_clock::now();
+  if (ssp_log_interval_ > 0 &&
+      now - ssp_last_log_ >= std::chrono::seconds(ssp_log_interval_)) {
+    LogSSPStats();
+    ssp_last_log_ = now;
+  }
+}
+
+// Counts the time a blocked pull waited for the slower workers
+void RecordSSPWait(int sender, std::chrono::steady_clock::time_point since) {
+  std::chrono::duration<double, std::milli> waited =
+      std::chrono::steady_clock::now() - since;
+  std::lock_guard<std::mutex> lock(ssp_stats_mu_);
+  ssp_stats_[ps::Postoffice::IDtoRank(sender)].blocked_ms += waited.count();
+}
+
+// Number of pushes of the sender ahead of the slowest worker, the workers
+// that have not pushed yet are at 0
+uint64_t GetSSPLead(const SSPClock& clock, int sender) {
+  auto it = clock.pushes.find(sender);
+  if (it == clock.pushes.end()) return 0;
+  uint64_t slowest = 0;
+  if (clock.pushes.size() == (size_t) ps::NumWorkers()) {
+    slowest = std::numeric_limits<uint64_t>::max();
+    for (const auto& p : clock.pushes) slowest = std::min(slowest, p.second);
+  }
+  return it->second - slowest;
+}
+
+// Answers a pull unless its worker is more than BYTEPS_SSP_STALENESS pushes
+// ahead of the slowest worker, then it is parked until that one catches up.
+// The caller holds handle_mu_ of this key's stripe.
+void HandleSSPPull(const DataHandleType& type, uint64_t key,
+                   const BytePSArray& stored, const ps::KVMeta& req_meta,
+                   SSPClock& clock, ps::KVServer<char>* server) {
+  auto lead = GetSSPLead(clock, req_meta.sender);
+  bool blocked = lead > (uint64_t) ssp_staleness_;
+  RecordSSPPull(req_meta.sender, lead, blocked);
+  if (blocked) {
+    clock.pending_pulls.emplace_back(req_meta,
+                                     std::chrono::steady_clock::now());
+  } else {
+    SendPullResponse(type, key, stored.tensor, stored.len, req_meta, server);
+  }
+}
+
+// Counts a push of a key and answers the parked pulls that are within the
+// bound again. The caller holds handle_mu_ of this key's stripe.
+void AdvanceSSPClock(uint64_t key, const BytePSArray& stored,
+                     const ps::KVMeta& req_meta, SSPClock& clock,
+                     ps::KVServer<char>* server) {
+  ++clock.pushes[req_meta.sender];
+  auto& pending = clock.pending_pulls;
+  size_t kept = 0;
+  for (size_t i = 0; i < pending.size(); ++i) {
+    const auto& req = pending[i].first;
+    if (GetSSPLead(clock, req.sender) > (uint64_t) ssp_staleness_) {
+      if (kept != i) pending[kept] = pending[i];
+      ++kept;
+      continue;
+    }
+    RecordSSPWait(req.sender, pending[i].second);
+    SendPullResponse(DepairDataHandleType(req.cmd), key, stored.tensor,
+                     stored.len, req, server);
+  }
+  pending.erase(pending.begin() + kept, pending.end());
+}
+
+void BytePSHandler(const ps::KVMeta& req_meta,
+                   const ps::KVPairs<char> &req_data, ps::KVServer<char>* server);
+
+// Handles the keys of a multi-key request one by one. All keys share the
+// command of the request.
+void BytePSBatchHandler(const ps::KVMeta& req_meta,
+                        const ps::KVPairs<char> &req_data,
+                        ps::KVServer<char>* server) {
+  auto n = req_data.keys.size();
+  {
+    std::lock_guard<std::mutex> lock(batch_mu_);
+    auto& batch = batch_responses_[GetBatchID(req_meta)];
+    CHECK(batch.responses.empty()) << "duplicated request from "
+                                   << req_meta.sender;
+    for (size_t i = 0; i < n; ++i) batch.index[req_data.keys[i]] = i;
+    CHECK_EQ(batch.index.size(), n) << "duplicated keys in one request";
+    batch.responses.resize(n);
+    batch.remaining = n;
+    ++batch_pending_;
+  }
+  if (req_meta.push) CHECK_EQ(req_data.lens.size(), n);
+  size_t offset = 0;
+  for (size_t i = 0; i < n; ++i) {
+    ps::KVPairs<char> data;
+    data.keys = req_data.keys.segment(i, i + 1);
+    if (req_meta.push) {
+      size_t len = req_data.lens[i];
+      data.lens = req_data.lens.segment(i, i + 1);
+      data.vals = req_data.vals.segment(offset, offset + len);
+      offset += len;
+    }
+    BytePSHandler(req_meta, data, server);
+  }
+  if (req_meta.push) CHECK_EQ(offset, req_data.vals.size());
+}
+
 void BytePSHandler(const ps::KVMeta& req_meta,
                    const ps::KVPairs<char> &req_data, ps::KVServer<char>* server) {
-  std::lock_guard<std::mutex> lock(handle_mu_); // push & pull may have racing
+  if (req_data.keys.size() > 1) {
+    BytePSBatchHandler(req_meta, req_data, server);
+    return;
+  }
   DataHandleType type = DepairDataHandleType(req_meta.cmd);
-  CHECK_EQ(type.requestType, RequestType::kDefaultPushPull); 
+  CHECK(type.requestType == RequestType::kDefaultPushPull ||
+        type.requestType == RequestType::kRowSparsePushPull ||
+        type.requestType == RequestType::kCompressedPushPull ||
+        type.requestType == RequestType::kServerOptimizerPushPull)
+      << "unsupported request type " << (int) type.requestType;
   // do some check
   CHECK_EQ(req_data.keys.size(), (size_t)1);
   if (log_key_info_) {
@@ -186,19 +610,38 @@ void BytePSHandler(const ps::KVMeta& req_meta,
     }
   }
   uint64_t key = DecodeKey(req_data.keys[0]);
+  // push & pull of the same key may have racing
+  auto stripe = GetStripeID(key);
+  std::lock_guard<std::mutex> lock(handle_mu_[stripe]);
+  auto& store = store_[stripe];
+  auto& update_buf = update_buf_[stripe];
+  if (type.requestType == RequestType::kRowSparsePushPull) {
+    BytePSRowSparseHandler(type, key, req_meta, req_data, server, store[key],
+                           update_buf[key], row_sparse_buf_[stripe][key]);
+    return;
+  }
   if (req_meta.push) { // push request
     CHECK_EQ(req_data.lens.size(), (size_t)1);
     CHECK_EQ(req_data.vals.size(), (size_t)req_data.lens[0]);
-    auto& stored = store_[key];
+    auto& stored = store[key];
     auto len = (size_t) req_data.lens[0];
     auto recved = reinterpret_cast<char*>(req_data.vals.data());
+    if (req_meta.pull) {
+      CHECK(sync_mode_ && !is_engine_blocking_)
+          << "push-and-pull requests need synchronous training and the "
+          << "non-blocking engine";
+      CHECK(type.requestType != RequestType::kCompressedPushPull)
+          << "compressed pushes cannot be answered with the merged data";
+      CHECK(stored.tensor) << "push-and-pull of key " << key
+                           << " before its init push";
+    }
     if (!stored.tensor) {
-      if (sync_mode_ && (update_buf_.find(key) == update_buf_.end())) {
-        update_buf_[key].merged.len = len;
-        update_buf_[key].merged.dtype = type.dtype;
+      if (sync_mode_ && (update_buf.find(key) == update_buf.end())) {
+        update_buf[key].merged.len = len;
+        update_buf[key].merged.dtype = type.dtype;
       }
       // buffer the request meta
-      auto &updates = update_buf_[key];
+      auto &updates = update_buf[key];
       updates.request.push_back(req_meta);
       // should send response after collecting all init push
       if (updates.request.size() < (size_t) ps::NumWorkers()) return;
@@ -207,6 +650,7 @@ void BytePSHandler(const ps::KVMeta& req_meta,
                   << " requests for key=" << key
                   << ", init the store buffer size=" << (size_t) req_data.lens[0];
       }
+      // init pushes are never compressed
       LogServerTrace("start", key, "init");
       // initialization
       stored.tensor = (char*) malloc(len); 
@@ -220,14 +664,31 @@ void BytePSHandler(const ps::KVMeta& req_meta,
       }
       updates.request.clear();
     } else {
-      auto &updates = update_buf_[key];
-      auto tid = GetThreadID(key, len);
+      auto &updates = update_buf[key];
+      auto tid = GetThreadID(key, stored.len);
+      bool is_compressed = (type.requestType == RequestType::kCompressedPushPull);
+      if (is_compressed) {
+        auto& compressed = GetCompressedBuf(key);
+        if (compressed.method == byteps::common::COMPRESS_NONE) {
+          auto header = reinterpret_cast<byteps::common::CompressHeader*>(recved);
+          compressed.method = header->method;
+          compressed.k = header->k;
+        }
+      }
       if (updates.request.empty()) { // from the first incoming worker
         if (sync_mode_) {
+          if (is_compressed && !updates.merged.tensor) {
+            // decompressed into a float32 buffer, no zero copy
+            updates.merged.tensor = (char*) malloc(stored.len);
+            CHECK(updates.merged.tensor);
+          }
           if (is_engine_blocking_) {
             LogServerTrace("start", key, "copy_first");
-            bps_reducer_->copy(updates.merged.tensor, recved, len);
+            CopyFirstRecv(type, updates.merged.tensor, recved, len);
             LogServerTrace("end", key, "copy_first");
+          } else if (is_compressed) {
+            BytePSEngineMessage msg = {timestamp_++, type, key, updates.merged.tensor, recved, len, COPY_FIRST, req_data, req_meta};
+            engine_queues_[tid]->Push(msg);
           } else { // non-blocking
             if (debug_mode_ && (debug_key_ == key)) {
               std::lock_guard<std::mutex> lock(debug_mu_);  
@@ -246,10 +707,7 @@ void BytePSHandler(const ps::KVMeta& req_meta,
         } else { // async mode, directly add to the buffer
           if (is_engine_blocking_) {
             LogServerTrace("start", key, "sum");
-            CHECK_GE(bps_reducer_->sum((void *) stored.tensor, 
-                                      (void *) recved, 
-                                      len, 
-                                      bps_reducer_->GetDataType(stored.dtype)), 0);
+            SumRecv(type, stored.tensor, recved, len);
             LogServerTrace("end", key, "sum");
           } else {
             BytePSEngineMessage msg = {timestamp_++, type, key, stored.tensor, recved, len, SUM_RECV, req_data};
@@ -261,10 +719,7 @@ void BytePSHandler(const ps::KVMeta& req_meta,
         CHECK(updates.merged.tensor);
         if (is_engine_blocking_) {
           LogServerTrace("start", key, "sum");
-          CHECK_GE(bps_reducer_->sum((void *) updates.merged.tensor, 
-                                    (void *) recved, 
-                                    len, 
-                                    bps_reducer_->GetDataType(updates.merged.dtype)), 0);
+          SumRecv(type, updates.merged.tensor, recved, len);
           LogServerTrace("end", key, "sum");
         } else { // non-blocking
           if (debug_mode_ && (debug_key_ == key)) {
@@ -282,13 +737,19 @@ void BytePSHandler(const ps::KVMeta& req_meta,
       }
       // add a worker information (request.size() is the # workers received)
       updates.request.push_back(req_meta);
-      SendPushResponse(key, req_meta, server);
+      if (req_meta.pull) {
+        // push-and-pull: answered with the merged data like a pull
+        HandlePullRequest(type, key, stored, req_meta, server);
+      } else {
+        SendPushResponse(key, req_meta, server);
+      }
       if (sync_mode_ && updates.request.size() == (size_t) ps::NumWorkers()) {
-        auto& stored = store_[key];
+        auto& stored = store[key];
         auto& update = updates.merged;
         if (is_engine_blocking_) {
           LogServerTrace("start", key, "copy_merged");
-          bps_reducer_->copy(stored.tensor, updates.merged.tensor, len);
+          CopyMergedToStore(type, key, stored.tensor, updates.merged.tensor,
+                            stored.len);
           LogServerTrace("end", key, "copy_merged");
         } else {
           if (debug_mode_ && (debug_key_ == key)) {
@@ -298,7 +759,7 @@ void BytePSHandler(const ps::KVMeta& req_meta,
                       << "merged: " << DEBUG_PRINT_TENSOR_VALUE(updates.merged.tensor) << "\t"
                       << "recved: " << DEBUG_PRINT_TENSOR_VALUE(recved);
           }
-          BytePSEngineMessage msg = {timestamp_++, type, key, stored.tensor, update.tensor, len, COPY_MERGED};
+          BytePSEngineMessage msg = {timestamp_++, type, key, stored.tensor, update.tensor, stored.len, COPY_MERGED};
           engine_queues_[tid]->Push(msg);
           engine_queues_[tid]->ClearCounter(key);
         }
@@ -307,34 +768,21 @@ void BytePSHandler(const ps::KVMeta& req_meta,
         // async: clean the request buffer 
         updates.request.clear();
         engine_queues_[tid]->ClearCounter(key);
+        if (ssp_staleness_ >= 0) {
+          AdvanceSSPClock(key, stored, req_meta, ssp_clock_[stripe][key],
+                          server);
+        }
       }
     }
   } else { // pull request
-    auto& stored = store_[key];
+    auto& stored = store[key];
     CHECK(stored.tensor) << "Processing pull request when the NDArray of key " 
                << key << " has not been inited yet, which is not expected.";
-    if (is_engine_blocking_) {
-      SendPullResponse(type, key, req_meta, server);
+    if (ssp_staleness_ >= 0) {
+      HandleSSPPull(type, key, stored, req_meta, ssp_clock_[stripe][key],
+                    server);
     } else {
-      auto tid = GetThreadID(key, 0);
-      std::lock_guard<std::mutex> lock(flag_mu_[tid]);
-      if (is_push_finished_[tid].find(key) == is_push_finished_[tid].end()) {
-        is_push_finished_[tid][key] = false;
-        pull_cnt_[tid][key] = 0;
-      }
-      if (is_push_finished_[tid][key]) { // push already finished
-        SendPullResponse(type, key, req_meta, server); 
-        pull_cnt_[tid][key] += 1;
-        if (pull_cnt_[tid][key] == (size_t) ps::NumWorkers()) {
-          is_push_finished_[tid][key] = false;
-          pull_cnt_[tid][key] = 0;
-          // check: remain should be 0
-          auto remain = q_pull_reqmeta_[tid][key].size();
-          CHECK_EQ(remain, 0) << remain;
-        }
-      } else { // push not finished, put into the queue, and wait for the engine 
-        q_pull_reqmeta_[tid][key].push_back(req_meta);
-      }
+      HandlePullRequest(type, key, stored, req_meta, server);
     }
   }
 }
@@ -347,6 +795,16 @@ void init_global_env() {
   sync_mode_ = GetEnv("BYTEPS_ENABLE_ASYNC", true);
   if (!sync_mode_) LOG(INFO) << "BytePS server is enabled asynchronous training";
 
+  // stale-synchronous training: max number of pushes a worker may be ahead
+  // of the slowest one before its pulls block, disabled if negative
+  ssp_staleness_ = GetEnv("BYTEPS_SSP_STALENESS", -1);
+  ssp_log_interval_ = GetEnv("BYTEPS_SSP_LOG_INTERVAL", 60);
+  if (ssp_staleness_ >= 0) {
+    CHECK(!sync_mode_) << "BYTEPS_SSP_STALENESS requires BYTEPS_ENABLE_ASYNC";
+    LOG(INFO) << "BytePS server is enabled stale-synchronous training "
+              << "with staleness " << ssp_staleness_;
+  }
+
   // debug mode
   debug_mode_ = GetEnv("BYTEPS_SERVER_DEBUG", false);
   debug_key_ = GetEnv("BYTEPS_SERVER_DEBUG_KEY", 0);
@@ -366,6 +824,30 @@ void init_global_env() {
   // enable scheduling for server engine
   enable_schedule_ = GetEnv("BYTEPS_SERVER_ENABLE_SCHEDULE", false);
   if (enable_schedule_) LOG(INFO) << "Enable engine scheduling for BytePS server";
+
+  // number of spins before an idle engine thread sleeps on its queue
+  engine_spin_count_ = GetEnv("BYTEPS_SERVER_ENGINE_SPIN_COUNT", 0);
+  CHECK_GE(engine_spin_count_, 0);
+
+  // max number of pushes of a key that an engine thread sums in one pass
+  engine_batch_size_ = GetEnv("BYTEPS_SERVER_ENGINE_BATCH", 8);
+  CHECK_GE(engine_batch_size_, 1);
+
+  // number of lock stripes for the request handler
+  handle_stripe_num_ = GetEnv("BYTEPS_SERVER_HANDLE_STRIPES", 64);
+  CHECK_GE(handle_stripe_num_, 1);
+
+  // send the recompressed merged data to compressed pulls
+  compress_pull_ = GetEnv("BYTEPS_COMPRESS_PULL", false);
+  if (compress_pull_) LOG(INFO) << "Enable compression for pull responses";
+
+  // optimizer applied on the servers, workers then pull the weights
+  auto optimizer = getenv("BYTEPS_SERVER_OPTIMIZER");
+  if (optimizer && strlen(optimizer)) {
+    CHECK(sync_mode_) << "BYTEPS_SERVER_OPTIMIZER requires synchronous training";
+    bps_optimizer_ = new byteps::common::CpuOptimizer(std::string(optimizer));
+    LOG(INFO) << "Enable server-side optimizer " << optimizer;
+  }
 }
 
 extern "C" void byteps_server() {
@@ -388,12 +870,26 @@ extern "C" void byteps_server() {
   CHECK_EQ(q_pull_reqmeta_.size(), engine_thread_num_);
   CHECK_EQ(pull_cnt_.size(), engine_thread_num_);
 
+  // striped locks and their protected maps
+  std::vector<std::mutex> tmp_handlemu(handle_stripe_num_);
+  std::vector<std::mutex> tmp_pullrespmu(handle_stripe_num_);
+  handle_mu_.swap(tmp_handlemu);
+  pullresp_mu_.swap(tmp_pullrespmu);
+  store_.resize(handle_stripe_num_);
+  update_buf_.resize(handle_stripe_num_);
+  push_response_map_.resize(handle_stripe_num_);
+  row_sparse_buf_.resize(handle_stripe_num_);
+  ssp_clock_.resize(handle_stripe_num_);
+  ssp_last_log_ = std::chrono::steady_clock::now();
+  pull_response_map_.resize(handle_stripe_num_);
+  hash_cache_.resize(handle_stripe_num_);
+
   // init the engine
   for (size_t i = 0; i < engine_thread_num_; ++i) {
     acc_load_.push_back(0);
   }
   for (size_t i = 0; i < engine_thread_num_; ++i) {
-    auto q = new PriorityQueue(enable_schedule_);
+    auto q = new PriorityQueue(enable_schedule_, engine_spin_count_);
     engine_queues_.push_back(q);
   }
   for (size_t i = 0; i < engine_thread_num_; ++i) {
@@ -420,12 +916,26 @@ extern "C" void byteps_server() {
     delete bps_reducer_;
     bps_reducer_ = nullptr;
   }
+  if (ssp_staleness_ >= 0) {
+    std::lock_guard<std::mutex> lock(ssp_stats_mu_);
+    LogSSPStats();
+  }
   BytePSEngineMessage msg;
   msg.ops = TERMINATE;
   for (auto q : engine_queues_) q->Push(msg);
   for (auto t : engine_threads_) t->join();
-  for (auto& it : store_) free(it.second.tensor);
-  for (auto& it : update_buf_) free(it.second.merged.tensor);
+  for (auto& stripe : store_) {
+    for (auto& it : stripe) free(it.second.tensor);
+  }
+  for (auto& stripe : update_buf_) {
+    for (auto& it : stripe) free(it.second.merged.tensor);
+  }
+  for (auto& it : compressed_) free(it.second.tensor);
+  if (bps_optimizer_) {
+    for (auto& it : opt_state_) bps_optimizer_->freeState(&it.second.state);
+    delete bps_optimizer_;
+    bps_optimizer_ = nullptr;
+  }
   LOG(INFO) << "byteps has been shutdown";
 
   return;
@@ -16,10 +16,13 @@
 #ifndef BYTEPS_SERVER_H
 #define BYTEPS_SERVER_H
 
+#include <atomic>
 #include <chrono>
 #include <cmath>
 #include <cstdlib>
+#include <map>
 #include "ps/ps.h"
+#include "../common/cpu_optimizer.h"
 #include "../common/cpu_reducer.h"
 
 namespace byteps {
@@ -33,11 +36,12 @@ namespace server {
 using namespace ps;
 
 enum class RequestType {
-  kDefaultPushPull, kRowSparsePushPull, kCompressedPushPull
+  kDefaultPushPull, kRowSparsePushPull, kCompressedPushPull,
+  kServerOptimizerPushPull
 };
 
 enum BytePSEngineOperation {
-  SUM_RECV, COPY_MERGED, TERMINATE
+  SUM_RECV, COPY_FIRST, COPY_MERGED, TERMINATE
 };
 
 struct PSKV {
@@ -62,6 +66,57 @@ struct UpdateBuf {
   BytePSArray merged;
 };
 
+struct ServerOptimizerState {
+  // the first round of a key carries the initial weights, not gradients
+  bool seeded = false;
+  byteps::common::OptimizerState state;
+};
+
+struct CompressedBuf {
+  // method and k of the pushes, reused to recompress the merged data
+  int method = byteps::common::COMPRESS_NONE;
+  size_t k = 0;
+  char* tensor = nullptr;
+  size_t len = 0;
+};
+
+struct RowSparseBuf {
+  size_t row_len = 0;
+  // rows pushed in this round, flagged to keep each row once
+  std::vector<uint32_t> rows;
+  std::vector<bool> touched;
+  // summed rows of the last round, sent to the pulls
+  ps::SArray<char> response;
+  bool ready = false;
+  size_t pull_cnt = 0;
+  std::vector<ps::KVMeta> pending_pulls;
+};
+
+// Stale-synchronous training (BYTEPS_SSP_STALENESS): the pushes of each
+// worker to a key are its clock, pulls of a worker that is too far ahead of
+// the slowest one are parked until it catches up
+struct SSPClock {
+  std::unordered_map<int, uint64_t> pushes;  // by sender
+  std::vector<std::pair<ps::KVMeta,
+      std::chrono::steady_clock::time_point> > pending_pulls;
+};
+
+// staleness counters of a worker, over all keys of this server
+struct SSPStats {
+  uint64_t pulls = 0;
+  uint64_t blocked_pulls = 0;
+  uint64_t max_lead = 0;
+  double blocked_ms = 0;
+};
+
+// A request with several keys is handled key by key, its response is sent
+// once all keys are answered
+struct BatchResponse {
+  std::unordered_map<ps::Key, size_t> index;  // position of each key
+  std::vector<ps::KVPairs<char> > responses;
+  size_t remaining;
+};
+
 struct BytePSEngineMessage {
   uint64_t id;
   DataHandleType type;
@@ -91,9 +146,6 @@ static DataHandleType DepairDataHandleType(int cmd) {
 KVServer<SERVER_DATA_TYPE>* byteps_server_;
 byteps::common::CpuReducer* bps_reducer_;
 std::unordered_map<SERVER_KEY_TYPE, KVPairs<SERVER_DATA_TYPE> > mem_map_;
-std::mutex pullresp_mu_;
-std::unordered_map<uint64_t, ps::KVPairs<char> > push_response_map_;
-std::unordered_map<uint64_t, ps::KVPairs<char> > pull_response_map_;
 
 // push & pull flag 
 std::vector<std::mutex> flag_mu_; 
@@ -101,24 +153,61 @@ std::vector<std::unordered_map<uint64_t, bool> > is_push_finished_;
 std::vector<std::unordered_map<uint64_t, std::vector<ps::KVMeta> > > q_pull_reqmeta_;
 std::vector<std::unordered_map<uint64_t, size_t> > pull_cnt_;
 
-// address map 
-std::mutex handle_mu_;
-std::unordered_map<uint64_t, BytePSArray> store_; 
-std::unordered_map<uint64_t, UpdateBuf> update_buf_;
+// address map, striped by key so that requests of unrelated keys
+// do not serialize on a single lock
+size_t handle_stripe_num_ = 64;
+std::vector<std::mutex> handle_mu_;
+std::vector<std::unordered_map<uint64_t, BytePSArray> > store_;
+std::vector<std::unordered_map<uint64_t, UpdateBuf> > update_buf_;
+std::vector<std::unordered_map<uint64_t, ps::KVPairs<char> > > push_response_map_;
+std::vector<std::unordered_map<uint64_t, RowSparseBuf> > row_sparse_buf_;
+std::vector<std::unordered_map<uint64_t, SSPClock> > ssp_clock_;
 
-// hash function
+// pull responses are also sent by the engine threads, so they have their own
+// (striped) lock which is always taken last
+std::vector<std::mutex> pullresp_mu_;
+std::vector<std::unordered_map<uint64_t, ps::KVPairs<char> > > pull_response_map_;
+
+// responses of pending multi-key requests, by sender and timestamp
+std::mutex batch_mu_;
+std::unordered_map<uint64_t, BatchResponse> batch_responses_;
+std::atomic<size_t> batch_pending_{0};
+
+// server-side optimizer (BYTEPS_SERVER_OPTIMIZER), the lock only protects
+// the map: updates of a key are serialized by the push protocol
+byteps::common::CpuOptimizer* bps_optimizer_ = nullptr;
+std::mutex opt_state_mu_;
+std::unordered_map<uint64_t, ServerOptimizerState> opt_state_;
+
+// recompressed data of kCompressedPushPull keys for pulls
+// (BYTEPS_COMPRESS_PULL), the lock only protects the map
+std::mutex compressed_mu_;
+std::unordered_map<uint64_t, CompressedBuf> compressed_;
+
+// staleness counters of stale-synchronous training, by worker rank
+std::mutex ssp_stats_mu_;
+std::map<int, SSPStats> ssp_stats_;
+std::chrono::steady_clock::time_point ssp_last_log_;
+
+// engine thread of each key, striped like store_ and protected by handle_mu_.
+// hash_mu_ is only taken to place a new key by the accumulated load.
+std::vector<std::unordered_map<uint64_t, size_t> > hash_cache_;
 std::mutex hash_mu_;
-std::unordered_map<uint64_t, size_t> hash_cache_;
 std::vector<uint64_t> acc_load_; // accumulated tensor size for an engine thread 
 
 // global knob
-uint64_t timestamp_ = 0;
+std::atomic<uint64_t> timestamp_{0};
 size_t engine_thread_num_ = 4;
 volatile bool is_engine_blocking_ = false;
 volatile bool log_key_info_ = false;
 volatile bool sync_mode_ = true;
 volatile bool debug_mode_ = false;
 volatile bool enable_schedule_ = false;
+volatile bool compress_pull_ = false;
+int engine_spin_count_ = 0;
+size_t engine_batch_size_ = 8;
+int ssp_staleness_ = -1;
+int ssp_log_interval_ = 60;
 
 // debug
 uint64_t debug_key_;
@@ -135,16 +224,30 @@ uint64_t EncodeKey(ps::Key key) {
   return key + kr.begin();
 }
 
+size_t GetStripeID(uint64_t key) {
+  // keys are (declared_key << 16) + partition_id, so mix the bits before
+  // taking the modulo, otherwise most keys land in the same stripe
+  return ((key * 0x9E3779B97F4A7C15ULL) >> 32) % handle_stripe_num_;
+}
+
+CompressedBuf& GetCompressedBuf(uint64_t key) {
+  std::lock_guard<std::mutex> lock(compressed_mu_);
+  return compressed_[key];
+}
+
+// The caller holds handle_mu_ of this key's stripe
 size_t GetThreadID(uint64_t key, size_t len) {
-  std::lock_guard<std::mutex> lock(hash_mu_);
+  auto& cache = hash_cache_[GetStripeID(key)];
+  auto it = cache.find(key);
   if (len == 0) { // pull
-    CHECK_NE(hash_cache_.find(key), hash_cache_.end());
-    return hash_cache_[key];
+    CHECK(it != cache.end());
+    return it->second;
   }
-  if (hash_cache_.find(key) != hash_cache_.end()) {
-    return hash_cache_[key];
+  if (it != cache.end()) {
+    return it->second;
   }
   CHECK_GT(len, 0);
+  std::lock_guard<std::mutex> lock(hash_mu_);
   CHECK_EQ(acc_load_.size(), engine_thread_num_);
   auto min_index = -1;
   auto min_load = std::numeric_limits<uint64_t>::max();
@@ -157,8 +260,8 @@ size_t GetThreadID(uint64_t key, size_t len) {
   CHECK_GE(min_index, 0);
   CHECK_LT(min_index, engine_thread_num_);
   acc_load_[min_index] += len;
-  hash_cache_[key] = min_index;
-  return hash_cache_[key];
+  cache[key] = min_index;
+  return min_index;
 }
 
 extern "C" void byteps_server();
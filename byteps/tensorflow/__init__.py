@@ -21,7 +21,7 @@ from __future__ import division
 from __future__ import print_function
 
 from byteps.tensorflow.compression import Compression
-from byteps.tensorflow.ops import broadcast, _push_pull
+from byteps.tensorflow.ops import broadcast, _push_pull, _push_pull_row_sparse
 from byteps.tensorflow.ops import init, shutdown
 from byteps.tensorflow.ops import size, local_size, rank, local_rank
 from byteps.tensorflow.util import _executing_eagerly
@@ -46,8 +46,28 @@ def push_pull(tensor, scope='', average=True, device_dense='', device_sparse='',
                      using compression.
     Returns:
         A tensor of the same shape and type as `tensor`, summed across all
-        processes.
+        processes. In synchronous training with one BytePS process per worker
+        machine, a tf.IndexedSlices with a known dense shape only sends its
+        rows, and a tf.IndexedSlices holding every row sent by any process is
+        returned. Otherwise it is reduced as a dense tensor.
     """
+    if (isinstance(tensor, tf.IndexedSlices) and local_size() == 1 and
+            tensor.dense_shape is not None and not enable_async):
+        with tf.device(device_sparse):
+            # the rows of each index are sent once
+            indices, positions = tf.unique(tensor.indices)
+            values = tf.unsorted_segment_sum(tensor.values, positions,
+                                             tf.size(indices))
+            dense_shape = tensor.dense_shape
+            summed_indices, summed_values = _push_pull_row_sparse(
+                tf.cast(indices, tf.int64), values,
+                tf.cast(dense_shape, tf.int64), scope)
+            if average:
+                summed_values = tf.div(summed_values,
+                                       tf.cast(size(), dtype=values.dtype))
+        return tf.IndexedSlices(summed_values, summed_indices,
+                                dense_shape=dense_shape)
+
     with tf.device(device_dense):
         byteps_size = tf.cast(size(), dtype=tensor.dtype)
         tensor_compressed, ctx = compression.compress(tensor)
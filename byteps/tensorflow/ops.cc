@@ -14,6 +14,7 @@
 // limitations under the License.
 // =============================================================================
 
+#include <cstring>
 #include <memory>
 #include <queue>
 #include <thread>
@@ -71,6 +72,8 @@ const common::DataType ConvertDType(int dtype) {
       return common::BYTEPS_INT64;
     case ::tensorflow::DT_HALF:
       return common::BYTEPS_FLOAT16;
+    case ::tensorflow::DT_BFLOAT16:
+      return common::BYTEPS_BFLOAT16;
     case ::tensorflow::DT_FLOAT:
       return common::BYTEPS_FLOAT32;
     case ::tensorflow::DT_DOUBLE:
@@ -140,12 +143,6 @@ void StartTask(::tensorflow::OpKernelContext* context,
                std::shared_ptr<common::ReadyEvent> ready_event) {
   auto& byteps_context = common::GetContextFromName(node_name);
   auto device = GetDeviceID(context);
-  auto size = byteps_input->size();
-  auto dtype = byteps_input->dtype();
-  void* cpubuff = (device == CPU_DEVICE_ID)
-                      ? const_cast<void*>(byteps_input->data())
-                      : nullptr;
-  common::InitTensor(byteps_context, size, dtype, cpubuff);
 
   auto queue_list = common::GetPushQueueList(device);
   auto queue_list_pull = common::GetPullQueueList(device);
@@ -188,9 +185,15 @@ class BytePSPushPullOp : public ::tensorflow::AsyncOpKernel {
     if (bps_context.initialized) {
       StartTask(context, done, node_name, bps_input, bps_output, ready_event);
     } else {
-      std::thread t(StartTask, context, done, node_name, bps_input, bps_output,
-                    ready_event);
-      t.detach();
+      void* cpubuff = (GetDeviceID(context) == CPU_DEVICE_ID)
+                          ? const_cast<void*>(bps_input->data())
+                          : nullptr;
+      common::InitTensorAsync(
+          bps_context, bps_input->size(), bps_input->dtype(), cpubuff,
+          [context, done, node_name, bps_input, bps_output, ready_event]() {
+            StartTask(context, done, node_name, bps_input, bps_output,
+                      ready_event);
+          });
     }
   }
 };
@@ -201,7 +204,7 @@ REGISTER_KERNEL_BUILDER(Name("BytepsPushPull").Device(::tensorflow::DEVICE_GPU),
                         BytePSPushPullOp);
 
 REGISTER_OP("BytepsPushPull")
-    .Attr("T: {int32, int64, float16, float32, float64}")
+    .Attr("T: {int32, int64, float16, bfloat16, float32, float64}")
     .Input("tensor: T")
     .Output("sum: T")
     .SetShapeFn([](::tensorflow::shape_inference::InferenceContext* c) {
@@ -219,5 +222,117 @@ Output
     sum:    A tensor with the same shape as `tensor`, summed across all processes.
 )doc");
 
+void StartRowSparseTask(::tensorflow::OpKernelContext* context,
+                        ::tensorflow::AsyncOpKernel::DoneCallback done,
+                        std::string node_name, ::tensorflow::Tensor indices,
+                        ::tensorflow::Tensor values, int64_t num_rows) {
+  auto& byteps_context = common::GetContextFromName(node_name);
+  auto dtype = ConvertDType(values.dtype());
+  auto values_shape = values.shape();
+  size_t row_len = ::tensorflow::DataTypeSize(values.dtype());
+  for (int i = 1; i < values_shape.dims(); ++i) {
+    row_len *= values_shape.dim_size(i);
+  }
+  common::InitRowSparseTensor(byteps_context, num_rows, row_len, dtype);
+
+  auto enqueue_result = common::EnqueueRowSparseTensor(
+      byteps_context, indices.flat<::tensorflow::int64>().data(),
+      values.tensor_data().data(), values_shape.dim_size(0), dtype,
+      [context, done, values_shape](
+          const common::Status& status,
+          std::shared_ptr<common::RowSparseData> data) mutable {
+        OP_REQUIRES_OK_ASYNC(context, ConvertStatus(status), done);
+        int64_t n = data->indices.size();
+        ::tensorflow::Tensor* out_indices;
+        OP_REQUIRES_OK_ASYNC(
+            context,
+            context->allocate_output(0, ::tensorflow::TensorShape({n}),
+                                     &out_indices),
+            done);
+        values_shape.set_dim(0, n);
+        ::tensorflow::Tensor* out_values;
+        OP_REQUIRES_OK_ASYNC(
+            context, context->allocate_output(1, values_shape, &out_values),
+            done);
+        if (n) {
+          memcpy(out_indices->flat<::tensorflow::int64>().data(),
+                 data->indices.data(), n * sizeof(int64_t));
+          memcpy(const_cast<char*>(out_values->tensor_data().data()),
+                 data->values.data(), data->values.size());
+        }
+        done();
+      });
+  OP_REQUIRES_OK_ASYNC(context, ConvertStatus(enqueue_result), done);
+}
+
+class BytePSPushPullRowSparseOp : public ::tensorflow::AsyncOpKernel {
+ public:
+  explicit BytePSPushPullRowSparseOp(
+      ::tensorflow::OpKernelConstruction* context)
+      : AsyncOpKernel(context) {}
+
+  void ComputeAsync(::tensorflow::OpKernelContext* context,
+                    DoneCallback done) override {
+    OP_REQUIRES_OK_ASYNC(context, ConvertStatus(common::CheckInitialized()),
+                         done);
+
+    auto indices = context->input(0);
+    auto values = context->input(1);
+    auto dense_shape = context->input(2);
+    OP_REQUIRES_ASYNC(
+        context, values.dims() > 0 && dense_shape.NumElements() > 0 &&
+                     indices.NumElements() == values.dim_size(0),
+        ::tensorflow::errors::InvalidArgument(
+            "indices must have one entry per row of values"),
+        done);
+    int64_t num_rows = dense_shape.flat<::tensorflow::int64>()(0);
+    auto node_name = name();
+    auto& bps_context = common::GetContextFromName(node_name);
+    if (bps_context.initialized) {
+      StartRowSparseTask(context, done, node_name, indices, values, num_rows);
+    } else {
+      // the first push of a tensor blocks until all workers declared it
+      std::thread t(StartRowSparseTask, context, done, node_name, indices,
+                    values, num_rows);
+      t.detach();
+    }
+  }
+};
+
+REGISTER_KERNEL_BUILDER(
+    Name("BytepsPushPullRowSparse").Device(::tensorflow::DEVICE_CPU),
+    BytePSPushPullRowSparseOp);
+
+REGISTER_OP("BytepsPushPullRowSparse")
+    .Attr("T: {int32, int64, float16, bfloat16, float32, float64}")
+    .Input("indices: int64")
+    .Input("values: T")
+    .Input("dense_shape: int64")
+    .Output("sum_indices: int64")
+    .Output("sum_values: T")
+    .SetShapeFn([](::tensorflow::shape_inference::InferenceContext* c) {
+      ::tensorflow::shape_inference::ShapeHandle rows;
+      TF_RETURN_IF_ERROR(c->Subshape(c->input(1), 1, &rows));
+      ::tensorflow::shape_inference::ShapeHandle values;
+      TF_RETURN_IF_ERROR(
+          c->Concatenate(c->Vector(c->UnknownDim()), rows, &values));
+      c->set_output(0, c->Vector(c->UnknownDim()));
+      c->set_output(1, values);
+      return ::tensorflow::Status::OK();
+    })
+    .Doc(R"doc(
+Perform a row-sparse PushPull on the slices of a tensor. Only the rows in
+`indices` are sent, and the output holds every row sent by any process.
+All other processes that do a reduction on a tensor with the same name must
+have the same `dense_shape` for that tensor.
+Arguments
+    indices:      Unique row indices of `values`.
+    values:       The rows to reduce.
+    dense_shape:  The shape of the dense tensor.
+Output
+    sum_indices:  The row indices of `sum_values`.
+    sum_values:   The rows summed across all processes.
+)doc");
+
 }  // namespace tensorflow
 }  // namespace byteps
@@ -92,6 +92,31 @@ def _push_pull(tensor, scope='', name=None):
     return C_LIB.byteps_push_pull(tensor, name=name)
 
 
+def _push_pull_row_sparse(indices, values, dense_shape, scope='', name=None):
+    """An op which sums the slices of a tensor over all the BytePS processes,
+    sending only the rows in `indices`, which must be unique. The dense shape
+    must be the same on all BytePS processes for a given name. Requires one
+    BytePS process per worker machine.
+    Returns:
+      The row indices and values of the sum, which holds every row sent by
+      any process.
+    """
+    if name is None and not _executing_eagerly():
+        name = 'BytePSPushPullRowSparse_%s' % _normalize_name(values.name)
+    if scope == '' and not _executing_eagerly():
+        if 'v1' in dir(tf.compat):
+            scope = tf.compat.v1.get_default_graph().get_name_scope()
+        else:
+            scope = tf.get_default_graph().get_name_scope()
+        if scope != '':
+            scope += '/'
+    full_name = scope + name
+    full_name = full_name.encode("ascii")
+    TF_LIB_CTYPES.byteps_tensorflow_declare_tensor(ctypes.c_char_p(full_name))
+    return C_LIB.byteps_push_pull_row_sparse(indices, values, dense_shape,
+                                             name=name)
+
+
 @ops.RegisterGradient('BytePSPushPull')
 def _push_pull_grad(op, grad):
     """Gradient for push_pull op.
@@ -20,8 +20,10 @@ from __future__ import print_function
 
 from byteps.torch.compression import Compression
 from byteps.torch.ops import push_pull_async_inplace as byteps_push_pull
-from byteps.torch.ops import push_pull
-from byteps.torch.ops import poll, synchronize, declare
+from byteps.torch.ops import push_pull, PushPullOp
+from byteps.torch.ops import push_pull_row_sparse_async, push_pull_row_sparse
+from byteps.torch.ops import poll, synchronize, synchronize_all
+from byteps.torch.ops import declare, declare_all
 from byteps.torch.ops import init, shutdown
 from byteps.torch.ops import size, local_size, rank, local_rank
 
@@ -30,11 +32,38 @@ import torch
 import collections
 
 
+class _GradientBucket(object):
+    """Gradients of several parameters, push_pulled as one flat tensor."""
+
+    def __init__(self, name, dtype, device):
+        self.name = name
+        self.dtype = dtype
+        self.device = device
+        self.params = []
+        self.numel = 0
+        self.nbytes = 0
+        self.buffer = None
+        # parameters whose gradient is in the buffer in this step
+        self.ready = set()
+        self.handle = None
+        self.ctx = None
+        self.op = None
+
+    def add(self, p):
+        """Appends p and returns the offset of its gradient."""
+        offset = self.numel
+        self.params.append((p, offset))
+        self.numel += p.numel()
+        self.nbytes += p.numel() * p.element_size()
+        return offset
+
+
 class _DistributedOptimizer(torch.optim.Optimizer):
     def __init__(self, params, named_parameters, compression,
-                 backward_passes_per_step=1):
+                 backward_passes_per_step=1, sparse_as_dense=True):
         super(self.__class__, self).__init__(params)
         self._compression = compression
+        self._sparse_as_dense = sparse_as_dense
 
         if named_parameters is not None:
             named_parameters = list(named_parameters)
@@ -47,6 +76,19 @@ class _DistributedOptimizer(torch.optim.Optimizer):
                 "Async is only valid for distributed training"
             print('BytePS: enable asynchronous training')
 
+        # the servers apply the optimizer and return the updated weights
+        self._server_optimizer = os.getenv('BYTEPS_SERVER_OPTIMIZER', '') != ''
+        if self._server_optimizer:
+            assert not self._enable_async, \
+                "BYTEPS_SERVER_OPTIMIZER does not support async training"
+            assert int(os.getenv('DMLC_NUM_WORKER', 1)) > 1 or \
+                int(os.getenv('BYTEPS_FORCE_DISTRIBUTED', 0)), \
+                "Server optimizer is only valid for distributed training"
+            assert sparse_as_dense, \
+                "BYTEPS_SERVER_OPTIMIZER does not support sparse gradients"
+            print('BytePS: enable server-side optimizer ' +
+                  os.getenv('BYTEPS_SERVER_OPTIMIZER'))
+
         # make sure that named_parameters are tuples
         if any([not isinstance(p, tuple) for p in named_parameters]):
             raise ValueError('named_parameters should be a sequence of '
@@ -82,17 +124,62 @@ class _DistributedOptimizer(torch.optim.Optimizer):
         self._push_pull_delay = {v: self.backward_passes_per_step
                                  for _, v in sorted(named_parameters)}
         self._handles = {}
+        self._push_pull_ops = {}
+        # the weights before the update of each parameter in async mode
+        self._async_buffers = {}
         self._grad_accs = []
         self._requires_update = set()
         if size() > 1:
             self._register_hooks()
 
-        # declare tensors
-        for name in sorted(self._parameter_names.values()):
-            declare("Gradient."+name)
+        # gradients are copied into flat buckets of up to BYTEPS_BUCKET_BYTES
+        # as they become ready, and each bucket is push_pulled as one tensor
+        self._buckets = []
+        self._bucket_of = {}
+        bucket_bytes = int(os.getenv('BYTEPS_BUCKET_BYTES', 0))
+        if (bucket_bytes > 0 and size() > 1 and not self._enable_async and
+                not self._server_optimizer and sparse_as_dense):
+            self._build_buckets(bucket_bytes)
+
+        # compress gradients on the wire, see BYTEPS_COMPRESSOR
+        self._wire_compression = (not self._server_optimizer and
+                                  os.getenv('BYTEPS_COMPRESSOR', '') != '')
+
+        # small dense gradients may be fused, see BYTEPS_FUSION_BYTES
+        fusion = (sparse_as_dense and not self._server_optimizer and
+                  not self._wire_compression)
+
+        # declare tensors, with the sizes of the ones pushed in training for
+        # the balanced placement (async mode pushes parameters)
+        sizes = {name: p.numel() * p.element_size()
+                 for name, p in named_parameters}
+        grad_sizes = {} if self._enable_async else sizes
+        param_sizes = sizes if self._enable_async else {}
+        grad_options = dict(server_optimizer=self._server_optimizer,
+                            compressed=self._wire_compression, fusion=fusion)
+        bucketed = set(self._get_name(p) for p in self._bucket_of)
+        if (size() > 1 and not self._enable_async and sparse_as_dense and
+                self._compression is Compression.none and
+                len(sizes) == len(self._parameter_names)):
+            # the gradients have the size and dtype of the parameters, so
+            # they are initialized with the servers at once
+            grads = [(name, p) for name, p in sorted(named_parameters)
+                     if name not in bucketed]
+            grads += [(b.name, b.buffer) for b in self._buckets]
+            declare_all(grads, prefix="Gradient.", **grad_options)
+        else:
+            for name in sorted(self._parameter_names.values()):
+                if name not in bucketed:
+                    declare("Gradient."+name, size=grad_sizes.get(name, 0),
+                            **grad_options)
+            for b in self._buckets:
+                declare("Gradient."+b.name, size=b.nbytes, **grad_options)
         # We use two loops for load-balancing
         for name in sorted(self._parameter_names.values()):
-            declare("Parameter."+name)
+            declare("Parameter."+name, size=param_sizes.get(name, 0))
+
+        if self._server_optimizer and size() > 1:
+            self._init_server_weights()
 
     @staticmethod
     def find_duplicates(lst):
@@ -104,34 +191,120 @@ class _DistributedOptimizer(torch.optim.Optimizer):
             seen.add(el)
         return dups
 
+    def _init_server_weights(self):
+        """The first push_pull of each gradient key carries the initial
+        weights. Only rank 0 contributes, so this also broadcasts them."""
+        handles = []
+        for p in self._requires_update:
+            if p.dtype != torch.float32:
+                raise ValueError('Server optimizer only supports float32 '
+                                 'parameters, got %s' % p.dtype)
+            if self._is_tensor_instance:
+                name = self._parameter_names.get(p.__hash__())
+            else:
+                name = self._parameter_names.get(p)
+            if rank() == 0:
+                tensor = p.data.clone()
+            else:
+                tensor = p.data.new(p.size()).zero_()
+            handle = byteps_push_pull(tensor, average=False, name="Gradient."+name)
+            handles.append((p, handle))
+        outputs = synchronize_all([handle for _, handle in handles])
+        for (p, _), output in zip(handles, outputs):
+            p.data.copy_(output)
+
     def set_backward_passes_per_step(self, passes):
         self.backward_passes_per_step = passes
         for p in self._push_pull_delay:
             self._push_pull_delay[p] = self.backward_passes_per_step
 
+    def _get_name(self, p):
+        if self._is_tensor_instance:
+            return self._parameter_names.get(p.__hash__())
+        return self._parameter_names.get(p)
+
+    def _build_buckets(self, bucket_bytes):
+        """Packs the parameters of each dtype and device into buckets in
+        reverse registration order, i.e., roughly the order in which their
+        gradients become ready in backward. A parameter larger than
+        bucket_bytes gets a bucket of its own."""
+        params = [p for param_group in self.param_groups
+                  for p in param_group['params'] if p in self._requires_update]
+        open_buckets = {}
+        for p in reversed(params):
+            nbytes = p.numel() * p.element_size()
+            bucket = open_buckets.get((p.dtype, p.device))
+            if bucket is None or bucket.nbytes + nbytes > bucket_bytes:
+                bucket = _GradientBucket('Bucket.%d' % len(self._buckets),
+                                         p.dtype, p.device)
+                self._buckets.append(bucket)
+                open_buckets[(p.dtype, p.device)] = bucket
+            self._bucket_of[p] = (bucket, bucket.add(p))
+        for bucket in self._buckets:
+            bucket.buffer = torch.zeros(bucket.numel, dtype=bucket.dtype,
+                                        device=bucket.device)
+
+    def _bucket_grad(self, p):
+        """Copies the gradient of p into its bucket, and push_pulls the
+        bucket once all of its gradients are there."""
+        bucket, offset = self._bucket_of[p]
+        if p.grad is None:
+            p.grad = p.data.new(p.size()).zero_()
+        bucket.buffer[offset:offset + p.numel()].copy_(p.grad.reshape(-1))
+        bucket.ready.add(p)
+        if len(bucket.ready) == len(bucket.params):
+            tensor_compressed, bucket.ctx = \
+                self._compression.compress(bucket.buffer)
+            if bucket.op is None:
+                bucket.op = PushPullOp("Gradient."+bucket.name)
+            bucket.handle = bucket.op(tensor_compressed, average=True)
+
     def _register_hooks(self):
         for param_group in self.param_groups:
             for p in param_group['params']:
                 if p.requires_grad:
-                    p.grad = p.data.new(p.size()).zero_()
+                    # a preallocated dense gradient turns sparse ones dense
+                    if self._sparse_as_dense:
+                        p.grad = p.data.new(p.size()).zero_()
                     self._requires_update.add(p)
                     p_tmp = p.expand_as(p)
                     grad_acc = p_tmp.grad_fn.next_functions[0][0]
                     grad_acc.register_hook(self._make_hook(p))
                     self._grad_accs.append(grad_acc)
 
+    def _get_op(self, p, prefix="Gradient."):
+        """The push_pull named prefix + the name of p, created at its first
+        use."""
+        ops = self._push_pull_ops.setdefault(prefix, {})
+        op = ops.get(p)
+        if op is None:
+            op = PushPullOp(prefix+self._get_name(p))
+            ops[p] = op
+        return op
+
     def _push_pull_grad_async(self, p):
-        if self._is_tensor_instance:
-            name = self._parameter_names.get(p.__hash__())
-        else:
-            name = self._parameter_names.get(p)
+        if p.grad is None:
+            # no gradient on this worker in this step
+            p.grad = p.data.new(p.size()).zero_()
         if self._enable_async:
             # the real handle will be created in step()
             handle, ctx = None, None
+        elif p.grad.is_sparse:
+            # only the rows touched in this step are sent
+            handle = push_pull_row_sparse_async(
+                p.grad, average=True, name="Gradient."+self._get_name(p))
+            ctx = None
+        elif self._server_optimizer:
+            # the servers average nothing, so send the mean gradient and
+            # get back the updated weights
+            tensor = p.grad
+            tensor.div_(size())
+            handle = self._get_op(p)(tensor, average=False)
+            ctx = None
         else:
             tensor = p.grad
             tensor_compressed, ctx = self._compression.compress(tensor)
-            handle = byteps_push_pull(tensor_compressed, average=True, name="Gradient."+name)
+            handle = self._get_op(p)(tensor_compressed, average=True)
         return handle, ctx
 
     def _make_hook(self, p):
@@ -147,13 +320,18 @@ class _DistributedOptimizer(torch.optim.Optimizer):
             assert self._push_pull_delay[p] > 0
             handle, ctx = None, None
             self._push_pull_delay[p] -= 1
+            if p in self._bucket_of:
+                if self._push_pull_delay[p] == 0:
+                    self._bucket_grad(p)
+                return
             if self._push_pull_delay[p] == 0:
                 handle, ctx = self._push_pull_grad_async(p)
             self._handles[p] = (handle, ctx)
         return hook
 
     def synchronize(self):
-        missing_p = self._requires_update - set(self._handles.keys())
+        missing_p = (self._requires_update - set(self._handles.keys()) -
+                     set(self._bucket_of.keys()))
         for p in missing_p:
             handle, ctx = self._push_pull_grad_async(p)
             self._handles[p] = (handle, ctx)
@@ -163,35 +341,63 @@ class _DistributedOptimizer(torch.optim.Optimizer):
             if handle is None:
                 handle, ctx = self._push_pull_grad_async(p)
                 self._handles[p] = (handle, ctx)
-        for p, (handle, _) in self._handles.items():
-            output = synchronize(handle)
+        for bucket in self._buckets:
+            for p, _ in bucket.params:
+                if p not in bucket.ready:
+                    self._bucket_grad(p)
+        outputs = synchronize_all(
+            [handle for handle, _ in self._handles.values()] +
+            [bucket.handle for bucket in self._buckets])
+        for bucket, output in zip(self._buckets, outputs[len(self._handles):]):
+            output = self._compression.decompress(output, bucket.ctx)
+            for p, offset in bucket.params:
+                self._push_pull_delay[p] = self.backward_passes_per_step
+                p.grad.copy_(output[offset:offset + p.numel()].view_as(p.grad))
+            bucket.ready.clear()
+            bucket.handle, bucket.ctx = None, None
+        for (p, (_, ctx)), output in zip(self._handles.items(), outputs):
             self._push_pull_delay[p] = self.backward_passes_per_step
-            if not self._enable_async:
+            if self._server_optimizer:
+                p.data.copy_(output)
+            elif output is not None and output.is_sparse:
+                p.grad = output
+            elif not self._enable_async:
                 p.grad.set_(self._compression.decompress(output, ctx))
         self._handles.clear()
 
     def step(self, closure=None):
         if self._enable_async:
-            old_weight_map = {}
-            # store the weights before update
-            for p, _ in self._handles.items():
-                old_weight_map[p] = p.data.clone().detach()
+            # store the weights before update in buffers kept across steps
+            params = list(self._handles.keys())
+            olds = []
+            for p in params:
+                old = self._async_buffers.get(p)
+                if old is None:
+                    old = self._async_buffers[p] = torch.empty_like(p.data)
+                olds.append(old)
+            if hasattr(torch, '_foreach_copy_'):
+                torch._foreach_copy_(olds, [p.data for p in params])
+            else:
+                for p, old in zip(params, olds):
+                    old.copy_(p.data)
             # update
             loss = super(self.__class__, self).step(closure)
-            
-            for p, (h, _) in self._handles.items():
-                # get the diff for each weight (in-place)
-                p.data.sub_(old_weight_map.get(p))
-                if h is None:
-                    # create the handler now
-                    if self._is_tensor_instance:
-                        name = self._parameter_names.get(p.__hash__())
-                    else:
-                        name = self._parameter_names.get(p)
-                    handle = byteps_push_pull(p, average=False, name="AsyncParam."+name)
-                    _, ctx = self._compression.compress(p)
-                    self._handles[p] = (handle, ctx)
 
+            for p, old in zip(params, olds):
+                # get the diff for each weight (in-place), and push it while
+                # the next diffs are computed
+                p.data.sub_(old)
+                if self._handles[p][0] is None:
+                    handle = self._get_op(p, "AsyncParam.")(p, average=False)
+                    self._handles[p] = (handle, None)
+
+            self.synchronize()
+            return loss
+        elif self._server_optimizer:
+            # the weights are already updated by the servers
+            loss = None
+            if closure is not None:
+                loss = closure()
             self.synchronize()
             return loss
         else:
@@ -201,7 +407,7 @@ class _DistributedOptimizer(torch.optim.Optimizer):
 
 def DistributedOptimizer(optimizer, named_parameters=None,
                          compression=Compression.none,
-                         backward_passes_per_step=1):
+                         backward_passes_per_step=1, sparse_as_dense=True):
     """
     An optimizer that wraps another torch.optim.Optimizer, using an push_pull to
     average gradient values before applying gradients to model weights.
@@ -211,6 +417,8 @@ def DistributedOptimizer(optimizer, named_parameters=None,
     DistributedOptimizer exposes the `synchronize()` method, which forces push_pull operations
     to finish before continuing the execution. It's useful in conjunction with gradient
     clipping, or other operations that modify gradients in place before `step()` is executed.
+    If BYTEPS_SERVER_OPTIMIZER is set, the servers apply the updates and `synchronize()`
+    copies the new weights into the model instead, see docs/env.md.
     Example of gradient clipping:
     ```
     output = model(data)
@@ -232,13 +440,19 @@ def DistributedOptimizer(optimizer, named_parameters=None,
                                   allows accumulating gradients over multiple
                                   mini-batches before executing averaging and
                                   applying them.
+        sparse_as_dense: If False, sparse gradients, e.g., of
+                         `nn.Embedding(sparse=True)`, are reduced with a
+                         row-sparse push_pull that only sends the touched
+                         rows. Requires one BytePS process per worker machine
+                         and the same parameters to get sparse gradients on
+                         all workers. Defaults to converting them to dense.
     """
     # We dynamically create a new class that inherits from the optimizer that was passed in.
     # The goal is to override the `step()` method with an push_pull implementation.
     cls = type(optimizer.__class__.__name__, (optimizer.__class__,),
                dict(_DistributedOptimizer.__dict__))
     return cls(optimizer.param_groups, named_parameters,
-               compression, backward_passes_per_step)
+               compression, backward_passes_per_step, sparse_as_dense)
 
 
 def broadcast_parameters(params, root_rank):
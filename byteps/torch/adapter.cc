@@ -36,6 +36,10 @@ const DataType TorchTensor::dtype() const {
       return DataType::BYTEPS_INT64;
     case ::torch::kHalf:
       return DataType::BYTEPS_FLOAT16;
+#if TORCH_VERSION >= 1003000000
+    case ::torch::kBFloat16:
+      return DataType::BYTEPS_BFLOAT16;
+#endif
     case ::torch::kFloat:
       return DataType::BYTEPS_FLOAT32;
     case ::torch::kDouble:
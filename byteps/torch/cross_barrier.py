@@ -4,17 +4,17 @@ from __future__ import print_function
 
 from byteps.torch.compression import Compression
 from byteps.torch.ops import push_pull_async_inplace as byteps_push_pull
-from byteps.torch.ops import poll, synchronize
+from byteps.torch.ops import synchronize, watch, wait_completion, post_completion
 from byteps.torch.ops import init, shutdown
 from byteps.torch.ops import size, local_size, rank, local_rank
 
+import collections
 import threading
 import logging
 try:
     import queue
 except ImportError:
     import Queue as queue
-import time
 import math
 import torch
 import byteps.torch as bps
@@ -59,12 +59,20 @@ class _CrossBarrier(_DistributedOptimizer):
             for p in param_group['params']:
                 self._locks[p] = threading.Lock()
 
+        # The hand-written updates only serve SGD, Adam and RMSprop themselves, as subclasses may change the math,
+        # e.g., AdamW. Other optimizers update the parameters with shards of their own class.
+        # the class of the wrapped optimizer is derived from the user's one by DistributedOptimizer
+        self._kernel = dict(_UPDATES).get(self._opt.__class__.__bases__[0])
+        self._index_param_groups()
+
         if size() > 1:
             self._register_forward_hooks()
             self._register_hooks()
 
-            # Poll whether the tensor push-pull is finished.
-            self._event_queue = queue.Queue()
+            # The poller updates each parameter once its push-pull completes.
+            # handle -> (parameter, compression context)
+            self._pending = {}
+            self._pending_cv = threading.Condition()
             self._poller = threading.Thread(target=self._poll, args=())
             self._poller.start()
 
@@ -81,9 +89,10 @@ class _CrossBarrier(_DistributedOptimizer):
             # if it is the final training step, wait for the completion of all tensors
             if self._step == self._final_step:
                 self._logger.debug("final step {}, waiting for push-pull completion.".format(self._final_step))
-                while not self._event_queue.empty():
-                    time.sleep(0.001)
-                self._event_queue.put((None, None, None))
+                with self._pending_cv:
+                    while self._pending:
+                        self._pending_cv.wait()
+                post_completion(-1)
                 self._poller.join()
                 self._logger.info("training finished!")
             loss = None
@@ -96,6 +105,11 @@ class _CrossBarrier(_DistributedOptimizer):
             super(self._opt.__class__, self._opt).step()
             self._step += 1
 
+    def load_state_dict(self, state_dict):
+        """Loads the state into the wrapped optimizer, whose state and param_groups the updates use."""
+        self._opt.load_state_dict(state_dict)
+        self._index_param_groups()
+
     def zero_grad(self):
         """Override the default zero_grad function.
         Clears the gradients of all optimized tensors.
@@ -152,38 +166,82 @@ class _CrossBarrier(_DistributedOptimizer):
         self._locks[p].acquire()
         handle = byteps_push_pull(tensor_compressed, average=True, name="Gradient."+name)
         self._logger.debug("{} calls byteps_push_pull for {}".format(self._desc, self._get_parameter_name(p)))
-        # Add to queue to poll completion
-        self._event_queue.put((p, handle, ctx))
+        # The poller gets the handle once the push-pull completes
+        with self._pending_cv:
+            self._pending[handle] = (p, ctx)
+        watch(handle)
         return handle, ctx
 
     def _poll(self):
-        """Poll the completion of the tensor's backward or push-pull from a FIFO event_queue"""
-        while True:
-            p, handle, ctx = self._event_queue.get()
-            if p is None:
-                self._logger.debug("poller exits.")
-                break
-            # Check whether the push-pull is finished. If so, start updating parameters.
-            if handle is not None and poll(handle):
+        """Update the parameters in the order in which their push-pulls complete"""
+        running = True
+        while running:
+            completed = []
+            for handle in wait_completion():
+                if handle < 0:
+                    self._logger.debug("poller exits.")
+                    running = False
+                    continue
+                with self._pending_cv:
+                    p, ctx = self._pending.pop(handle)
                 output = synchronize(handle)
                 p.grad.set_(self._compression.decompress(output, ctx))
                 self._logger.debug("{} {} finished push-pull".format(self._desc, self._get_parameter_name(p)))
                 self._push_pull_delay[p] = self.backward_passes_per_step
-                # So only support SGD, Adam and RMSprop optimizers in torch
-                if isinstance(self._opt, torch.optim.SGD):
-                    self._sgd(p)
-                elif isinstance(self._opt, torch.optim.Adam):
-                    self._adam(p)
-                elif isinstance(self._opt, torch.optim.RMSprop):
-                    self._rmsprop(p)
-                else:
-                    raise ValueError("Invalid optimizer! Only support SGD, Adam and RMSprop.")
+                completed.append(p)
+            self._update_params(completed)
+            for p in completed:
                 self._zero_one_grad(p)
                 # notify update completion and parameter is ready for forward propagation
                 if p in self._locks:
                     self._locks[p].release()
-            else:
-                self._event_queue.put((p, handle, ctx))
+            with self._pending_cv:
+                if not self._pending:
+                    self._pending_cv.notify_all()
+
+    def _index_param_groups(self):
+        """Maps each parameter to its param_group, so that an update does not search for it, and picks the update
+        of each param_group. For the generic updates, also builds a shard of the optimizer per param_group, which
+        shares the state of the wrapped optimizer."""
+        self._param_groups = {}
+        self._group_updates = {}
+        self._shards = {}
+        cls = self._opt.__class__.__bases__[0]
+        for param_group in self.param_groups:
+            for p in param_group['params']:
+                self._param_groups[p] = param_group
+            update = self._kernel
+            if update is None or any(param_group.get(option) for option in _UNSUPPORTED_OPTIONS):
+                update = self._shard_update
+                shard = cls([dict(param_group)], **self._opt.defaults)
+                shard.state = self._opt.state
+                self._shards[id(param_group)] = shard
+            self._group_updates[id(param_group)] = update
+
+    def _shard_update(self, group, params, state):
+        """Performs a single optimization step using the shard of a param_group on some of its parameters.
+        Arguments:
+            group: The param_group of the parameters.
+            params: The parameters to be updated.
+            state: The optimizer state, shared with the shard.
+        """
+        shard = self._shards[id(group)]
+        shard_group = shard.param_groups[0]
+        # the hyperparameters may have been changed, e.g., by a learning rate scheduler
+        for key, value in group.items():
+            if key != 'params':
+                shard_group[key] = value
+        shard_group['params'] = params
+        shard.step()
+
+    def _update_params(self, params):
+        """Updates the parameters whose push-pulls have completed together, one call per param_group."""
+        groups = collections.OrderedDict()
+        for p in params:
+            group = self._param_groups[p]
+            groups.setdefault(id(group), (group, []))[1].append(p)
+        for group, group_params in groups.values():
+            self._group_updates[id(group)](group, group_params, self.state)
 
     def _register_forward_hooks(self):
         """Add hook before forward propagation of each layer to block forward computation until the push-pull and
@@ -230,155 +288,189 @@ class _CrossBarrier(_DistributedOptimizer):
             p.grad.detach_()
             p.grad.zero_()
 
-    """Below are the implementations of optimizers, e.g., SGD, Adam, RMSprop.
-    The implementation is derived from Torch's code, except that we update one parameter each time."""
 
-    def _sgd(self, p):
-        """Performs a single optimization step using SGD optimizer on a parameter.
-        Arguments:
-            p: The parameter to be updated.
-        """
-        for group in self.param_groups:
-            weight_decay = group['weight_decay']
-            momentum = group['momentum']
-            dampening = group['dampening']
-            nesterov = group['nesterov']
-
-            for gp in group['params']:
-                if self._get_parameter_name(p) != self._get_parameter_name(gp) or gp.shape != p.shape:
-                    continue
-                self._logger.debug("{} is updating {}".format(self._desc, self._get_parameter_name(p)))
-                if p.grad is None:
-                    continue
-                d_p = p.grad.data
-                if weight_decay != 0:
-                    d_p.add_(weight_decay, p.data)
-                if momentum != 0:
-                    param_state = self.state[p]
-                    if 'momentum_buffer' not in param_state:
-                        buf = param_state['momentum_buffer'] = torch.zeros_like(p.data)
-                        buf.mul_(momentum).add_(d_p)
-                    else:
-                        buf = param_state['momentum_buffer']
-                        buf.mul_(momentum).add_(1 - dampening, d_p)
-                    if nesterov:
-                        d_p = d_p.add(momentum, buf)
-                    else:
-                        d_p = buf
-                p.data.add_(-group['lr'], d_p)
-                break
-
-    def _adam(self, p):
-        """Performs a single optimization step using Adam optimizer on a parameter.
-        Arguments:
-            p: The parameter to be updated.
-        """
-        for group in self.param_groups:
-            for gp in group['params']:
-                if self._get_parameter_name(p) != self._get_parameter_name(gp) or gp.shape != p.shape:
-                    continue
-                self._logger.debug("{} is updating {}".format(self._desc, self._get_parameter_name(p)))
-                if p.grad is None:
-                    continue
-                grad = p.grad.data
-                if grad.is_sparse:
-                    raise RuntimeError('Adam does not support sparse gradients, please consider SparseAdam instead')
-                amsgrad = group['amsgrad']
+"""Below are the implementations of optimizers, e.g., SGD, Adam, RMSprop.
+The implementation is derived from Torch's code, except that we update the parameters of one group whose push-pulls
+have completed together."""
 
-                state = self.state[p]
+_HAS_FOREACH = hasattr(torch, '_foreach_add_')
 
-                # State initialization
-                if len(state) == 0:
-                    state['step'] = 0
 
-                    # Exponential moving average of gradient values
-                    state['exp_avg'] = torch.zeros_like(p.data)
+def _sgd(group, params, state):
+    """Performs a single optimization step using SGD optimizer on some parameters.
+    Arguments:
+        group: The param_group of the parameters.
+        params: The parameters to be updated.
+        state: The optimizer state.
+    """
+    weight_decay = group['weight_decay']
+    momentum = group['momentum']
+    dampening = group['dampening']
+    nesterov = group['nesterov']
+
+    params = [p for p in params if p.grad is not None]
+    if not params:
+        return
+    if _HAS_FOREACH:
+        # one multi-tensor kernel per operation for all parameters
+        data = [p.data for p in params]
+        d_ps = [p.grad.data for p in params]
+        if weight_decay != 0:
+            torch._foreach_add_(d_ps, data, alpha=weight_decay)
+        if momentum != 0:
+            new_bufs, old_bufs = [], []
+            for p, d_p in zip(params, d_ps):
+                param_state = state[p]
+                if 'momentum_buffer' not in param_state:
+                    param_state['momentum_buffer'] = torch.clone(d_p).detach()
+                    new_bufs.append(param_state['momentum_buffer'])
+                else:
+                    old_bufs.append((param_state['momentum_buffer'], d_p))
+            if old_bufs:
+                bufs = [b for b, _ in old_bufs]
+                torch._foreach_mul_(bufs, momentum)
+                torch._foreach_add_(bufs, [d_p for _, d_p in old_bufs], alpha=1 - dampening)
+            bufs = [state[p]['momentum_buffer'] for p in params]
+            if nesterov:
+                d_ps = torch._foreach_add(d_ps, bufs, alpha=momentum)
+            else:
+                d_ps = bufs
+        torch._foreach_add_(data, d_ps, alpha=-group['lr'])
+        return
+
+    for p in params:
+        d_p = p.grad.data
+        if weight_decay != 0:
+            d_p.add_(weight_decay, p.data)
+        if momentum != 0:
+            param_state = state[p]
+            if 'momentum_buffer' not in param_state:
+                buf = param_state['momentum_buffer'] = torch.zeros_like(p.data)
+                buf.mul_(momentum).add_(d_p)
+            else:
+                buf = param_state['momentum_buffer']
+                buf.mul_(momentum).add_(1 - dampening, d_p)
+            if nesterov:
+                d_p = d_p.add(momentum, buf)
+            else:
+                d_p = buf
+        p.data.add_(-group['lr'], d_p)
 
-                    # Exponential moving average of squared gradient values
-                    state['exp_avg_sq'] = torch.zeros_like(p.data)
-                    if amsgrad:
-                        # Maintains max of all exp. moving avg. of sq. grad. values
-                        state['max_exp_avg_sq'] = torch.zeros_like(p.data)
 
-                exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
-                if amsgrad:
-                    max_exp_avg_sq = state['max_exp_avg_sq']
-                beta1, beta2 = group['betas']
+def _adam(group, params, state):
+    """Performs a single optimization step using Adam optimizer on some parameters.
+    Arguments:
+        group: The param_group of the parameters.
+        params: The parameters to be updated.
+        state: The optimizer state.
+    """
+    amsgrad = group['amsgrad']
+    beta1, beta2 = group['betas']
+    for p in params:
+        if p.grad is None:
+            continue
+        grad = p.grad.data
+        if grad.is_sparse:
+            raise RuntimeError('Adam does not support sparse gradients, please consider SparseAdam instead')
+
+        param_state = state[p]
+
+        # State initialization
+        if len(param_state) == 0:
+            param_state['step'] = 0
+
+            # Exponential moving average of gradient values
+            param_state['exp_avg'] = torch.zeros_like(p.data)
+
+            # Exponential moving average of squared gradient values
+            param_state['exp_avg_sq'] = torch.zeros_like(p.data)
+            if amsgrad:
+                # Maintains max of all exp. moving avg. of sq. grad. values
+                param_state['max_exp_avg_sq'] = torch.zeros_like(p.data)
+
+        exp_avg, exp_avg_sq = param_state['exp_avg'], param_state['exp_avg_sq']
+        if amsgrad:
+            max_exp_avg_sq = param_state['max_exp_avg_sq']
+
+        param_state['step'] += 1
+
+        if group['weight_decay'] != 0:
+            grad.add_(group['weight_decay'], p.data)
+
+        # Decay the first and second moment running average coefficient
+        exp_avg.mul_(beta1).add_(1 - beta1, grad)
+        exp_avg_sq.mul_(beta2).addcmul_(1 - beta2, grad, grad)
+        if amsgrad:
+            # Maintains the maximum of all 2nd moment running avg. till now
+            torch.max(max_exp_avg_sq, exp_avg_sq, out=max_exp_avg_sq)
+
+            # Use the max. for normalizing running avg. of gradient
+            denom = max_exp_avg_sq.sqrt().add_(group['eps'])
+        else:
+            denom = exp_avg_sq.sqrt().add_(group['eps'])
 
-                state['step'] += 1
+        bias_correction1 = 1 - beta1 ** param_state['step']
+        bias_correction2 = 1 - beta2 ** param_state['step']
+        step_size = group['lr'] * math.sqrt(bias_correction2) / bias_correction1
 
-                if group['weight_decay'] != 0:
-                    grad.add_(group['weight_decay'], p.data)
+        p.data.addcdiv_(-step_size, exp_avg, denom)
 
-                # Decay the first and second moment running average coefficient
-                exp_avg.mul_(beta1).add_(1 - beta1, grad)
-                exp_avg_sq.mul_(beta2).addcmul_(1 - beta2, grad, grad)
-                if amsgrad:
-                    # Maintains the maximum of all 2nd moment running avg. till now
-                    torch.max(max_exp_avg_sq, exp_avg_sq, out=max_exp_avg_sq)
 
-                    # Use the max. for normalizing running avg. of gradient
-                    denom = max_exp_avg_sq.sqrt().add_(group['eps'])
-                else:
-                    denom = exp_avg_sq.sqrt().add_(group['eps'])
+def _rmsprop(group, params, state):
+    """Performs a single optimization step using RMSprop optimizer on some parameters.
+    Arguments:
+        group: The param_group of the parameters.
+        params: The parameters to be updated.
+        state: The optimizer state.
+    """
+    alpha = group['alpha']
+    for p in params:
+        if p.grad is None:
+            continue
+        grad = p.grad.data
+        if grad.is_sparse:
+            raise RuntimeError('RMSprop does not support sparse gradients')
+        param_state = state[p]
+
+        # State initialization
+        if len(param_state) == 0:
+            param_state['step'] = 0
+            param_state['square_avg'] = torch.zeros_like(p.data)
+            if group['momentum'] > 0:
+                param_state['momentum_buffer'] = torch.zeros_like(p.data)
+            if group['centered']:
+                param_state['grad_avg'] = torch.zeros_like(p.data)
+
+        square_avg = param_state['square_avg']
+
+        param_state['step'] += 1
+
+        if group['weight_decay'] != 0:
+            grad = grad.add(group['weight_decay'], p.data)
+
+        square_avg.mul_(alpha).addcmul_(1 - alpha, grad, grad)
+
+        if group['centered']:
+            grad_avg = param_state['grad_avg']
+            grad_avg.mul_(alpha).add_(1 - alpha, grad)
+            avg = square_avg.addcmul(-1, grad_avg, grad_avg).sqrt().add_(group['eps'])
+        else:
+            avg = square_avg.sqrt().add_(group['eps'])
 
-                bias_correction1 = 1 - beta1 ** state['step']
-                bias_correction2 = 1 - beta2 ** state['step']
-                step_size = group['lr'] * math.sqrt(bias_correction2) / bias_correction1
+        if group['momentum'] > 0:
+            buf = param_state['momentum_buffer']
+            buf.mul_(group['momentum']).addcdiv_(grad, avg)
+            p.data.add_(-group['lr'], buf)
+        else:
+            p.data.addcdiv_(-group['lr'], grad, avg)
 
-                p.data.addcdiv_(-step_size, exp_avg, denom)
-                break
 
-    def _rmsprop(self, p):
-        """Performs a single optimization step using RMSprop optimizer on a parameter.
-        Arguments:
-            p: The parameter to be updated.
-        """
-        for group in self.param_groups:
-            for gp in group['params']:
-                if self._get_parameter_name(p) != self._get_parameter_name(gp) or gp.shape != p.shape:
-                    continue
-                self._logger.debug("{} is updating {}".format(self._desc, self._get_parameter_name(p)))
-                if p.grad is None:
-                    continue
-                grad = p.grad.data
-                if grad.is_sparse:
-                    raise RuntimeError('RMSprop does not support sparse gradients')
-                state = self.state[p]
-
-                # State initialization
-                if len(state) == 0:
-                    state['step'] = 0
-                    state['square_avg'] = torch.zeros_like(p.data)
-                    if group['momentum'] > 0:
-                        state['momentum_buffer'] = torch.zeros_like(p.data)
-                    if group['centered']:
-                        state['grad_avg'] = torch.zeros_like(p.data)
-
-                square_avg = state['square_avg']
-                alpha = group['alpha']
-
-                state['step'] += 1
-
-                if group['weight_decay'] != 0:
-                    grad = grad.add(group['weight_decay'], p.data)
-
-                square_avg.mul_(alpha).addcmul_(1 - alpha, grad, grad)
-
-                if group['centered']:
-                    grad_avg = state['grad_avg']
-                    grad_avg.mul_(alpha).add_(1 - alpha, grad)
-                    avg = square_avg.addcmul(-1, grad_avg, grad_avg).sqrt().add_(group['eps'])
-                else:
-                    avg = square_avg.sqrt().add_(group['eps'])
+# Hand-written updates of these exact classes, other optimizers use _CrossBarrier._shard_update
+_UPDATES = [(torch.optim.SGD, _sgd), (torch.optim.Adam, _adam), (torch.optim.RMSprop, _rmsprop)]
 
-                if group['momentum'] > 0:
-                    buf = state['momentum_buffer']
-                    buf.mul_(group['momentum']).addcdiv_(grad, avg)
-                    p.data.add_(-group['lr'], buf)
-                else:
-                    p.data.addcdiv_(-group['lr'], grad, avg)
-                break
+# Options of torch's optimizers that the hand-written updates do not implement, param_groups setting them use
+# _CrossBarrier._shard_update
+_UNSUPPORTED_OPTIONS = ('maximize', 'decoupled_weight_decay')
 
 
 def _init_bsc():
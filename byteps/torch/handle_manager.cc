@@ -27,17 +27,74 @@ int HandleManager::AllocateHandle() {
 }
 
 void HandleManager::MarkDone(int handle, const Status& status) {
-  std::lock_guard<std::mutex> guard(mutex_);
-  results_[handle] = std::make_shared<Status>(status);
+  bool watched;
+  {
+    std::lock_guard<std::mutex> guard(mutex_);
+    results_[handle] = std::make_shared<Status>(status);
+    watched = watched_.erase(handle) > 0;
+    if (watched) {
+      completed_.push_back(handle);
+    }
+  }
+  cv_.notify_all();
+  if (watched) {
+    completion_cv_.notify_one();
+  }
 }
 
-bool HandleManager::PollHandle(int handle) {
-  std::lock_guard<std::mutex> guard(mutex_);
-  if (results_.find(handle) == results_.end()) {
+bool HandleManager::IsDone(int handle) {
+  auto it = results_.find(handle);
+  if (it == results_.end()) {
     throw std::invalid_argument("Handle " + std::to_string(handle) +
                                 " was not created or has been cleared.");
   }
-  return results_[handle] != nullptr;
+  return it->second != nullptr;
+}
+
+bool HandleManager::PollHandle(int handle) {
+  std::lock_guard<std::mutex> guard(mutex_);
+  return IsDone(handle);
+}
+
+void HandleManager::WaitHandle(int handle) {
+  std::unique_lock<std::mutex> lock(mutex_);
+  cv_.wait(lock, [this, handle] { return IsDone(handle); });
+}
+
+void HandleManager::WaitHandles(const std::vector<int>& handles) {
+  std::unique_lock<std::mutex> lock(mutex_);
+  // the handles finish roughly in order, so each wait skips the done ones
+  for (auto handle : handles) {
+    cv_.wait(lock, [this, handle] { return IsDone(handle); });
+  }
+}
+
+void HandleManager::WatchHandle(int handle) {
+  {
+    std::lock_guard<std::mutex> guard(mutex_);
+    if (!IsDone(handle)) {
+      watched_.insert(handle);
+      return;
+    }
+    completed_.push_back(handle);
+  }
+  completion_cv_.notify_one();
+}
+
+std::vector<int> HandleManager::WaitCompletion() {
+  std::unique_lock<std::mutex> lock(mutex_);
+  completion_cv_.wait(lock, [this] { return !completed_.empty(); });
+  std::vector<int> handles(completed_.begin(), completed_.end());
+  completed_.clear();
+  return handles;
+}
+
+void HandleManager::PostCompletion(int handle) {
+  {
+    std::lock_guard<std::mutex> guard(mutex_);
+    completed_.push_back(handle);
+  }
+  completion_cv_.notify_one();
 }
 
 std::shared_ptr<Status> HandleManager::ReleaseHandle(int handle) {
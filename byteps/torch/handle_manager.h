@@ -18,9 +18,13 @@
 #define BYTEPS_TORCH_HANDLE_MANAGER_H
 
 #include <atomic>
+#include <condition_variable>
+#include <deque>
 #include <memory>
 #include <mutex>
 #include <unordered_map>
+#include <unordered_set>
+#include <vector>
 
 #include "../common/common.h"
 
@@ -34,12 +38,29 @@ class HandleManager {
   int AllocateHandle();
   void MarkDone(int handle, const Status& status);
   bool PollHandle(int handle);
+  // Block until MarkDone() has been called for the handles
+  void WaitHandle(int handle);
+  void WaitHandles(const std::vector<int>& handles);
   std::shared_ptr<Status> ReleaseHandle(int handle);
 
+  // A watched handle is put into the completion queue once it is done
+  void WatchHandle(int handle);
+  // Blocks until the completion queue is not empty and pops all of it
+  std::vector<int> WaitCompletion();
+  // Puts a value into the completion queue, e.g., to wake up a waiter
+  void PostCompletion(int handle);
+
  private:
+  // Throws if the handle is unknown, the caller holds mutex_
+  bool IsDone(int handle);
+
   std::atomic_int last_handle_;
   std::unordered_map<int, std::shared_ptr<Status>> results_;
   std::mutex mutex_;
+  std::condition_variable cv_;
+  std::unordered_set<int> watched_;
+  std::deque<int> completed_;
+  std::condition_variable completion_cv_;
 };
 
 }  // namespace torch
@@ -17,8 +17,11 @@
 #include <torch/extension.h>
 #include <torch/torch.h>
 #include <chrono>
+#include <cstring>
 #include <memory>
+#include <mutex>
 #include <thread>
+#include <unordered_map>
 
 #include "../common/operations.h"
 #include "adapter.h"
@@ -31,6 +34,15 @@ namespace torch {
 
 static HandleManager handle_manager;
 
+// results of row-sparse push_pull, taken by RowSparseResult()
+struct RowSparseOutput {
+  std::shared_ptr<common::RowSparseData> data;
+  ::torch::TensorOptions options;
+  std::vector<int64_t> row_shape;
+};
+static std::mutex row_sparse_mutex;
+static std::unordered_map<int, RowSparseOutput> row_sparse_outputs;
+
 namespace {
 
 std::string GetOpName(const std::string& prefix, const std::string& name,
@@ -48,31 +60,25 @@ int GetDeviceID(const ::torch::Tensor& tensor) {
   return CPU_DEVICE_ID;
 }
 
-}  // namespace
-
-void StartTask(::torch::Tensor tensor, ::torch::Tensor output, int average,
-               const std::string tensor_name, int version, int priority, int handle) {
+std::shared_ptr<std::vector<common::QueueType>> GetQueueList(int device) {
+  auto queue_list = common::GetPushQueueList(device);
+  auto queue_list_pull = common::GetPullQueueList(device);
+  queue_list->insert(queue_list->end(), queue_list_pull->begin(),
+                     queue_list_pull->end());
+  return queue_list;
+}
 
+void StartTask(common::BPSContext* context,
+               std::shared_ptr<std::vector<common::QueueType>> queue_list,
+               ::torch::Tensor tensor, ::torch::Tensor output, int average,
+               int version, int priority, int handle) {
   auto device = GetDeviceID(tensor);
   auto ready_event = RecordReadyEvent(device);
   auto byteps_input = std::make_shared<TorchTensor>(tensor);
   auto byteps_output = std::make_shared<TorchTensor>(output);
-  size_t size = byteps_input->size();
-  auto dtype = byteps_input->dtype();
-
-  auto& context = common::GetContextFromName(tensor_name);
-  common::InitTensor(context, size, dtype,
-                      (device == CPU_DEVICE_ID)
-                      ? const_cast<void*>(byteps_input->data())
-                      : nullptr);
-
-  auto queue_list = common::GetPushQueueList(device);
-  auto queue_list_pull = common::GetPullQueueList(device);
-  queue_list->insert(queue_list->end(), queue_list_pull->begin(),
-                     queue_list_pull->end());
 
   auto enqueue_result = common::EnqueueTensor(
-      context, byteps_input, byteps_output, ready_event, device, priority,
+      *context, byteps_input, byteps_output, ready_event, device, priority,
       version,
       [handle, average, tensor, output](const Status& status) mutable {
         // Will execute in the `device` context.
@@ -84,26 +90,133 @@ void StartTask(::torch::Tensor tensor, ::torch::Tensor output, int average,
       queue_list);
 
   ThrowIfError(enqueue_result);
-  return;
+}
 
+// Starts the push_pull right away if the tensor is initialized, otherwise
+// once the init pool has initialized it
+int PushPull(common::BPSContext* context,
+             std::shared_ptr<std::vector<common::QueueType>> queue_list,
+             ::torch::Tensor tensor, ::torch::Tensor output, int average,
+             int version, int priority) {
+  auto handle = handle_manager.AllocateHandle();
+  if (context->initialized) {
+    StartTask(context, queue_list, tensor, output, average, version, priority,
+              handle);
+  } else {
+    TorchTensor byteps_input(tensor);
+    auto cpubuff = (GetDeviceID(tensor) == CPU_DEVICE_ID)
+                       ? const_cast<void*>(byteps_input.data())
+                       : nullptr;
+    common::InitTensorAsync(
+        *context, byteps_input.size(), byteps_input.dtype(), cpubuff,
+        [context, queue_list, tensor, output, average, version, priority,
+         handle]() {
+          StartTask(context, queue_list, tensor, output, average, version,
+                    priority, handle);
+        });
+  }
+  return handle;
 }
 
+}  // namespace
+
 int DoPushPull(::torch::Tensor tensor, ::torch::Tensor output, int average,
                const std::string& name, int version, int priority) {
   ThrowIfError(common::CheckInitialized());
 
-  auto handle = handle_manager.AllocateHandle();
   std::string tensor_name = GetOpName("byteps", name.c_str(), 0);
   auto& context = common::GetContextFromName(tensor_name);
-  if (context.initialized) {
-    StartTask(tensor, output, average, tensor_name, version, priority, handle);
-  } else {
-    std::thread t(StartTask, tensor, output, average, tensor_name, version, priority, handle);
-    t.detach();
+  return PushPull(&context, GetQueueList(GetDeviceID(tensor)), tensor, output,
+                  average, version, priority);
+}
+
+// A push_pull declared once, which keeps its context and queue list so
+// that each call skips the name lookups of DoPushPull
+class PushPullOp {
+ public:
+  explicit PushPullOp(const std::string& name) {
+    ThrowIfError(common::CheckInitialized());
+    std::string tensor_name = GetOpName("byteps", name.c_str(), 0);
+    common::IsTensorDeclared(tensor_name);
+    _context = &common::GetContextFromName(tensor_name);
   }
+
+  int Run(::torch::Tensor tensor, ::torch::Tensor output, int average,
+          int version, int priority) {
+    auto device = GetDeviceID(tensor);
+    if (!_queue_list || device != _device) {
+      _queue_list = GetQueueList(device);
+      _device = device;
+    }
+    return PushPull(_context, _queue_list, tensor, output, average, version,
+                    priority);
+  }
+
+ private:
+  common::BPSContext* _context;
+  // the queue list of _device
+  std::shared_ptr<std::vector<common::QueueType>> _queue_list;
+  int _device = CPU_DEVICE_ID;
+};
+
+// indices: int64 row ids without duplicates, values: rows on CPU
+int DoPushPullRowSparse(::torch::Tensor indices, ::torch::Tensor values,
+                        int64_t num_rows, const std::string& name) {
+  ThrowIfError(common::CheckInitialized());
+
+  auto handle = handle_manager.AllocateHandle();
+  std::string tensor_name = GetOpName("byteps", name.c_str(), 0);
+  common::IsTensorDeclared(tensor_name);
+  auto& context = common::GetContextFromName(tensor_name);
+  auto dtype = TorchTensor(values).dtype();
+  std::vector<int64_t> row_shape(values.sizes().begin() + 1,
+                                 values.sizes().end());
+  size_t row_len = values.element_size();
+  for (auto dim : row_shape) row_len *= dim;
+  common::InitRowSparseTensor(context, num_rows, row_len, dtype);
+
+  auto options = values.options();
+  auto enqueue_result = common::EnqueueRowSparseTensor(
+      context, reinterpret_cast<const int64_t*>(indices.data_ptr()),
+      values.data_ptr(), values.size(0), dtype,
+      [handle, options, row_shape](
+          const Status& status, std::shared_ptr<common::RowSparseData> data) {
+        {
+          std::lock_guard<std::mutex> lock(row_sparse_mutex);
+          row_sparse_outputs[handle] = {data, options, row_shape};
+        }
+        handle_manager.MarkDone(handle, status);
+      });
+  ThrowIfError(enqueue_result);
   return handle;
 }
 
+// Returns [indices, values] of a finished row-sparse push_pull
+std::vector<::torch::Tensor> RowSparseResult(int handle) {
+  RowSparseOutput output;
+  {
+    std::lock_guard<std::mutex> lock(row_sparse_mutex);
+    auto it = row_sparse_outputs.find(handle);
+    if (it == row_sparse_outputs.end()) {
+      ThrowIfError(Status::InvalidArgument(
+          "No row-sparse result for handle " + std::to_string(handle)));
+    }
+    output = std::move(it->second);
+    row_sparse_outputs.erase(it);
+  }
+  auto& data = output.data;
+  int64_t n = data ? data->indices.size() : 0;
+  auto indices = ::torch::empty({n}, ::torch::kInt64);
+  std::vector<int64_t> shape{n};
+  shape.insert(shape.end(), output.row_shape.begin(), output.row_shape.end());
+  auto values = ::torch::empty(shape, output.options);
+  if (n) {
+    memcpy(indices.data_ptr(), data->indices.data(), n * sizeof(int64_t));
+    memcpy(values.data_ptr(), data->values.data(), data->values.size());
+  }
+  return {indices, values};
+}
+
 int PollHandle(int handle) { return handle_manager.PollHandle(handle) ? 1 : 0; }
 
 void DeclareTensor(const std::string& name) {
@@ -111,19 +224,93 @@ void DeclareTensor(const std::string& name) {
   common::IsTensorDeclared(tensor_name);
 }
 
-void WaitAndClear(int handle) {
-  while (!handle_manager.PollHandle(handle)) {
-    std::this_thread::sleep_for(std::chrono::milliseconds(1));
+void DeclareTensorWithType(const std::string& name, int request_type) {
+  std::string tensor_name = GetOpName("byteps", name.c_str(), 0);
+  common::IsTensorDeclared(tensor_name);
+  auto& context = common::GetContextFromName(tensor_name);
+  // must be set before the first push of this tensor
+  if (context.initialized) {
+    ThrowIfError(Status::PreconditionError(
+        tensor_name + " is already initialized"));
+  }
+  context.request_type = static_cast<common::RequestType>(request_type);
+}
+
+void DeclareFusedTensor(const std::string& name) {
+  std::string tensor_name = GetOpName("byteps", name.c_str(), 0);
+  common::IsTensorDeclared(tensor_name);
+  auto& context = common::GetContextFromName(tensor_name);
+  // must be set before the first push of this tensor
+  if (context.initialized) {
+    ThrowIfError(Status::PreconditionError(
+        tensor_name + " is already initialized"));
+  }
+  context.fusion = true;
+}
+
+void DeclareTensorSize(const std::string& name, size_t size) {
+  std::string tensor_name = GetOpName("byteps", name.c_str(), 0);
+  common::IsTensorDeclared(tensor_name);
+  auto& context = common::GetContextFromName(tensor_name);
+  context.declared_size = size;
+}
+
+// Initializes the push_pulls of the given GPU tensors with one round trip.
+// Called without the GIL.
+void InitTensors(const std::vector<std::string>& names,
+                 const std::vector<::torch::Tensor>& tensors) {
+  ThrowIfError(common::CheckInitialized());
+  std::vector<common::BPSContext*> contexts;
+  std::vector<size_t> sizes;
+  std::vector<int> dtypes;
+  for (size_t i = 0; i < names.size(); ++i) {
+    if (GetDeviceID(tensors[i]) == CPU_DEVICE_ID) {
+      ThrowIfError(Status::InvalidArgument(
+          names[i] + " is on CPU, it is initialized by its first push_pull"));
+    }
+    std::string tensor_name = GetOpName("byteps", names[i].c_str(), 0);
+    common::IsTensorDeclared(tensor_name);
+    auto byteps_tensor = TorchTensor(tensors[i]);
+    contexts.push_back(&common::GetContextFromName(tensor_name));
+    sizes.push_back(byteps_tensor.size());
+    dtypes.push_back(byteps_tensor.dtype());
   }
+  common::InitTensors(contexts, sizes, dtypes);
+}
+
+// Both are called without the GIL
+void WaitAndClear(int handle) {
+  handle_manager.WaitHandle(handle);
   auto status = handle_manager.ReleaseHandle(handle);
   ThrowIfError(*status);
 }
 
+// Releases all handles before reporting the first error
+void WaitAllAndClear(const std::vector<int>& handles) {
+  handle_manager.WaitHandles(handles);
+  Status first_error = Status::OK();
+  for (auto handle : handles) {
+    auto status = handle_manager.ReleaseHandle(handle);
+    if (first_error.ok() && !status->ok()) {
+      first_error = *status;
+    }
+  }
+  ThrowIfError(first_error);
+}
+
+void WatchHandle(int handle) { handle_manager.WatchHandle(handle); }
+
+// Called without the GIL
+std::vector<int> WaitCompletion() { return handle_manager.WaitCompletion(); }
+
+void PostCompletion(int handle) { handle_manager.PostCompletion(handle); }
+
 PYBIND11_MODULE(c_lib, m) {
   // push_pull
   m.def("byteps_torch_push_pull_async_torch_IntTensor", &DoPushPull);
   m.def("byteps_torch_push_pull_async_torch_LongTensor", &DoPushPull);
   m.def("byteps_torch_push_pull_async_torch_HalfTensor", &DoPushPull);
+  m.def("byteps_torch_push_pull_async_torch_BFloat16Tensor", &DoPushPull);
   m.def("byteps_torch_push_pull_async_torch_FloatTensor", &DoPushPull);
   m.def("byteps_torch_push_pull_async_torch_DoubleTensor", &DoPushPull);
 
@@ -131,14 +318,35 @@ PYBIND11_MODULE(c_lib, m) {
   m.def("byteps_torch_push_pull_async_torch_cuda_IntTensor", &DoPushPull);
   m.def("byteps_torch_push_pull_async_torch_cuda_LongTensor", &DoPushPull);
   m.def("byteps_torch_push_pull_async_torch_cuda_HalfTensor", &DoPushPull);
+  m.def("byteps_torch_push_pull_async_torch_cuda_BFloat16Tensor",
+        &DoPushPull);
   m.def("byteps_torch_push_pull_async_torch_cuda_FloatTensor", &DoPushPull);
   m.def("byteps_torch_push_pull_async_torch_cuda_DoubleTensor", &DoPushPull);
 #endif
 
   // basics
+  m.def("byteps_torch_push_pull_row_sparse_async", &DoPushPullRowSparse);
+  m.def("byteps_torch_row_sparse_result", &RowSparseResult);
+
+  pybind11::class_<PushPullOp>(m, "PushPullOp")
+      .def(pybind11::init<const std::string&>())
+      .def("run", &PushPullOp::Run);
+
   m.def("byteps_torch_poll", &PollHandle);
-  m.def("byteps_torch_wait_and_clear", &WaitAndClear);
+  m.def("byteps_torch_wait_and_clear", &WaitAndClear,
+        pybind11::call_guard<pybind11::gil_scoped_release>());
+  m.def("byteps_torch_wait_all_and_clear", &WaitAllAndClear,
+        pybind11::call_guard<pybind11::gil_scoped_release>());
+  m.def("byteps_torch_watch", &WatchHandle);
+  m.def("byteps_torch_wait_completion", &WaitCompletion,
+        pybind11::call_guard<pybind11::gil_scoped_release>());
+  m.def("byteps_torch_post_completion", &PostCompletion);
   m.def("byteps_torch_declare_tensor", &DeclareTensor);
+  m.def("byteps_torch_declare_tensor_with_type", &DeclareTensorWithType);
+  m.def("byteps_torch_declare_fused_tensor", &DeclareFusedTensor);
+  m.def("byteps_torch_declare_tensor_size", &DeclareTensorSize);
+  m.def("byteps_torch_init_tensors", &InitTensors,
+        pybind11::call_guard<pybind11::gil_scoped_release>());
 }
 
 }  // namespace torch
@@ -161,6 +161,45 @@ def push_pull_async_inplace(tensor, average=True, name=None, version=0, priority
     return _do_push_pull_async(tensor, tensor, average, name, version, priority)
 
 
+class PushPullOp(object):
+    """
+    A push_pull with a fixed name, declared once. Each call is a single call
+    into the C++ library, without the declaration and the name lookups of
+    `push_pull_async()`. To declare the tensor with options, call `declare()`
+    before creating the op.
+    Arguments:
+        name: A name of the push_pull operation.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._run = c_lib.PushPullOp(name.encode()).run
+
+    def __call__(self, tensor, average=True, output=None, version=0,
+                 priority=0):
+        """
+        Performs an asynchronous push_pull of the tensor, in place unless an
+        output tensor is given.
+        Arguments:
+            tensor: A contiguous tensor to average and sum. Its type and
+                    shape must be the same in all calls.
+            average: A flag indicating whether to compute average or
+                     summation, defaults to average.
+            output: A tensor of the shape and type of tensor that receives
+                    the result.
+        Returns:
+            A handle to the push_pull operation that can be used with
+            `poll()` or `synchronize()`.
+        """
+        if not tensor.is_contiguous():
+            raise ValueError('Tensor is required to be contiguous.')
+        if output is None:
+            output = tensor
+        handle = self._run(tensor, output, average, version, priority)
+        _handle_map[handle] = (tensor, output)
+        return handle
+
+
 def push_pull_inplace(tensor, average=True, name=None, version=0, priority=0):
     """
     A function that performs in-place averaging or summation of the input tensor over
@@ -182,6 +221,66 @@ def push_pull_inplace(tensor, average=True, name=None, version=0, priority=0):
     return synchronize(handle)
 
 
+class _RowSparseOutput(object):
+    """Placeholder of a row-sparse push_pull result until it is synchronized."""
+
+    def __init__(self, tensor, average):
+        self.shape = tensor.shape
+        self.device = tensor.device
+        self.average = average
+
+    def fetch(self, handle):
+        indices, values = c_lib.byteps_torch_row_sparse_result(handle)
+        if self.average:
+            values.div_(size())
+        return torch.sparse_coo_tensor(indices.unsqueeze(0), values,
+                                       self.shape).to(self.device)
+
+
+def push_pull_row_sparse_async(tensor, average=True, name=None):
+    """
+    A function that performs asynchronous averaging or summation of a sparse
+    tensor whose first dimension is sparse, e.g., the gradient of an
+    `nn.Embedding(sparse=True)`, over all the BytePS processes. Only the rows
+    present in `tensor` are sent, and the result holds every row sent by any
+    process. The dense shape must be the same on all BytePS processes for a
+    given name. Requires one BytePS process per worker machine.
+    Arguments:
+        tensor: A sparse COO tensor to average and sum.
+        average: A flag indicating whether to compute average or summation,
+                 defaults to average.
+        name: A name of the reduction operation.
+    Returns:
+        A handle to the push_pull operation that can be used with `poll()` or
+        `synchronize()`.
+    """
+    if name is None:
+        raise AssertionError("To call row-sparse push_pull, you must specify a name by name=...")
+    if not tensor.is_sparse or tensor.sparse_dim() != 1:
+        raise ValueError('%s: only sparse tensors with one sparse dimension '
+                         'are supported' % name)
+    tensor = tensor.coalesce()
+    indices = tensor._indices()[0].cpu().contiguous()
+    values = tensor._values().cpu().contiguous()
+    handle = c_lib.byteps_torch_push_pull_row_sparse_async(
+        indices, values, tensor.shape[0], name.encode())
+    _handle_map[handle] = ((indices, values), _RowSparseOutput(tensor, average))
+    return handle
+
+
+def push_pull_row_sparse(tensor, average=True, name=None):
+    """
+    A function that performs averaging or summation of a sparse tensor whose
+    first dimension is sparse over all the BytePS processes. See
+    `push_pull_row_sparse_async()`.
+    Returns:
+        A sparse tensor of the same dense shape and type as `tensor`, averaged
+        or summed across all processes.
+    """
+    handle = push_pull_row_sparse_async(tensor, average, name)
+    return synchronize(handle)
+
+
 def poll(handle):
     """
     Polls an push_pull handle to determine whether underlying
@@ -196,8 +295,105 @@ def poll(handle):
     return c_lib.byteps_torch_poll(handle) != 0
 
 
-def declare(name):
-    c_lib.byteps_torch_declare_tensor(name.encode())
+def watch(handle):
+    """
+    Puts a handle into the completion queue once its push_pull operation has
+    completed, so that it is returned by `wait_completion()`. The handle must
+    still be synchronized.
+    Arguments:
+        handle: A handle returned by an push_pull asynchronous
+                operation.
+    """
+    c_lib.byteps_torch_watch(handle)
+
+
+def wait_completion():
+    """
+    Blocks until the completion queue is not empty, without holding the GIL,
+    and empties it.
+    Returns:
+        A list of the watched handles whose operations have completed and of
+        the values given to `post_completion()`, in the order of completion.
+    """
+    return c_lib.byteps_torch_wait_completion()
+
+
+def post_completion(value):
+    """
+    Puts a value that is not a handle, e.g., -1, into the completion queue,
+    to wake up a thread blocked in `wait_completion()`.
+    """
+    c_lib.byteps_torch_post_completion(value)
+
+
+# Values of RequestType in byteps/common/common.h
+_COMPRESSED_PUSH_PULL = 2
+_SERVER_OPTIMIZER_PUSH_PULL = 3
+
+
+def declare(name, server_optimizer=False, compressed=False, fusion=False,
+            size=0):
+    """
+    Declares a tensor before its first push_pull.
+
+    Arguments:
+        name: A name of the push_pull operation.
+        server_optimizer: If True, the servers apply the optimizer set by
+                          BYTEPS_SERVER_OPTIMIZER to this tensor, so a
+                          push_pull of gradients returns the updated weights.
+                          The first push_pull must carry the initial weights.
+        compressed: If True, float32 data is compressed on the wire with the
+                    method set by BYTEPS_COMPRESSOR.
+        fusion: If True, the tensor may be pushed and pulled together with
+                other small tensors declared with fusion by the same
+                declare_all(), see BYTEPS_FUSION_BYTES. All of them must be
+                push_pulled in every step.
+        size: The size of the tensor in bytes, used to balance the bytes per
+              server with BYTEPS_KEY_HASH_FN=balanced. All tensors must be
+              declared before the first push_pull.
+    """
+    if server_optimizer and compressed:
+        raise ValueError('%s: server optimizer does not support compression' % name)
+    if fusion and (server_optimizer or compressed):
+        raise ValueError('%s: fusion only supports plain push_pull' % name)
+    if server_optimizer:
+        c_lib.byteps_torch_declare_tensor_with_type(name.encode(),
+                                                    _SERVER_OPTIMIZER_PUSH_PULL)
+    elif compressed:
+        c_lib.byteps_torch_declare_tensor_with_type(name.encode(),
+                                                    _COMPRESSED_PUSH_PULL)
+    elif fusion:
+        c_lib.byteps_torch_declare_fused_tensor(name.encode())
+    else:
+        c_lib.byteps_torch_declare_tensor(name.encode())
+    if size:
+        c_lib.byteps_torch_declare_tensor_size(name.encode(), size)
+    return 0
+
+
+def declare_all(named_tensors, prefix='Gradient.', **kwargs):
+    """
+    Declares the push_pulls of several tensors and initializes them with the
+    servers at once. It costs one round trip to the servers instead of one
+    per partition at the first push_pull of each tensor. Tensors on CPU are
+    only declared.
+
+    Arguments:
+        named_tensors: A sequence of (name, tensor) tuples, e.g.,
+                       model.named_parameters(). The push_pull of each tensor
+                       must be named prefix + name and have its size and
+                       dtype. All workers must declare in the same order.
+        prefix: The prefix of the push_pull names.
+        kwargs: Other arguments of declare().
+    """
+    names, tensors = [], []
+    for name, tensor in named_tensors:
+        declare(prefix + name, size=tensor.numel() * tensor.element_size(),
+                **kwargs)
+        if tensor.is_cuda:
+            names.append((prefix + name).encode())
+            tensors.append(tensor.detach())
+    c_lib.byteps_torch_init_tensors(names, tensors)
     return 0
 
 
@@ -215,4 +411,32 @@ def synchronize(handle):
         return
     c_lib.byteps_torch_wait_and_clear(handle)
     _, output = _handle_map.pop(handle)
+    if isinstance(output, _RowSparseOutput):
+        return output.fetch(handle)
     return output
+
+
+def synchronize_all(handles):
+    """
+    Synchronizes several asynchronous push_pull operations with a single
+    wait, which is cheaper than calling `synchronize()` on each of them.
+    Arguments:
+        handles: A list of handles returned by push_pull asynchronous
+                 operations.
+    Returns:
+        A list of the output tensors of the operations, in the order of
+        `handles`.
+    """
+    pending = [h for h in handles if h in _handle_map]
+    if pending:
+        c_lib.byteps_torch_wait_all_and_clear(pending)
+    outputs = []
+    for handle in handles:
+        if handle not in _handle_map:
+            outputs.append(None)
+            continue
+        _, output = _handle_map.pop(handle)
+        if isinstance(output, _RowSparseOutput):
+            output = output.fetch(handle)
+        outputs.append(output)
+    return outputs
@@ -26,8 +26,8 @@ optimizer, as shown below:
 import byteps.torch.cross_barrier as bps
 optimizer = bps.CrossBarrier(model, optimizer, named_parameters, compression, backward_passes_per_step, num_steps)
 ```
-So far we support SGD, Adam and RMSprop optimizers. Please submit a ticket if you need support for 
-any other optimizers.
+SGD, Adam and RMSprop have hand-written updates. Other optimizers, e.g., AdamW or Adagrad, update the parameters with
+instances of their own class that share the state of the wrapped optimizer.
 
 To see performance gain, the system parameters should be properly set, including BYTEPS_PARTITION_BYTES and 
 BYTEPS_SCHEDULING_CREDIT.
@@ -89,7 +89,6 @@ compression = bps.Compression.fp16 if args.fp16_allreduce else bps.Compression.n
 
 # Wrap Torch optimizer with CrossBarrier.
 # You need to specify two additional args, i.e., model and num_steps.
-# Note that we only support SGD, Adam and RMSProp optimizers so far.
 optimizer = bps.CrossBarrier(model,
                                      optimizer,
                                      named_parameters=model.named_parameters(),
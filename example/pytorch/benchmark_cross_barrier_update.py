@@ -0,0 +1,58 @@
+from __future__ import print_function
+
+import argparse
+import timeit
+import torch
+from byteps.torch import cross_barrier
+
+# Measures the Python-side cost per step of the CrossBarrier parameter updates against the number of parameters.
+# It only runs the updates, with the parameters whose push-pulls complete together passed in one call.
+parser = argparse.ArgumentParser(description='CrossBarrier update overhead',
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--optimizer', type=str, default='sgd', choices=['sgd', 'adam', 'rmsprop'],
+                    help='optimizer whose update is measured')
+parser.add_argument('--num-params', type=str, default='100,1000,4000',
+                    help='comma-separated numbers of parameters')
+parser.add_argument('--param-size', type=int, default=256,
+                    help='number of float32 elements per parameter')
+parser.add_argument('--completed-together', type=int, default=8,
+                    help='number of parameters updated per call')
+parser.add_argument('--num-warmup-steps', type=int, default=3,
+                    help='number of warm-up steps')
+parser.add_argument('--num-steps', type=int, default=10,
+                    help='number of benchmark steps')
+parser.add_argument('--no-cuda', action='store_true', default=False,
+                    help='use parameters on CPU')
+args = parser.parse_args()
+device = 'cuda' if not args.no_cuda and torch.cuda.is_available() else 'cpu'
+
+optimizers = {
+    'sgd': (torch.optim.SGD, dict(lr=0.01, momentum=0.9)),
+    'adam': (torch.optim.Adam, dict(lr=0.001)),
+    'rmsprop': (torch.optim.RMSprop, dict(lr=0.01)),
+}
+cls, kwargs = optimizers[args.optimizer]
+update = dict(cross_barrier._UPDATES)[cls]
+
+print('Optimizer: %s, %d float32 per parameter on %s, %d updated per call' %
+      (args.optimizer, args.param_size, device, args.completed_together))
+for num_params in [int(n) for n in args.num_params.split(',')]:
+    params = [torch.zeros(args.param_size, device=device, requires_grad=True) for _ in range(num_params)]
+    for p in params:
+        p.grad = torch.ones_like(p)
+    opt = cls(params, **kwargs)
+    group = opt.param_groups[0]
+    times = []
+    for step in range(args.num_warmup_steps + args.num_steps):
+        if device == 'cuda':
+            torch.cuda.synchronize()
+        start = timeit.default_timer()
+        for i in range(0, num_params, args.completed_together):
+            update(group, params[i:i + args.completed_together], opt.state)
+        if device == 'cuda':
+            torch.cuda.synchronize()
+        if step >= args.num_warmup_steps:
+            times.append(timeit.default_timer() - start)
+    per_step = sum(times) / len(times)
+    print('%6d parameters: %8.2f ms per step, %6.2f us per parameter' %
+          (num_params, per_step * 1e3, per_step / num_params * 1e6))
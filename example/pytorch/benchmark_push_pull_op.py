@@ -0,0 +1,64 @@
+from __future__ import print_function
+
+import argparse
+import timeit
+import torch
+import byteps.torch as bps
+from byteps.torch.ops import push_pull_async_inplace
+
+# Measures the Python-side cost of issuing a push_pull, i.e., the time until
+# the call returns its handle, for named push_pulls and PushPullOp.
+parser = argparse.ArgumentParser(description='PyTorch push_pull call overhead',
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--num-tensors', type=int, default=160,
+                    help='number of tensors pushed and pulled per iteration')
+parser.add_argument('--tensor-size', type=int, default=1024,
+                    help='number of float32 elements per tensor')
+parser.add_argument('--num-warmup-iters', type=int, default=5,
+                    help='number of warm-up iterations')
+parser.add_argument('--num-iters', type=int, default=50,
+                    help='number of benchmark iterations')
+parser.add_argument('--no-cuda', action='store_true', default=False,
+                    help='use tensors on CPU')
+args = parser.parse_args()
+args.cuda = not args.no_cuda and torch.cuda.is_available()
+
+bps.init()
+if args.cuda:
+    torch.cuda.set_device(bps.local_rank())
+device = 'cuda' if args.cuda else 'cpu'
+
+tensors = [torch.ones(args.tensor_size, device=device)
+           for _ in range(args.num_tensors)]
+names = ['bench.named.%d' % i for i in range(args.num_tensors)]
+ops = [bps.PushPullOp('bench.op.%d' % i) for i in range(args.num_tensors)]
+
+
+def named_push_pull():
+    return [push_pull_async_inplace(t, average=True, name=n)
+            for t, n in zip(tensors, names)]
+
+
+def op_push_pull():
+    return [op(t, average=True) for t, op in zip(tensors, ops)]
+
+
+def benchmark(issue):
+    times = []
+    for i in range(args.num_warmup_iters + args.num_iters):
+        start = timeit.default_timer()
+        handles = issue()
+        elapsed = timeit.default_timer() - start
+        bps.synchronize_all(handles)
+        if i >= args.num_warmup_iters:
+            times.append(elapsed)
+    return sum(times) / len(times) / args.num_tensors * 1e6
+
+
+named = benchmark(named_push_pull)
+persistent = benchmark(op_push_pull)
+if bps.rank() == 0:
+    print('Tensors: %d x %d float32 on %s' % (args.num_tensors,
+                                             args.tensor_size, device))
+    print('push_pull_async_inplace: %.2f us per call' % named)
+    print('PushPullOp:              %.2f us per call' % persistent)
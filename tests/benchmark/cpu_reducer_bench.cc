@@ -0,0 +1,120 @@
+// Copyright 2019 Bytedance Inc. or its affiliates. All Rights Reserved.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//     http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+// =============================================================================
+
+// GB/s of dst += src for each data type, with every summation kernel this
+// CPU supports on one thread, and with CpuReducer::sum on
+// BYTEPS_OMP_THREAD_PER_GPU threads. Bytes are counted as two reads and one
+// write of the buffer. Then the time to sum k float32 buffers into one, by
+// k - 1 calls of CpuReducer::sum and by one fused multi-source call. CPU
+// only, no network.
+//
+// Usage: ./cpu_reducer_bench [bytes] [iterations]
+
+#include <chrono>
+#include <cstdio>
+#include <cstdlib>
+#include <cstring>
+#include <vector>
+#include "../../byteps/common/cpu_reducer.h"
+
+using namespace byteps::common;
+
+namespace {
+
+template <typename F>
+double Measure(F f, size_t bytes, int iters) {
+  f();  // warm up
+  auto start = std::chrono::steady_clock::now();
+  for (int i = 0; i < iters; ++i) {
+    f();
+  }
+  auto end = std::chrono::steady_clock::now();
+  double sec = std::chrono::duration<double>(end - start).count();
+  return 3.0 * bytes * iters / sec / 1e9;
+}
+
+}  // namespace
+
+int main(int argc, char** argv) {
+  size_t bytes = argc > 1 ? strtoull(argv[1], nullptr, 10) : 4096000;
+  int iters = argc > 2 ? atoi(argv[2]) : 200;
+
+  struct {
+    const char* name;
+    DataType dtype;
+  } dtypes[] = {{"float32", BYTEPS_FLOAT32}, {"float64", BYTEPS_FLOAT64},
+                {"float16", BYTEPS_FLOAT16}, {"bfloat16", BYTEPS_BFLOAT16},
+                {"uint8", BYTEPS_UINT8},     {"int32", BYTEPS_INT32},
+                {"int8", BYTEPS_INT8},       {"int64", BYTEPS_INT64}};
+
+  std::vector<char> dst(bytes), src(bytes);
+  // small values, so that floats stay finite
+  for (size_t i = 0; i < bytes; ++i) {
+    dst[i] = 0;
+    src[i] = (i % 2) ? 0 : 1;
+  }
+  CpuReducer reducer(nullptr);
+
+  printf("bytes=%zu iterations=%d cpu=%s reducer=%s\n", bytes, iters,
+         GetCpuIsaName(GetCpuIsa()), GetCpuIsaName(reducer.getIsa()));
+  printf("%8s", "dtype");
+  for (int isa = 0; isa <= GetCpuIsa(); ++isa) {
+    printf(" %10s", GetCpuIsaName(static_cast<CpuIsa>(isa)));
+  }
+  printf(" %10s  (GB/s)\n", "reducer");
+
+  for (auto& d : dtypes) {
+    size_t n = bytes / GetSumElementSize(d.dtype);
+    printf("%8s", d.name);
+    for (int isa = 0; isa <= GetCpuIsa(); ++isa) {
+      auto kernel = GetSumKernel(d.dtype, static_cast<CpuIsa>(isa));
+      double gbps = Measure(
+          [&]() { kernel(dst.data(), dst.data(), src.data(), n); }, bytes,
+          iters);
+      printf(" %10.2f", gbps);
+    }
+    double gbps = Measure(
+        [&]() { reducer.sum(dst.data(), src.data(), bytes, d.dtype); }, bytes,
+        iters);
+    printf(" %10.2f\n", gbps);
+    memset(dst.data(), 0, bytes);
+  }
+
+  printf("\n%8s %12s %12s  (ms per reduction of float32)\n", "k",
+         "one_by_one", "fused");
+  for (int k : {2, 4, 8, 16}) {
+    std::vector<std::vector<char>> bufs(k - 1, src);
+    std::vector<void*> srcs{dst.data()};
+    for (auto& b : bufs) srcs.push_back(b.data());
+    // Measure() reports GB/s of one buffer, turn it back into time
+    double one_by_one = Measure(
+        [&]() {
+          for (int j = 1; j < k; ++j) {
+            reducer.sum(dst.data(), srcs[j], bytes, BYTEPS_FLOAT32);
+          }
+        },
+        bytes, iters);
+    double fused = Measure(
+        [&]() {
+          reducer.sum(dst.data(), srcs.data(), srcs.size(), bytes,
+                      BYTEPS_FLOAT32);
+        },
+        bytes, iters);
+    printf("%8d %12.3f %12.3f\n", k, 3.0 * bytes / one_by_one / 1e6,
+           3.0 * bytes / fused / 1e6);
+    memset(dst.data(), 0, bytes);
+  }
+  return 0;
+}
@@ -0,0 +1,76 @@
+// Copyright 2019 Bytedance Inc. or its affiliates. All Rights Reserved.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//     http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+// =============================================================================
+
+// Messages/sec through the server engine queue, with several producers
+// (request handler threads) and one consumer (the engine thread).
+//
+// Usage: ./engine_queue_bench [num_producers] [msgs_per_producer]
+
+#include <chrono>
+#include <cstdio>
+#include <cstdlib>
+#include <thread>
+#include <vector>
+#include "../../byteps/server/server.h"
+#include "../../byteps/server/queue.h"
+
+using namespace byteps::server;
+
+namespace {
+
+double Run(bool schedule, int spin, int producers, int msgs) {
+  PriorityQueue q(schedule, spin);
+  std::vector<std::thread> threads;
+  auto start = std::chrono::steady_clock::now();
+  std::thread consumer([&q, producers, msgs]() {
+    BytePSEngineMessage msg;
+    for (long i = 0; i < (long) producers * msgs; ++i) {
+      q.WaitAndPop(&msg);
+    }
+  });
+  for (int p = 0; p < producers; ++p) {
+    threads.emplace_back([&q, p, msgs]() {
+      for (int i = 0; i < msgs; ++i) {
+        BytePSEngineMessage msg;
+        msg.id = i;
+        msg.key = (uint64_t) (p * 64 + i % 64);
+        msg.ops = SUM_RECV;
+        q.Push(msg);
+      }
+    });
+  }
+  for (auto& t : threads) t.join();
+  consumer.join();
+  auto end = std::chrono::steady_clock::now();
+  double sec = std::chrono::duration<double>(end - start).count();
+  return (double) producers * msgs / sec;
+}
+
+}  // namespace
+
+int main(int argc, char** argv) {
+  int producers = argc > 1 ? atoi(argv[1]) : 2;
+  int msgs = argc > 2 ? atoi(argv[2]) : 200000;
+
+  printf("producers=%d msgs_per_producer=%d\n", producers, msgs);
+  printf("%10s %8s %14s\n", "mode", "spin", "msgs/s");
+  for (bool schedule : {false, true}) {
+    for (int spin : {0, 1000}) {
+      double rate = Run(schedule, spin, producers, msgs);
+      printf("%10s %8d %14.0f\n", schedule ? "schedule" : "fifo", spin, rate);
+    }
+  }
+  return 0;
+}
@@ -0,0 +1,147 @@
+// Copyright 2019 Bytedance Inc. or its affiliates. All Rights Reserved.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//     http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+// =============================================================================
+
+// CPU usage and wakeup latency of the worker loop threads, which either
+// poll their queue with 1us sleeps as the core loops used to, or wait on a
+// TaskNotifier. Runs as many loop threads as a worker has, first idle, then
+// with one task every interval sent to a random thread. Latency is from
+// adding a task to the loop thread taking it. No GPU or network.
+//
+// Usage: ./loop_wait_bench [threads] [tasks] [interval_us]
+// BYTEPS_LOOP_SPIN_COUNT sets the spins before a waiting thread blocks.
+
+#include <time.h>
+#include <algorithm>
+#include <atomic>
+#include <chrono>
+#include <cstdio>
+#include <cstdlib>
+#include <deque>
+#include <memory>
+#include <mutex>
+#include <random>
+#include <thread>
+#include <vector>
+#include "../../byteps/common/task_notifier.h"
+
+using namespace byteps::common;
+
+namespace {
+
+typedef std::chrono::steady_clock Clock;
+
+struct Loop {
+  std::mutex mu;
+  std::deque<Clock::time_point> tasks;
+  TaskNotifier notifier;
+  std::vector<double> latencies;
+
+  void Add() {
+    {
+      std::lock_guard<std::mutex> lock(mu);
+      tasks.push_back(Clock::now());
+    }
+    notifier.Notify();
+  }
+
+  bool Get() {
+    std::lock_guard<std::mutex> lock(mu);
+    if (tasks.empty()) return false;
+    latencies.push_back(
+        std::chrono::duration<double, std::micro>(Clock::now() - tasks.front())
+            .count());
+    tasks.pop_front();
+    return true;
+  }
+};
+
+double CpuSeconds() {
+  timespec ts;
+  clock_gettime(CLOCK_PROCESS_CPUTIME_ID, &ts);
+  return ts.tv_sec + ts.tv_nsec / 1e9;
+}
+
+void Run(const char* name, bool notify, int num_threads, int num_tasks,
+         int interval_us) {
+  std::vector<std::unique_ptr<Loop>> loops;
+  for (int i = 0; i < num_threads; ++i) loops.emplace_back(new Loop);
+  std::atomic<bool> stop{false};
+  std::vector<std::thread> threads;
+  for (auto& l : loops) {
+    Loop* loop = l.get();
+    threads.emplace_back([loop, notify, &stop]() {
+      while (!stop) {
+        uint64_t version = loop->notifier.Version();
+        if (loop->Get()) continue;
+        if (notify) {
+          loop->notifier.Wait(version);
+        } else {
+          std::this_thread::sleep_for(std::chrono::nanoseconds(1000));
+        }
+      }
+    });
+  }
+
+  // idle
+  double cpu = CpuSeconds();
+  auto start = Clock::now();
+  std::this_thread::sleep_for(std::chrono::seconds(1));
+  double idle = (CpuSeconds() - cpu) /
+                std::chrono::duration<double>(Clock::now() - start).count();
+
+  // busy
+  std::mt19937 rng(0);
+  cpu = CpuSeconds();
+  start = Clock::now();
+  for (int i = 0; i < num_tasks; ++i) {
+    loops[rng() % num_threads]->Add();
+    std::this_thread::sleep_for(std::chrono::microseconds(interval_us));
+  }
+  std::this_thread::sleep_for(std::chrono::milliseconds(20));
+  double busy = (CpuSeconds() - cpu) /
+                std::chrono::duration<double>(Clock::now() - start).count();
+
+  stop = true;
+  for (auto& l : loops) l->notifier.Notify();
+  for (auto& t : threads) t.join();
+
+  std::vector<double> latencies;
+  for (auto& l : loops) {
+    latencies.insert(latencies.end(), l->latencies.begin(),
+                     l->latencies.end());
+  }
+  std::sort(latencies.begin(), latencies.end());
+  double sum = 0;
+  for (auto x : latencies) sum += x;
+  printf("%8s %12.2f %12.2f %10.1f %10.1f %10.1f\n", name, idle, busy,
+         sum / latencies.size(), latencies[latencies.size() / 2],
+         latencies[latencies.size() * 99 / 100]);
+}
+
+}  // namespace
+
+int main(int argc, char** argv) {
+  int num_threads = argc > 1 ? atoi(argv[1]) : 12;
+  int num_tasks = argc > 2 ? atoi(argv[2]) : 5000;
+  int interval_us = argc > 3 ? atoi(argv[3]) : 50;
+
+  printf("threads=%d tasks=%d interval=%dus\n", num_threads, num_tasks,
+         interval_us);
+  printf("%8s %12s %12s %10s %10s %10s\n", "mode", "idle_cores",
+         "busy_cores", "mean_us", "p50_us", "p99_us");
+  Run("poll", false, num_threads, num_tasks, interval_us);
+  Run("notify", true, num_threads, num_tasks, interval_us);
+  return 0;
+}
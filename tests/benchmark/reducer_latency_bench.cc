@@ -0,0 +1,87 @@
+// Copyright 2019 Bytedance Inc. or its affiliates. All Rights Reserved.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//     http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+// =============================================================================
+
+// Microseconds per call of float32 dst += src across partition sizes, on
+// one thread, with an OpenMP team per call as CpuReducer used to do, and
+// with CpuReducer::sum on its persistent thread pool. Both use
+// BYTEPS_OMP_THREAD_PER_GPU threads. CPU only, no network.
+//
+// Usage: ./reducer_latency_bench [max_bytes] [iterations]
+
+#include <algorithm>
+#include <chrono>
+#include <cstdio>
+#include <cstdlib>
+#include <vector>
+#include "../../byteps/common/cpu_reducer.h"
+
+using namespace byteps::common;
+
+namespace {
+
+template <typename F>
+double Measure(F f, int iters) {
+  f();  // warm up
+  auto start = std::chrono::steady_clock::now();
+  for (int i = 0; i < iters; ++i) {
+    f();
+  }
+  auto end = std::chrono::steady_clock::now();
+  return std::chrono::duration<double, std::micro>(end - start).count() /
+         iters;
+}
+
+}  // namespace
+
+int main(int argc, char** argv) {
+  size_t max_bytes = argc > 1 ? strtoull(argv[1], nullptr, 10) : 16384000;
+  int iters = argc > 2 ? atoi(argv[2]) : 1000;
+  int num_threads = getenv("BYTEPS_OMP_THREAD_PER_GPU")
+                        ? atoi(getenv("BYTEPS_OMP_THREAD_PER_GPU"))
+                        : 4;
+
+  std::vector<float> dst(max_bytes / 4, 0), src(max_bytes / 4, 0);
+  CpuReducer reducer(nullptr);
+  auto kernel = GetSumKernel(BYTEPS_FLOAT32, reducer.getIsa());
+
+  printf("threads=%d iterations=%d isa=%s\n", num_threads, iters,
+         GetCpuIsaName(reducer.getIsa()));
+  printf("%10s %10s %10s %10s  (us per call)\n", "bytes", "serial", "openmp",
+         "pool");
+  for (size_t bytes = 1024; bytes <= max_bytes; bytes *= 4) {
+    size_t n = bytes / 4;
+    // fewer iterations for large sizes, so that each size takes similar time
+    int size_iters = std::max(10, (int)(iters * 4096.0 / bytes * 64));
+    size_iters = std::min(size_iters, iters * 10);
+    double serial = Measure(
+        [&]() { kernel(dst.data(), dst.data(), src.data(), n); }, size_iters);
+    double openmp = Measure(
+        [&]() {
+          size_t chunk = ((n + num_threads - 1) / num_threads + 15) / 16 * 16;
+          size_t num_chunks = (n + chunk - 1) / chunk;
+#pragma omp parallel for num_threads(num_threads)
+          for (size_t c = 0; c < num_chunks; ++c) {
+            kernel(dst.data() + c * chunk, dst.data() + c * chunk,
+                   src.data() + c * chunk, std::min(chunk, n - c * chunk));
+          }
+        },
+        size_iters);
+    double pool = Measure(
+        [&]() { reducer.sum(dst.data(), src.data(), bytes, BYTEPS_FLOAT32); },
+        size_iters);
+    printf("%10zu %10.2f %10.2f %10.2f\n", bytes, serial, openmp, pool);
+  }
+  return 0;
+}
@@ -0,0 +1,212 @@
+// Copyright 2019 Bytedance Inc. or its affiliates. All Rights Reserved.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//     http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+// =============================================================================
+
+// Replays the partitions of one training step of ResNet-50 and BERT-large
+// through the pending tasks of a scheduled queue with a ready table, as the
+// root GPU of a machine sees them. Gradients are produced from the last
+// layer to the first, the signals of the other GPUs arrive in a random
+// order shortly after, and the queue thread takes every task that is ready.
+// Compares the old vector that is sorted on every insert and scanned on
+// every get with TaskIndex. No GPU or network.
+//
+// Usage: ./scheduled_queue_bench [partition_bytes] [steps]
+
+#include <algorithm>
+#include <chrono>
+#include <cstdio>
+#include <cstdlib>
+#include <memory>
+#include <random>
+#include <unordered_map>
+#include <vector>
+#include "../../byteps/common/task_index.h"
+
+using namespace byteps::common;
+
+namespace {
+
+struct Task {
+  int priority;
+  uint64_t key;
+  unsigned int len;
+};
+
+// Parameter sizes in bytes of float32, in declaration order
+std::vector<size_t> ResNet50() {
+  std::vector<size_t> params;
+  auto conv_bn = [&](size_t in, size_t out, size_t k) {
+    params.push_back(k * k * in * out * 4);
+    params.push_back(out * 4);
+    params.push_back(out * 4);
+  };
+  conv_bn(3, 64, 7);
+  size_t in = 64;
+  int blocks[] = {3, 4, 6, 3};
+  for (int stage = 0; stage < 4; ++stage) {
+    size_t width = 64 << stage;
+    for (int b = 0; b < blocks[stage]; ++b) {
+      conv_bn(in, width, 1);
+      conv_bn(width, width, 3);
+      conv_bn(width, width * 4, 1);
+      if (b == 0) conv_bn(in, width * 4, 1);
+      in = width * 4;
+    }
+  }
+  params.push_back(2048 * 1000 * 4);
+  params.push_back(1000 * 4);
+  return params;
+}
+
+std::vector<size_t> BertLarge() {
+  size_t h = 1024, ffn = 4096;
+  std::vector<size_t> params = {30522 * h * 4, 512 * h * 4, 2 * h * 4,
+                                h * 4, h * 4};
+  for (int layer = 0; layer < 24; ++layer) {
+    for (int i = 0; i < 4; ++i) {  // query, key, value and output
+      params.push_back(h * h * 4);
+      params.push_back(h * 4);
+    }
+    params.push_back(h * 4);  // layer norm
+    params.push_back(h * 4);
+    params.push_back(h * ffn * 4);
+    params.push_back(ffn * 4);
+    params.push_back(ffn * h * 4);
+    params.push_back(h * 4);
+    params.push_back(h * 4);
+    params.push_back(h * 4);
+  }
+  params.push_back(h * h * 4);  // pooler
+  params.push_back(h * 4);
+  return params;
+}
+
+// Partitions in the order the backward pass produces them
+std::vector<Task> Partition(const std::vector<size_t>& params,
+                            size_t partition_bytes) {
+  std::vector<Task> tasks;
+  for (size_t i = params.size(); i-- > 0;) {
+    size_t bytes = params[i];
+    for (uint64_t p = 0; p * partition_bytes < bytes; ++p) {
+      unsigned int len =
+          std::min(partition_bytes, bytes - p * partition_bytes);
+      tasks.push_back({-(int)i, (i << 16) + p, len});
+    }
+  }
+  return tasks;
+}
+
+// The queue before TaskIndex
+class SortedVector {
+ public:
+  void Add(std::shared_ptr<Task> task, bool key_ready) {
+    _sq.push_back(task);
+    std::sort(_sq.begin(), _sq.end(),
+              [](std::shared_ptr<Task> a, std::shared_ptr<Task> b) {
+                if (a->priority == b->priority) {
+                  return (a->key < b->key);
+                }
+                return (a->priority > b->priority);
+              });
+  }
+  void SetKeyReady(uint64_t key) { _ready[key] = true; }
+  std::shared_ptr<Task> Pop() {
+    for (auto it = _sq.begin(); it != _sq.end(); ++it) {
+      if (!_ready[(*it)->key]) continue;
+      _ready[(*it)->key] = false;
+      auto task = *it;
+      _sq.erase(it);
+      return task;
+    }
+    return nullptr;
+  }
+
+ private:
+  std::vector<std::shared_ptr<Task>> _sq;
+  std::unordered_map<uint64_t, bool> _ready;
+};
+
+class Indexed {
+ public:
+  Indexed() : _index(true) {}
+  void Add(std::shared_ptr<Task> task, bool key_ready) {
+    _index.Add(std::move(task), key_ready);
+  }
+  void SetKeyReady(uint64_t key) { _index.SetKeyReady(key); }
+  std::shared_ptr<Task> Pop() {
+    return _index.PopReady([](const Task&) { return true; }, true);
+  }
+
+ private:
+  TaskIndex<Task> _index;
+};
+
+// Returns us per step, every task must come out exactly once
+template <typename Q>
+double Replay(const std::vector<Task>& tasks, int steps) {
+  std::mt19937 rng(0);
+  // the signals of the i-th task arrive after task signal_after[i] is added
+  std::vector<size_t> signal_after(tasks.size());
+  for (size_t i = 0; i < tasks.size(); ++i) {
+    signal_after[i] = std::min(tasks.size() - 1, i + rng() % 32);
+  }
+  std::vector<std::vector<size_t>> signals(tasks.size());
+  for (size_t i = 0; i < tasks.size(); ++i) {
+    signals[signal_after[i]].push_back(i);
+  }
+  for (auto& s : signals) std::shuffle(s.begin(), s.end(), rng);
+
+  double total = 0;
+  for (int step = 0; step < steps; ++step) {
+    std::vector<std::shared_ptr<Task>> entries;
+    for (auto& t : tasks) entries.push_back(std::make_shared<Task>(t));
+    Q q;
+    size_t taken = 0;
+    auto start = std::chrono::steady_clock::now();
+    for (size_t i = 0; i < tasks.size(); ++i) {
+      q.Add(entries[i], false);
+      for (auto j : signals[i]) q.SetKeyReady(tasks[j].key);
+      while (q.Pop()) ++taken;
+    }
+    auto end = std::chrono::steady_clock::now();
+    if (taken != tasks.size()) {
+      fprintf(stderr, "took %zu of %zu tasks\n", taken, tasks.size());
+      exit(1);
+    }
+    total += std::chrono::duration<double, std::micro>(end - start).count();
+  }
+  return total / steps;
+}
+
+}  // namespace
+
+int main(int argc, char** argv) {
+  size_t partition_bytes =
+      argc > 1 ? strtoull(argv[1], nullptr, 10) : 4096000;
+  int steps = argc > 2 ? atoi(argv[2]) : 20;
+
+  printf("partition_bytes=%zu steps=%d\n", partition_bytes, steps);
+  printf("%12s %10s %14s %14s  (us per step)\n", "model", "partitions",
+         "sorted_vector", "task_index");
+  struct {
+    const char* name;
+    std::vector<size_t> params;
+  } models[] = {{"resnet50", ResNet50()}, {"bert_large", BertLarge()}};
+  for (auto& m : models) {
+    auto tasks = Partition(m.params, partition_bytes);
+    printf("%12s %10zu %14.1f %14.1f\n", m.name, tasks.size(),
+           Replay<SortedVector>(tasks, steps), Replay<Indexed>(tasks, steps));
+  }
+  return 0;
+}
@@ -0,0 +1,151 @@
+// Copyright 2019 Bytedance Inc. or its affiliates. All Rights Reserved.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//     http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+// =============================================================================
+
+// Measures the request rate of the BytePS server, i.e. BytePSHandler and
+// the engine, with 1 vs 64 lock stripes. It starts a local cluster of one
+// scheduler, one server and num_workers worker processes over loopback.
+// Each worker pushes and pulls its keys from num_threads threads, with
+// synchronous rounds like in training.
+//
+// Usage: ./server_handler_bench [num_workers] [num_threads] [num_keys]
+//                               [bytes_per_key]
+
+#include <sys/wait.h>
+#include <unistd.h>
+#include <chrono>
+#include <cstdio>
+#include <cstdlib>
+#include <string>
+#include <thread>
+#include <vector>
+#include "ps/ps.h"
+
+extern "C" void byteps_server();
+
+namespace {
+
+// kDefaultPushPull of float32, see GetCommandType
+const int kCmd = 0;
+const int kIters = 50;
+
+std::vector<ps::Key> GetKeys(size_t num_keys) {
+  auto begin = ps::Postoffice::Get()->GetServerKeyRanges()[0].begin();
+  std::vector<ps::Key> keys;
+  for (size_t i = 0; i < num_keys; ++i) {
+    // same key layout as the workers: (declared_key << 16) + partition
+    keys.push_back(begin + ((i / 8) << 16) + (i % 8));
+  }
+  return keys;
+}
+
+void RunWorker(size_t num_threads, size_t num_keys, size_t len) {
+  auto kv = new ps::KVWorker<char>(0, 0);
+  ps::StartAsync(0, "server_handler_bench\0");
+  ps::Postoffice::Get()->Barrier(
+      0, ps::kWorkerGroup + ps::kServerGroup + ps::kScheduler);
+  auto keys = GetKeys(num_keys);
+  std::vector<char> data(len, 0);
+  ps::SArray<int> lens(1, len);
+
+  // init pushes
+  for (auto key : keys) {
+    ps::SArray<ps::Key> k(1, key);
+    ps::SArray<char> vals(data.data(), len, false);
+    kv->Wait(kv->ZPush(k, vals, lens, kCmd));
+  }
+  ps::Postoffice::Get()->Barrier(0, ps::kWorkerGroup);
+
+  auto start = std::chrono::steady_clock::now();
+  std::vector<std::thread> threads;
+  for (size_t t = 0; t < num_threads; ++t) {
+    threads.emplace_back([t, num_threads, len, &keys, &lens, kv]() {
+      std::vector<char> buf(len, 1);
+      for (int it = 0; it < kIters; ++it) {
+        for (size_t i = t; i < keys.size(); i += num_threads) {
+          ps::SArray<ps::Key> k(1, keys[i]);
+          ps::SArray<char> vals(buf.data(), len, false);
+          kv->Wait(kv->ZPush(k, vals, lens, kCmd));
+          ps::SArray<int> pull_lens(lens);
+          kv->Wait(kv->ZPull(k, &vals, &pull_lens, kCmd));
+        }
+      }
+    });
+  }
+  for (auto& t : threads) t.join();
+  double sec = std::chrono::duration<double>(
+      std::chrono::steady_clock::now() - start).count();
+  ps::Postoffice::Get()->Barrier(0, ps::kWorkerGroup);
+  if (ps::MyRank() == 0) {
+    // a push and a pull per key and iteration, from every worker
+    double reqs = 2.0 * keys.size() * kIters * ps::NumWorkers();
+    printf("%16s %16.0f\n", getenv("BYTEPS_SERVER_HANDLE_STRIPES"),
+           reqs / sec);
+    fflush(stdout);
+  }
+  ps::Finalize(0, true);
+  delete kv;
+}
+
+pid_t Launch(const char* role, int port, size_t num_workers, size_t stripes,
+             size_t num_threads, size_t num_keys, size_t len) {
+  pid_t pid = fork();
+  if (pid != 0) return pid;
+  setenv("DMLC_ROLE", role, 1);
+  setenv("DMLC_PS_ROOT_URI", "127.0.0.1", 1);
+  setenv("DMLC_PS_ROOT_PORT", std::to_string(port).c_str(), 1);
+  setenv("DMLC_NUM_SERVER", "1", 1);
+  setenv("DMLC_NUM_WORKER", std::to_string(num_workers).c_str(), 1);
+  setenv("BYTEPS_SERVER_HANDLE_STRIPES", std::to_string(stripes).c_str(), 1);
+  // one thread per sum, so that the handler and the engine are measured
+  setenv("BYTEPS_OMP_THREAD_PER_GPU", "1", 1);
+  if (std::string(role) == "worker") {
+    RunWorker(num_threads, num_keys, len);
+  } else {
+    // the scheduler also runs byteps_server(), as in bpslaunch
+    byteps_server();
+  }
+  exit(0);
+}
+
+}  // namespace
+
+int main(int argc, char** argv) {
+  size_t num_workers = argc > 1 ? atoi(argv[1]) : 4;
+  size_t num_threads = argc > 2 ? atoi(argv[2]) : 4;
+  size_t num_keys = argc > 3 ? atoi(argv[3]) : 256;
+  size_t len = argc > 4 ? atoi(argv[4]) : 65536;
+  if (num_workers == 0) num_workers = 1;
+  if (num_threads == 0) num_threads = 1;
+
+  printf("workers=%zu threads=%zu keys=%zu bytes_per_key=%zu\n", num_workers,
+         num_threads, num_keys, len);
+  printf("%16s %16s\n", "stripes", "req/s");
+  fflush(stdout);
+  int port = 9100 + getpid() % 500;
+  for (size_t stripes : {1, 64}) {
+    std::vector<pid_t> pids;
+    pids.push_back(Launch("scheduler", port, num_workers, stripes,
+                          num_threads, num_keys, len));
+    pids.push_back(Launch("server", port, num_workers, stripes, num_threads,
+                          num_keys, len));
+    for (size_t i = 0; i < num_workers; ++i) {
+      pids.push_back(Launch("worker", port, num_workers, stripes,
+                            num_threads, num_keys, len));
+    }
+    for (auto pid : pids) waitpid(pid, nullptr, 0);
+    ++port;
+  }
+  return 0;
+}